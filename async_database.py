@@ -0,0 +1,999 @@
+"""
+Асинхронный доступ к базе данных для обработчиков бота
+
+AsyncDatabase повторяет публичные методы Database, которые нужны обработчикам (save_*, list_*,
+get_*_period, get_files_by_period, get_report_dates и др.), на asyncpg со своим пулом подключений:
+запрос не занимает поток и не блокирует цикл событий, независимые запросы можно выполнять
+одновременно через asyncio.gather.
+
+Общие запросы (сводные блоки за период, пересчет daily_club_facts) и помощники берутся из database.py,
+параметры psycopg2 (%s, %(name)s) переводятся в $1..$n один раз на текст запроса. Схему создает
+и обновляет Database при запуске; движки загрузки, переобработки и воркер очереди работают через Database.
+"""
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+import asyncpg
+
+from database import (
+    DAILY_FACT_COLUMNS,
+    DAILY_FACTS_UPSERT_SQL,
+    DAILY_FACTS_VERSION,
+    INGEST_JOB_COLUMNS,
+    PAYMENT_CASH_TOTAL_SQL,
+    UPLOADED_FILE_COLUMNS,
+    Database,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Блоки отчета по файлу: таблица -> колонки строки (list_* читает их и created_at, save_* пишет их)
+BLOCK_COLUMNS = {
+    'income_records': ('category', 'amount'),
+    'ticket_sales': ('price_label', 'price_value', 'quantity', 'amount', 'is_total'),
+    'payment_types': ('payment_type', 'amount', 'is_total', 'is_cash_total'),
+    'staff_statistics': ('role_name', 'staff_count'),
+    'expense_records': ('expense_item', 'amount', 'is_total'),
+    'misc_expenses_records': ('expense_item', 'amount', 'is_total'),
+    'cash_collection': ('currency_label', 'quantity', 'exchange_rate', 'amount', 'is_total'),
+    'staff_debts': ('debt_type', 'amount', 'is_total'),
+    'notes_entries': ('category', 'entry_text', 'is_total', 'amount'),
+    'totals_summary': ('payment_type', 'income_amount', 'expense_amount', 'net_profit'),
+}
+
+# Флаги строк блока, которые по умолчанию FALSE
+BLOCK_FLAGS = ('is_total', 'is_cash_total')
+
+# Блоки, от которых зависит daily_club_facts: после записи дневные показатели пересчитываются
+DAILY_FACTS_BLOCKS = frozenset({'income_records', 'ticket_sales', 'staff_debts', 'totals_summary', 'taxi_expenses'})
+
+
+class AsyncDatabase:
+    """Методы Database для обработчиков как корутины на пуле подключений asyncpg"""
+
+    def __init__(self, host: str, port: int, database: str, user: str, password: str,
+                 pool_min: int = 1, pool_max: int = 10, pool_timeout: float = 30.0,
+                 pool_max_idle: float = 300.0, prepared_statements: bool = True):
+        """
+        Параметры как у Database; пул создается в open() внутри цикла событий
+
+        prepared_statements=False отключает кэш подготовленных запросов asyncpg
+        (нужно за PgBouncer в режиме pool_mode=transaction).
+        """
+        self.connection_params = {
+            'host': host,
+            'port': port,
+            'database': database,
+            'user': user,
+            'password': password
+        }
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        self.pool_timeout = pool_timeout
+        self.pool_max_idle = pool_max_idle
+        self.prepared_statements = prepared_statements
+        self.pool: Optional[asyncpg.Pool] = None
+        self.trigram_search = False
+        # Текст запроса psycopg2 -> (текст с $1..$n, имена именованных параметров)
+        self._statement_templates: Dict[str, Tuple[str, Optional[List[str]]]] = {}
+        self._stats = {'calls': 0, 'in_flight': 0, 'max_in_flight': 0, 'timeouts': 0}
+
+    async def open(self) -> None:
+        """Создание пула подключений (вызывается из post_init приложения)"""
+        if self.pool is not None:
+            return
+        self.pool = await asyncpg.create_pool(
+            **self.connection_params,
+            min_size=self.pool_min,
+            max_size=self.pool_max,
+            max_inactive_connection_lifetime=self.pool_max_idle,
+            statement_cache_size=100 if self.prepared_statements else 0,
+            init=self._init_connection
+        )
+        self.trigram_search = await self._fetchval(
+            "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')"
+        )
+        logger.info(f"Async database pool opened ({self.pool_min}-{self.pool_max} connections)")
+
+    async def close(self) -> None:
+        """Закрытие пула подключений (post_shutdown приложения)"""
+        if self.pool is None:
+            return
+        pool, self.pool = self.pool, None
+        await pool.close()
+
+    @staticmethod
+    async def _init_connection(conn: asyncpg.Connection) -> None:
+        # JSON и JSONB - словари и списки Python, как в psycopg2
+        for type_name in ('json', 'jsonb'):
+            await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика запросов и пула (для /debug)"""
+        stats = dict(self._stats)
+        if self.pool is not None:
+            stats.update(
+                size=self.pool.get_size(),
+                idle=self.pool.get_idle_size(),
+                max_size=self.pool.get_max_size()
+            )
+        else:
+            stats.update(size=0, idle=0, max_size=self.pool_max)
+        return stats
+
+    # --- Выполнение запросов ---
+
+    def _query(self, sql: str, params: Any = None) -> Tuple[str, List[Any]]:
+        """Текст запроса для asyncpg и значения параметров по порядку"""
+        template = self._statement_templates.get(sql)
+        if template is None:
+            template = Database._statement_template(sql)
+            self._statement_templates[sql] = template
+        body, names = template
+        values = [params[key] for key in names] if names else list(params or ())
+        return body, values
+
+    @asynccontextmanager
+    async def _connection(self, transaction: bool = False):
+        """Подключение из пула (с transaction=True - в транзакции)"""
+        if self.pool is None:
+            raise RuntimeError("AsyncDatabase is not open, call open() first")
+
+        stats = self._stats
+        stats['calls'] += 1
+        stats['in_flight'] += 1
+        stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+        try:
+            async with self.pool.acquire(timeout=self.pool_timeout) as conn:
+                if transaction:
+                    async with conn.transaction():
+                        yield conn
+                else:
+                    yield conn
+        except asyncio.TimeoutError:
+            stats['timeouts'] += 1
+            logger.error(f"Database error: no free connection in {self.pool_timeout} s")
+            raise
+        except Exception as e:
+            logger.error(f"Database error: {e}")
+            raise
+        finally:
+            stats['in_flight'] -= 1
+
+    async def _fetch(self, sql: str, params: Any = None) -> List[Dict[str, Any]]:
+        body, values = self._query(sql, params)
+        async with self._connection() as conn:
+            return [dict(row) for row in await conn.fetch(body, *values)]
+
+    async def _fetchrow(self, sql: str, params: Any = None) -> Optional[Dict[str, Any]]:
+        body, values = self._query(sql, params)
+        async with self._connection() as conn:
+            row = await conn.fetchrow(body, *values)
+        return dict(row) if row else None
+
+    async def _fetchval(self, sql: str, params: Any = None) -> Any:
+        body, values = self._query(sql, params)
+        async with self._connection() as conn:
+            return await conn.fetchval(body, *values)
+
+    async def _execute(self, conn: asyncpg.Connection, sql: str, params: Any = None) -> int:
+        """Выполнение запроса на подключении; число затронутых строк"""
+        body, values = self._query(sql, params)
+        return self._rowcount(await conn.execute(body, *values))
+
+    @staticmethod
+    def _rowcount(status: str) -> int:
+        # Статус команды: 'INSERT 0 5', 'UPDATE 3', 'DELETE 0'
+        count = status.rsplit(' ', 1)[-1]
+        return int(count) if count.isdigit() else 0
+
+    # --- Дневные показатели клубов (daily_club_facts) ---
+
+    async def _refresh_daily_facts(self, conn: asyncpg.Connection, file_ids: Optional[List[int]] = None,
+                                   keys: Optional[List[tuple]] = None) -> int:
+        """Пересчет дневных показателей в текущей транзакции (как Database._refresh_daily_facts)"""
+        days = {tuple(key) for key in (keys or []) if key[0] and key[1]}
+        if file_ids:
+            body, values = self._query(
+                """
+                SELECT DISTINCT club_name, report_date
+                FROM uploaded_files
+                WHERE id = ANY(%s) AND club_name IS NOT NULL AND report_date IS NOT NULL
+                """,
+                (list(file_ids),)
+            )
+            days.update(tuple(row) for row in await conn.fetch(body, *values))
+
+        for club_name, report_date in days:
+            params = {'club_name': club_name, 'report_date': report_date, 'facts_version': DAILY_FACTS_VERSION}
+            if await self._execute(conn, DAILY_FACTS_UPSERT_SQL, params) == 0:
+                await self._execute(
+                    conn,
+                    "DELETE FROM daily_club_facts WHERE club_name = %(club_name)s AND report_date = %(report_date)s",
+                    params
+                )
+        return len(days)
+
+    async def get_daily_facts_period(self, club_name: str, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+        """Дневные показатели клуба за период (по одной строке на дату отчета)"""
+        return await self._fetch(
+            f"""
+            SELECT {DAILY_FACT_COLUMNS}
+            FROM daily_club_facts
+            WHERE club_name = %s AND report_date >= %s AND report_date <= %s
+            ORDER BY report_date
+            """,
+            (club_name, start_date, end_date)
+        )
+
+    # --- Блоки отчета по файлу ---
+
+    async def _replace_block(self, table: str, file_id: int, records: List[Dict[str, Any]]) -> None:
+        """Перезапись строк блока файла (старые строки удаляются в той же транзакции)"""
+        if not records:
+            return
+
+        columns = BLOCK_COLUMNS[table]
+        placeholders = ', '.join(['%s'] * (len(columns) + 1))
+        body, _ = self._query(f"INSERT INTO {table} (file_id, {', '.join(columns)}) VALUES ({placeholders})")
+        rows = [
+            (file_id, *(rec.get(column, False) if column in BLOCK_FLAGS else rec.get(column) for column in columns))
+            for rec in records
+        ]
+        async with self._connection(transaction=True) as conn:
+            await self._execute(conn, f"DELETE FROM {table} WHERE file_id = %s", (file_id,))
+            await conn.executemany(body, rows)
+            if table in DAILY_FACTS_BLOCKS:
+                await self._refresh_daily_facts(conn, file_ids=[file_id])
+
+    async def _list_block(self, table: str, file_id: int) -> List[Dict[str, Any]]:
+        return await self._fetch(
+            f"""
+            SELECT {', '.join(BLOCK_COLUMNS[table])}, created_at
+            FROM {table}
+            WHERE file_id = %s
+            ORDER BY id
+            """,
+            (file_id,)
+        )
+
+    async def save_income_records(self, file_id: int, records: List[Dict[str, Any]]) -> None:
+        """Сохранение данных блока «Доходы»"""
+        await self._replace_block('income_records', file_id, records)
+
+    async def list_income_records(self, file_id: int) -> List[Dict[str, Any]]:
+        """Получение данных блока «Доходы» по файлу"""
+        return await self._list_block('income_records', file_id)
+
+    async def save_ticket_sales(self, file_id: int, records: List[Dict[str, Any]]) -> None:
+        """Сохранение данных блока «Входные билеты»"""
+        await self._replace_block('ticket_sales', file_id, records)
+
+    async def list_ticket_sales(self, file_id: int) -> List[Dict[str, Any]]:
+        """Получение данных блока «Входные билеты» по файлу"""
+        return await self._list_block('ticket_sales', file_id)
+
+    async def save_payment_types(self, file_id: int, records: List[Dict[str, Any]]) -> None:
+        """Сохранение данных блока «Типы оплат за смену»"""
+        await self._replace_block('payment_types', file_id, records)
+
+    async def list_payment_types(self, file_id: int) -> List[Dict[str, Any]]:
+        """Получение данных блока «Типы оплат за смену» по файлу"""
+        return await self._list_block('payment_types', file_id)
+
+    async def save_staff_statistics(self, file_id: int, records: List[Dict[str, Any]]) -> None:
+        """Сохранение данных блока «Статистика персонала»"""
+        await self._replace_block('staff_statistics', file_id, records)
+
+    async def list_staff_statistics(self, file_id: int) -> List[Dict[str, Any]]:
+        """Получение данных блока «Статистика персонала» по файлу"""
+        return await self._list_block('staff_statistics', file_id)
+
+    async def save_expense_records(self, file_id: int, records: List[Dict[str, Any]]) -> None:
+        """Сохранение данных блока «Расходы»"""
+        await self._replace_block('expense_records', file_id, records)
+
+    async def list_expense_records(self, file_id: int) -> List[Dict[str, Any]]:
+        """Получение данных блока «Расходы» по файлу"""
+        return await self._list_block('expense_records', file_id)
+
+    async def save_misc_expenses_records(self, file_id: int, records: List[Dict[str, Any]]) -> None:
+        """Сохранение данных блока «Прочие расходы»"""
+        await self._replace_block('misc_expenses_records', file_id, records)
+
+    async def list_misc_expenses_records(self, file_id: int) -> List[Dict[str, Any]]:
+        """Получение данных блока «Прочие расходы» по файлу"""
+        return await self._list_block('misc_expenses_records', file_id)
+
+    async def save_cash_collection(self, file_id: int, records: List[Dict[str, Any]]) -> None:
+        """Сохранение данных блока «Инкассация»"""
+        await self._replace_block('cash_collection', file_id, records)
+
+    async def list_cash_collection(self, file_id: int) -> List[Dict[str, Any]]:
+        """Получение данных блока «Инкассация» по файлу"""
+        return await self._list_block('cash_collection', file_id)
+
+    async def save_staff_debts(self, file_id: int, records: List[Dict[str, Any]]) -> None:
+        """Сохранение данных блока «Долги по персоналу»"""
+        await self._replace_block('staff_debts', file_id, records)
+
+    async def list_staff_debts(self, file_id: int) -> List[Dict[str, Any]]:
+        """Получение данных блока «Долги по персоналу» по файлу"""
+        return await self._list_block('staff_debts', file_id)
+
+    async def save_notes_entries(self, file_id: int, records: List[Dict[str, Any]]) -> None:
+        """Сохранение данных блока «Примечание»"""
+        await self._replace_block('notes_entries', file_id, records)
+
+    async def list_notes_entries(self, file_id: int) -> List[Dict[str, Any]]:
+        """Получение данных блока «Примечание» по файлу"""
+        return await self._list_block('notes_entries', file_id)
+
+    async def save_totals_summary(self, file_id: int, rows: List[Dict[str, Any]]) -> None:
+        """Сохранение данных блока «Итого»"""
+        await self._replace_block('totals_summary', file_id, rows)
+
+    async def list_totals_summary(self, file_id: int) -> List[Dict[str, Any]]:
+        """Получение данных блока «Итого» по файлу"""
+        return await self._list_block('totals_summary', file_id)
+
+    async def save_taxi_expenses(self, file_id: int, taxi_amount: Decimal, taxi_percent_amount: Decimal,
+                                 deposits_total: Decimal, total_amount: Decimal) -> None:
+        """Сохранение данных блока «ТАКСИ»"""
+        async with self._connection(transaction=True) as conn:
+            await self._execute(conn, "DELETE FROM taxi_expenses WHERE file_id = %s", (file_id,))
+            await self._execute(
+                conn,
+                """
+                INSERT INTO taxi_expenses (file_id, taxi_amount, taxi_percent_amount, deposits_total, total_amount)
+                VALUES (%s, %s, %s, %s, %s)
+                """,
+                (file_id, taxi_amount, taxi_percent_amount, deposits_total, total_amount)
+            )
+            await self._refresh_daily_facts(conn, file_ids=[file_id])
+
+    async def get_taxi_expenses(self, file_id: int) -> Optional[Dict[str, Any]]:
+        """Получение данных блока «ТАКСИ» по файлу"""
+        return await self._fetchrow(
+            """
+            SELECT taxi_amount, taxi_percent_amount, deposits_total, total_amount, created_at
+            FROM taxi_expenses
+            WHERE file_id = %s
+            ORDER BY id DESC
+            LIMIT 1
+            """,
+            (file_id,)
+        )
+
+    # --- Сводные данные блоков за период ---
+
+    async def _aggregate_block_period(self, block: str, club_name: str, start_date: date, end_date: date,
+                                      include_off_shift: bool = True) -> List[Dict[str, Any]]:
+        """Суммирование блока за период одним запросом (тот же запрос, что у Database)"""
+        return await self._fetch(
+            Database._block_period_sql(block, include_off_shift),
+            {'club_name': club_name, 'start_date': start_date, 'end_date': end_date}
+        )
+
+    async def get_income_period(self, club_name: str, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+        """Суммы блока «Доходы» за период по категориям"""
+        return await self._aggregate_block_period('income', club_name, start_date, end_date)
+
+    async def get_ticket_sales_period(self, club_name: str, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+        """Суммы блока «Входные билеты» за период по ценам (без итоговых строк)"""
+        return await self._aggregate_block_period('ticket_sales', club_name, start_date, end_date)
+
+    async def get_payment_types_period(self, club_name: str, start_date: date, end_date: date) -> Dict[str, Any]:
+        """Суммы блока «Типы оплат» за период; «ИТОГО КАССА» считается отдельно"""
+        records = await self._aggregate_block_period('payment_types', club_name, start_date, end_date)
+        cash_total = await self._fetchval(PAYMENT_CASH_TOTAL_SQL, (club_name, start_date, end_date))
+        return {'records': records, 'cash_total': cash_total}
+
+    async def get_staff_statistics_period(self, club_name: str, start_date: date,
+                                          end_date: date) -> List[Dict[str, Any]]:
+        """Суммы блока «Статистика персонала» за период по должностям"""
+        return await self._aggregate_block_period('staff_statistics', club_name, start_date, end_date)
+
+    async def get_expense_records_period(self, club_name: str, start_date: date, end_date: date,
+                                         include_off_shift: bool = True) -> List[Dict[str, Any]]:
+        """Суммы блока «Расходы» за период по статьям (по умолчанию вместе с расходами вне смены)"""
+        return await self._aggregate_block_period(
+            'expense_records', club_name, start_date, end_date, include_off_shift
+        )
+
+    async def get_cash_collection_period(self, club_name: str, start_date: date,
+                                         end_date: date) -> List[Dict[str, Any]]:
+        """Суммы блока «Инкассация» за период по парам (валюта, курс)"""
+        return await self._aggregate_block_period('cash_collection', club_name, start_date, end_date)
+
+    async def get_staff_debts_period(self, club_name: str, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+        """Суммы блока «Долги по персоналу» за период по типам долга"""
+        return await self._aggregate_block_period('staff_debts', club_name, start_date, end_date)
+
+    async def get_totals_summary_period(self, club_name: str, start_date: date, end_date: date,
+                                        include_off_shift: bool = True) -> List[Dict[str, Any]]:
+        """Суммы блока «Итоговый баланс» за период по типам оплаты (расходы вне смены идут в расход)"""
+        return await self._aggregate_block_period(
+            'totals_summary', club_name, start_date, end_date, include_off_shift
+        )
+
+    async def get_misc_expenses_period(self, club_name: str, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+        """Получение данных блока «Прочие расходы» за период с группировкой по статьям"""
+        return await self._fetch(
+            """
+            SELECT
+                mer.expense_item,
+                SUM(mer.amount) as total_amount
+            FROM misc_expenses_records mer
+            JOIN current_uploaded_files uf ON mer.file_id = uf.id
+            WHERE uf.club_name = %s
+            AND uf.report_date >= %s
+            AND uf.report_date <= %s
+            AND mer.is_total = FALSE
+            GROUP BY mer.expense_item
+            ORDER BY mer.expense_item
+            """,
+            (club_name, start_date, end_date)
+        )
+
+    async def get_taxi_expenses_period(self, club_name: str, start_date: date, end_date: date) -> Dict[str, Any]:
+        """Получение данных блока «ТАКСИ» за период"""
+        result = await self._fetchrow(
+            """
+            SELECT
+                COALESCE(SUM(taxi_amount), 0) as total_taxi_amount,
+                COALESCE(SUM(taxi_percent_amount), 0) as total_taxi_percent_amount,
+                COALESCE(SUM(deposits_total), 0) as total_deposits_total,
+                COALESCE(SUM(taxi_total), 0) as total_amount
+            FROM daily_club_facts
+            WHERE club_name = %s
+            AND report_date >= %s
+            AND report_date <= %s
+            """,
+            (club_name, start_date, end_date)
+        )
+        if result:
+            return result
+        return {
+            'total_taxi_amount': Decimal('0.00'),
+            'total_taxi_percent_amount': Decimal('0.00'),
+            'total_deposits_total': Decimal('0.00'),
+            'total_amount': Decimal('0.00')
+        }
+
+    # --- Загруженные файлы ---
+
+    async def get_files_by_period(self, start_date: date, end_date: date, club_name: str) -> List[Dict[str, Any]]:
+        """Файлы клуба за период: по одному (последнему загруженному) на дату отчета"""
+        return await self._fetch(
+            f"""
+            SELECT {UPLOADED_FILE_COLUMNS}
+            FROM current_uploaded_files
+            WHERE report_date >= %s AND report_date <= %s AND club_name = %s
+            ORDER BY report_date ASC
+            """,
+            (start_date, end_date, club_name)
+        )
+
+    async def get_period_version(self, club_name: str, start_date: date,
+                                 end_date: date) -> Tuple[int, Optional[datetime]]:
+        """Версия данных периода для кэша отчетов: число файлов и последняя дата загрузки"""
+        row = await self._fetchrow(
+            """
+            SELECT COUNT(*) AS count, MAX(upload_date) AS last_upload
+            FROM uploaded_files
+            WHERE report_date >= %s AND report_date <= %s AND club_name = %s
+            """,
+            (start_date, end_date, club_name)
+        )
+        return row['count'], row['last_upload']
+
+    async def get_report_dates(self, club_name: Optional[str] = None) -> List[date]:
+        if club_name and club_name != 'Оба':
+            rows = await self._fetch(
+                """
+                SELECT DISTINCT report_date
+                FROM uploaded_files
+                WHERE report_date IS NOT NULL AND club_name = %s
+                ORDER BY report_date DESC
+                """,
+                (club_name,)
+            )
+        else:
+            # Режим "Оба" - показываем все даты
+            rows = await self._fetch(
+                """
+                SELECT DISTINCT report_date
+                FROM uploaded_files
+                WHERE report_date IS NOT NULL
+                ORDER BY report_date DESC
+                """
+            )
+        return [row['report_date'] for row in rows]
+
+    async def get_file_by_report_date(self, report_date: date,
+                                      club_name: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        if club_name and club_name != 'Оба':
+            return await self._fetchrow(
+                f"""
+                SELECT {UPLOADED_FILE_COLUMNS}
+                FROM current_uploaded_files
+                WHERE report_date = %s AND club_name = %s
+                """,
+                (report_date, club_name)
+            )
+        # Режим "Оба" - берем последний файл за дату (любой клуб)
+        return await self._fetchrow(
+            f"""
+            SELECT {UPLOADED_FILE_COLUMNS}
+            FROM uploaded_files
+            WHERE report_date = %s
+            ORDER BY upload_date DESC
+            LIMIT 1
+            """,
+            (report_date,)
+        )
+
+    async def set_uploaded_file_report_date(self, file_id: int, report_date: date) -> None:
+        async with self._connection(transaction=True) as conn:
+            # Дневные показатели пересчитываются и для прежней даты файла
+            body, values = self._query("SELECT club_name, report_date FROM uploaded_files WHERE id = %s", (file_id,))
+            previous = await conn.fetchrow(body, *values)
+            await self._execute(
+                conn,
+                """
+                UPDATE uploaded_files
+                SET report_date = %s
+                WHERE id = %s
+                """,
+                (report_date, file_id)
+            )
+            keys = [(previous['club_name'], previous['report_date'])] if previous else []
+            await self._refresh_daily_facts(conn, file_ids=[file_id], keys=keys)
+
+    async def get_file_content(self, file_id: int) -> Optional[bytes]:
+        """Содержимое загруженного файла из file_blobs (читается только по запросу)"""
+        row = await self._fetchrow(
+            """
+            SELECT b.codec, b.content
+            FROM uploaded_files uf
+            JOIN file_blobs b ON b.file_hash = uf.file_hash
+            WHERE uf.id = %s
+            """,
+            (file_id,)
+        )
+        if not row:
+            return None
+        return Database._decompress_blob(row['codec'], bytes(row['content']))
+
+    async def get_cached_blocks(self, file_hash: str, parser_version: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Блоки из кэша разбора для содержимого файла и версии парсера"""
+        if not file_hash or not parser_version:
+            return None
+
+        text = await self._fetchval(
+            "SELECT blocks::text FROM parse_cache WHERE file_hash = %s AND parser_version = %s",
+            (file_hash, parser_version)
+        )
+        if text is None:
+            return None
+        try:
+            return Database._load_blocks(text)
+        except Exception as e:
+            logger.warning(f"Broken parse cache entry for hash {file_hash}: {e}")
+            return None
+
+    async def list_recent_files(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """Список последних загруженных файлов"""
+        return await self._fetch(
+            """
+            SELECT id, file_name, upload_date, row_count, report_date
+            FROM uploaded_files
+            ORDER BY upload_date DESC
+            LIMIT %s
+            """,
+            (limit,)
+        )
+
+    async def get_latest_file(self) -> Optional[Dict[str, Any]]:
+        """Последний загруженный файл"""
+        return await self._fetchrow(
+            """
+            SELECT id, file_name, upload_date, row_count, report_date
+            FROM uploaded_files
+            ORDER BY upload_date DESC
+            LIMIT 1
+            """
+        )
+
+    async def get_user_files(self, user_id: int) -> List[Dict[str, Any]]:
+        """Получение списка файлов пользователя"""
+        return await self._fetch(
+            """
+            SELECT id, file_name, upload_date, row_count
+            FROM uploaded_files
+            WHERE user_id = %s
+            ORDER BY upload_date DESC
+            """,
+            (user_id,)
+        )
+
+    async def get_latest_user_file(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Последний загруженный файл пользователя"""
+        return await self._fetchrow(
+            """
+            SELECT id, file_name, row_count, report_date, club_name
+            FROM uploaded_files
+            WHERE user_id = %s
+            ORDER BY upload_date DESC
+            LIMIT 1
+            """,
+            (user_id,)
+        )
+
+    async def clear_uploaded_files(self) -> int:
+        """Полная очистка загруженных файлов и связанных данных"""
+        async with self._connection(transaction=True) as conn:
+            # Удаляем файлы (связанные данные удалятся через CASCADE)
+            deleted_files = await self._execute(conn, "DELETE FROM uploaded_files")
+            await self._execute(conn, "DELETE FROM daily_club_facts")
+            await self._execute(conn, "DELETE FROM file_blobs")
+
+            # Удаляем расходы вне смены
+            deleted_expenses = await self._execute(conn, "DELETE FROM off_shift_expenses")
+
+        logger.info(f"Cleared {deleted_files} files and {deleted_expenses} off-shift expenses")
+        return deleted_files
+
+    # --- Запросы к Excel данным ---
+
+    async def count_sheet_rows(self) -> int:
+        """Количество строк исходных листов (по row_count файлов, без чтения sheet_rows)"""
+        return await self._fetchval("SELECT COALESCE(SUM(row_count), 0) FROM uploaded_files")
+
+    async def get_file_preview(self, file_id: int, limit: int = 10) -> List[Dict[str, Any]]:
+        """Предпросмотр первых строк файла (читаются только limit строк по первичному ключу)"""
+        rows = await self._fetch(
+            """
+            SELECT row_number, data
+            FROM sheet_rows
+            WHERE file_id = %s
+            ORDER BY row_number
+            LIMIT %s
+            """,
+            (file_id, limit)
+        )
+        return [{'row_number': row['row_number'], 'data': Database._sheet_row_data(row['data'])} for row in rows]
+
+    async def search_excel_by_column(self, column_name: str, search_value: str,
+                                     limit: int = 10) -> List[Dict[str, Any]]:
+        """Поиск строк, в которых значение колонки содержит search_value (как Database.search_excel_by_column)"""
+        value_sql = "data->>%(column_name)s"
+        rank_sql = f"word_similarity(%(value)s, {value_sql})" if self.trigram_search else "0"
+        # В JSON тексте строки кавычки и обратная косая черта экранированы - такой текст индекс не найдет
+        prefilter_sql = (
+            "AND data::text ILIKE %(pattern)s"
+            if self.trigram_search and search_value.isprintable() and not set('"\\') & set(search_value)
+            else ""
+        )
+        rows = await self._fetch(
+            f"""
+            SELECT m.file_id, m.row_number, m.data, u.file_name
+            FROM (
+                SELECT file_id, row_number, data, {rank_sql} AS rank
+                FROM sheet_rows
+                WHERE data ? %(column_name)s
+                AND {value_sql} ILIKE %(pattern)s
+                {prefilter_sql}
+                ORDER BY rank DESC, file_id DESC, row_number
+                LIMIT %(limit)s
+            ) m
+            JOIN uploaded_files u ON u.id = m.file_id
+            ORDER BY m.rank DESC, u.upload_date DESC, m.row_number
+            """,
+            {
+                'column_name': column_name,
+                'value': search_value,
+                'pattern': Database._like_pattern(search_value),
+                'limit': limit
+            }
+        )
+        return [
+            {
+                'file_name': row['file_name'],
+                'row_number': row['row_number'],
+                'data': Database._sheet_row_data(row['data'])
+            }
+            for row in rows
+        ]
+
+    async def get_database_schema(self) -> str:
+        """Получение схемы базы данных для контекста DeepSeek"""
+        columns = await self._fetch(
+            """
+            SELECT
+                table_name,
+                column_name,
+                data_type,
+                is_nullable
+            FROM information_schema.columns
+            WHERE table_schema = 'public'
+            AND table_name <> 'excel_data_legacy'
+            ORDER BY table_name, ordinal_position
+            """
+        )
+
+        schema_description = "Database Schema:\n\n"
+        current_table = None
+
+        for col in columns:
+            if col['table_name'] != current_table:
+                current_table = col['table_name']
+                schema_description += f"\nTable: {current_table}\n"
+
+            nullable = "NULL" if col['is_nullable'] == 'YES' else "NOT NULL"
+            schema_description += f"  - {col['column_name']}: {col['data_type']} ({nullable})\n"
+
+        return schema_description
+
+    # --- Работа с сотрудниками ---
+
+    async def save_employees(self, employees: List[Dict[str, str]]) -> Dict[str, int]:
+        """Массовое добавление/обновление сотрудников"""
+        if not employees:
+            return {"inserted": 0, "updated": 0}
+
+        inserted = 0
+        updated = 0
+        body, _ = self._query(
+            """
+            INSERT INTO employees (employee_code, full_name)
+            VALUES (%s, %s)
+            ON CONFLICT (employee_code) DO UPDATE
+            SET full_name = EXCLUDED.full_name,
+                created_at = CURRENT_TIMESTAMP
+            RETURNING (xmax = 0) AS inserted
+            """
+        )
+        async with self._connection(transaction=True) as conn:
+            for employee in employees:
+                code = employee.get('employee_code')
+                name = employee.get('full_name')
+
+                if not code or not name:
+                    continue
+
+                if await conn.fetchval(body, code, name):
+                    inserted += 1
+                else:
+                    updated += 1
+
+        return {"inserted": inserted, "updated": updated}
+
+    async def add_employee(self, employee_code: str, full_name: str):
+        """Добавление одного сотрудника"""
+        async with self._connection() as conn:
+            await self._execute(
+                conn,
+                """
+                INSERT INTO employees (employee_code, full_name)
+                VALUES (%s, %s)
+                ON CONFLICT (employee_code) DO UPDATE
+                SET full_name = EXCLUDED.full_name,
+                    created_at = CURRENT_TIMESTAMP
+                """,
+                (employee_code, full_name)
+            )
+
+    async def delete_employee(self, employee_code: str) -> int:
+        """Удаление сотрудника по коду"""
+        async with self._connection() as conn:
+            return await self._execute(conn, "DELETE FROM employees WHERE employee_code = %s", (employee_code,))
+
+    async def clear_employees(self) -> int:
+        """Полная очистка таблицы сотрудников"""
+        async with self._connection() as conn:
+            return await self._execute(conn, "DELETE FROM employees")
+
+    async def get_employee(self, employee_code: str) -> Optional[Dict[str, Any]]:
+        """Получение одного сотрудника по коду"""
+        return await self._fetchrow(
+            """
+            SELECT employee_code, full_name, created_at
+            FROM employees
+            WHERE employee_code = %s
+            """,
+            (employee_code,)
+        )
+
+    async def list_employees(self, limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+        """Получение списка сотрудников"""
+        return await self._fetch(
+            """
+            SELECT employee_code, full_name, created_at
+            FROM employees
+            ORDER BY employee_code
+            LIMIT %s OFFSET %s
+            """,
+            (limit, offset)
+        )
+
+    async def count_employees(self) -> int:
+        """Подсчет сотрудников"""
+        return await self._fetchval("SELECT COUNT(*) FROM employees")
+
+    async def search_employees(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Поиск сотрудников по части ФИО или кода (с pg_trgm - и с опечатками, по похожести)"""
+        query = query.strip()
+        if not query:
+            return []
+
+        if self.trigram_search:
+            match_sql = "OR %(query)s <%% full_name"
+            rank_sql = "GREATEST(word_similarity(%(query)s, full_name), similarity(employee_code, %(query)s)) DESC,"
+        else:
+            match_sql = ""
+            rank_sql = ""
+
+        return await self._fetch(
+            f"""
+            SELECT employee_code, full_name, created_at
+            FROM employees
+            WHERE full_name ILIKE %(pattern)s
+            OR employee_code ILIKE %(pattern)s
+            {match_sql}
+            ORDER BY UPPER(employee_code) = UPPER(%(query)s) DESC, {rank_sql} full_name
+            LIMIT %(limit)s
+            """,
+            {'query': query, 'pattern': Database._like_pattern(query), 'limit': limit}
+        )
+
+    # --- Очередь задач разбора ---
+
+    async def enqueue_job(self, kind: str, user_id: int, payload: Optional[Dict[str, Any]] = None,
+                          file_content: Optional[bytes] = None, chat_id: Optional[int] = None,
+                          message_id: Optional[int] = None) -> int:
+        """Постановка задачи в очередь (upload - разбор загруженного файла, reprocess - переобработка)"""
+        job_id = await self._fetchval(
+            """
+            INSERT INTO ingest_jobs (kind, user_id, chat_id, message_id, payload, file_content)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING id
+            """,
+            (kind, user_id, chat_id, message_id, payload or {},
+             bytes(file_content) if file_content is not None else None)
+        )
+        logger.info(f"Job {job_id} ({kind}) queued for user {user_id}")
+        return job_id
+
+    async def get_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Состояние задачи для показа прогресса"""
+        return await self._fetchrow(f"SELECT {INGEST_JOB_COLUMNS} FROM ingest_jobs WHERE id = %s", (job_id,))
+
+    async def get_active_job(self, kind: str, user_id: int) -> Optional[Dict[str, Any]]:
+        """Незавершенная задача пользователя этого вида (чтобы не ставить переобработку дважды)"""
+        return await self._fetchrow(
+            f"""
+            SELECT {INGEST_JOB_COLUMNS}
+            FROM ingest_jobs
+            WHERE kind = %s AND user_id = %s AND status IN ('queued', 'running')
+            ORDER BY id
+            LIMIT 1
+            """,
+            (kind, user_id)
+        )
+
+    async def get_unnotified_jobs(self) -> List[Dict[str, Any]]:
+        """Задачи, о результате которых пользователю еще не сообщили: завершенные и выполняемые с прогрессом"""
+        return await self._fetch(
+            f"""
+            SELECT {INGEST_JOB_COLUMNS}
+            FROM ingest_jobs
+            WHERE notified_at IS NULL AND chat_id IS NOT NULL
+            AND (status IN ('done', 'error') OR (status = 'running' AND progress IS NOT NULL))
+            ORDER BY id
+            """
+        )
+
+    async def mark_job_notified(self, job_id: int):
+        async with self._connection() as conn:
+            await self._execute(conn, "UPDATE ingest_jobs SET notified_at = CURRENT_TIMESTAMP WHERE id = %s", (job_id,))
+
+    # --- Работа с расходами вне смены ---
+
+    async def add_off_shift_expense(self, user_id: int, username: str, club_name: str,
+                                    expense_item: str, amount: Decimal, payment_type: str,
+                                    expense_date: Optional[date] = None) -> int:
+        """Добавление расхода вне смены"""
+        if expense_date is None:
+            expense_date = date.today()
+
+        expense_id = await self._fetchval(
+            """
+            INSERT INTO off_shift_expenses (user_id, username, club_name, expense_item, amount, payment_type, expense_date)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+            """,
+            (user_id, username, club_name, expense_item, amount, payment_type, expense_date)
+        )
+        logger.info(f"Off-shift expense added: ID={expense_id}, Club={club_name}, Item={expense_item}, Amount={amount}, Type={payment_type}")
+        return expense_id
+
+    async def get_off_shift_expenses(self, club_name: str, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+        """Получение расходов вне смены за период по клубу"""
+        return await self._fetch(
+            """
+            SELECT id, expense_item, amount, payment_type, expense_date, created_at
+            FROM off_shift_expenses
+            WHERE club_name = %s AND expense_date >= %s AND expense_date <= %s
+            ORDER BY expense_date ASC, created_at ASC
+            """,
+            (club_name, start_date, end_date)
+        )
+
+    async def get_off_shift_expense_by_id(self, expense_id: int) -> Optional[Dict[str, Any]]:
+        """Получение расхода вне смены по ID"""
+        return await self._fetchrow(
+            """
+            SELECT id, user_id, username, club_name, expense_item, amount, payment_type, expense_date, created_at
+            FROM off_shift_expenses
+            WHERE id = %s
+            """,
+            (expense_id,)
+        )
+
+    async def update_off_shift_expense(self, expense_id: int, expense_item: str = None,
+                                       amount: Decimal = None, payment_type: str = None,
+                                       expense_date: date = None) -> bool:
+        """Обновление расхода вне смены"""
+        updates = []
+        params = []
+
+        if expense_item is not None:
+            updates.append("expense_item = %s")
+            params.append(expense_item)
+
+        if amount is not None:
+            updates.append("amount = %s")
+            params.append(amount)
+
+        if payment_type is not None:
+            updates.append("payment_type = %s")
+            params.append(payment_type)
+
+        if expense_date is not None:
+            updates.append("expense_date = %s")
+            params.append(expense_date)
+
+        if not updates:
+            return False
+
+        params.append(expense_id)
+
+        async with self._connection() as conn:
+            updated = await self._execute(
+                conn,
+                f"""
+                UPDATE off_shift_expenses
+                SET {', '.join(updates)}
+                WHERE id = %s
+                """,
+                params
+            )
+        if updated:
+            logger.info(f"Off-shift expense updated: ID={expense_id}")
+        return updated > 0
+
+    async def delete_off_shift_expense(self, expense_id: int) -> bool:
+        """Удаление расхода вне смены"""
+        async with self._connection() as conn:
+            deleted = await self._execute(conn, "DELETE FROM off_shift_expenses WHERE id = %s", (expense_id,))
+        if deleted:
+            logger.info(f"Off-shift expense deleted: ID={expense_id}")
+        return deleted > 0
@@ -0,0 +1,136 @@
+"""
+Замеры разбора Excel отчета
+
+    python benchmark.py loader [--file 01.11.xlsx] [--runs 20]
+    python benchmark.py extractors [--file 01.11.xlsx] [--runs 200] [--source DIR]
+
+loader - загрузчики листа EXCEL_SHEET_LOADER (pandas и stream): время загрузки листа вместе с текстовым
+листом (dtype=str), время загрузки с extract_all_blocks и пик памяти Python (tracemalloc) на один файл.
+
+extractors - время каждого экстрактора и extract_all_blocks на уже загруженном листе (общие представления
+листа построены заранее). --source берет excel_processor.py из другой копии репозитория, например
+версию до перехода с df.iloc на список строк:
+
+    git worktree add ../before 29d4f52~1
+    python benchmark.py extractors --source ../before
+"""
+import argparse
+import importlib
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from typing import Callable, Tuple
+
+LOADERS = ('pandas', 'stream')
+
+EXTRACTORS = (
+    'extract_income_records',
+    'extract_ticket_sales',
+    'extract_payment_types',
+    'extract_staff_statistics',
+    'extract_expense_records',
+    'extract_cash_collection',
+    'extract_staff_debts',
+    'extract_notes_entries',
+    'extract_misc_expenses_from_notes_after_total',
+    'extract_totals_summary',
+    'extract_taxi_expenses',
+)
+
+# Ленивые представления ParsedWorkbook, общие для экстракторов (в старых версиях есть не все)
+SHARED_VIEWS = ('text_sheet', 'anchors', 'cells', 'text_cells')
+
+
+def measure(func: Callable[[], object], runs: int) -> Tuple[float, float]:
+    """Среднее время вызова (мс) и пик памяти Python за один вызов (КиБ)"""
+    func()  # прогрев: импорты openpyxl/pandas и кэши процесса не входят в замер
+    started = time.perf_counter()
+    for _ in range(runs):
+        func()
+    elapsed = (time.perf_counter() - started) / runs
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed * 1000, peak / 1024
+
+
+def bench_loader(excel_processor, file_content: bytes, runs: int):
+    """Загрузчики листа: только загрузка и загрузка с разбором всех блоков"""
+    ParsedWorkbook = excel_processor.ParsedWorkbook
+    processor = excel_processor.ExcelProcessor()
+
+    reference = None
+    for loader in LOADERS:
+        workbook = ParsedWorkbook(file_content, loader)
+        if workbook.error is not None:
+            raise SystemExit(f"{loader}: {workbook.error}")
+        blocks = processor.extract_all_blocks(workbook)
+        if reference is None:
+            reference = blocks
+            print(f"Лист: {workbook.sheet.shape[0]} x {workbook.sheet.shape[1]}")
+        elif blocks != reference:
+            print(f"! {loader}: блоки отличаются от {LOADERS[0]}")
+
+    print(f"{'загрузчик':10s} {'лист+текст, мс':>15s} {'пик, КиБ':>10s} {'лист+блоки, мс':>15s} {'пик, КиБ':>10s}")
+    for loader in LOADERS:
+        load_ms, load_peak = measure(lambda: ParsedWorkbook(file_content, loader).text_sheet, runs)
+        full_ms, full_peak = measure(
+            lambda: processor.extract_all_blocks(ParsedWorkbook(file_content, loader)), runs
+        )
+        print(f"{loader:10s} {load_ms:15.1f} {load_peak:10.0f} {full_ms:15.1f} {full_peak:10.0f}")
+
+
+def bench_extractors(excel_processor, file_content: bytes, runs: int):
+    """Экстракторы блоков по отдельности на одном загруженном листе"""
+    processor = excel_processor.ExcelProcessor()
+    workbook = excel_processor.ParsedWorkbook(file_content)
+    if workbook.error is not None:
+        raise SystemExit(str(workbook.error))
+    for view in SHARED_VIEWS:
+        if hasattr(type(workbook), view):
+            getattr(workbook, view)
+
+    print(f"{excel_processor.__file__}")
+    print(f"{'экстрактор':46s} {'мс':>8s}")
+    for name in EXTRACTORS:
+        extractor = getattr(processor, name, None)
+        if extractor is None:
+            continue
+        elapsed, _ = measure(lambda: extractor(workbook), runs)
+        print(f"{name:46s} {elapsed:8.2f}")
+
+    elapsed, _ = measure(lambda: processor.extract_all_blocks(workbook), runs)
+    print(f"{'extract_all_blocks':46s} {elapsed:8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры разбора Excel отчета")
+    parser.add_argument('mode', choices=['loader', 'extractors'])
+    parser.add_argument('--file', default='01.11.xlsx', help="Excel отчет (по умолчанию 01.11.xlsx)")
+    parser.add_argument('--runs', type=int, help="Повторов на замер (loader - 20, extractors - 200)")
+    parser.add_argument('--source', help="Каталог с другой версией excel_processor.py")
+    args = parser.parse_args()
+
+    if args.source:
+        sys.path.insert(0, os.path.abspath(args.source))
+    excel_processor = importlib.import_module('excel_processor')
+
+    # Экстракторы пишут каждую найденную строку в INFO - это не должно попадать в замер
+    logging.disable(logging.CRITICAL)
+    with open(args.file, 'rb') as f:
+        file_content = f.read()
+
+    if args.mode == 'loader':
+        bench_loader(excel_processor, file_content, args.runs or 20)
+    else:
+        bench_extractors(excel_processor, file_content, args.runs or 200)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 Telegram бот для работы с Excel файлами и PostgreSQL через DeepSeek API
 """
 import os
+import asyncio
 import logging
 from typing import Optional, Dict, Any, Set, List
 from dotenv import load_dotenv
@@ -23,13 +24,20 @@ from telegram.ext import (
 )
 
 from database import Database
+from async_database import AsyncDatabase
 from excel_processor import ExcelProcessor
+from executors import WorkerPools
+from reprocessing import ReprocessEngine, ReprocessAlreadyRunningError
+from bulk_upload import BulkUploadEngine, ArchiveError
+from ingest import ingest_report, result_from_job
+from webhook import ChatOrderedUpdateProcessor, serve_webhook
+from report_cache import PeriodReportCache
+import executors
 from employee_parser import EmployeeParser
 from simple_query_parser import SimpleQueryParser
-from psycopg2.extras import RealDictCursor
 import re
 import io
-from decimal import Decimal, InvalidOperation
+from decimal import Decimal
 from datetime import datetime, date
 import pandas as pd
 
@@ -96,15 +104,60 @@ db = Database(
     port=int(os.getenv('DB_PORT', 5432)),
     database=os.getenv('DB_NAME', 'excel_bot'),
     user=os.getenv('DB_USER', 'postgres'),
-    password=os.getenv('DB_PASSWORD', 'postgres')
+    password=os.getenv('DB_PASSWORD', 'postgres'),
+    pool_min=int(os.getenv('DB_POOL_MIN', 1)),
+    pool_max=int(os.getenv('DB_POOL_MAX', 10)),
+    pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+    pool_max_idle=float(os.getenv('DB_POOL_MAX_IDLE', 300)),
+    prepared_statements=os.getenv('DB_PREPARED_STATEMENTS', '1') != '0'
 )
 
 excel_processor = ExcelProcessor()
 query_parser = SimpleQueryParser()
 employee_parser = EmployeeParser()
 
+# Разбор Excel - в пуле процессов, запросы движков к БД и выгрузки - в пуле потоков
+pools = WorkerPools(
+    process_workers=int(os.getenv('WORKER_PROCESSES', 0)) or None,
+    thread_workers=int(os.getenv('WORKER_THREADS', os.getenv('DB_POOL_MAX', 10))),
+    process_queue_depth=int(os.getenv('WORKER_PROCESS_QUEUE', 16)),
+    thread_queue_depth=int(os.getenv('WORKER_THREAD_QUEUE', 64))
+)
+# Запросы к БД из обработчиков: asyncpg со своим пулом подключений (открывается в post_init)
+adb = AsyncDatabase(
+    host=os.getenv('DB_HOST', 'localhost'),
+    port=int(os.getenv('DB_PORT', 5432)),
+    database=os.getenv('DB_NAME', 'excel_bot'),
+    user=os.getenv('DB_USER', 'postgres'),
+    password=os.getenv('DB_PASSWORD', 'postgres'),
+    pool_min=int(os.getenv('ASYNC_DB_POOL_MIN', 1)),
+    pool_max=int(os.getenv('ASYNC_DB_POOL_MAX', os.getenv('DB_POOL_MAX', 10))),
+    pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+    pool_max_idle=float(os.getenv('DB_POOL_MAX_IDLE', 300)),
+    prepared_statements=os.getenv('DB_PREPARED_STATEMENTS', '1') != '0'
+)
+
+# Переобработка всех файлов: параллельно, с продолжением после сбоя
+reprocess_engine = ReprocessEngine(
+    db,
+    pools,
+    workers=int(os.getenv('REPROCESS_WORKERS', 0)) or None,
+    batch_size=int(os.getenv('REPROCESS_BATCH_SIZE', 20))
+)
+
+# Готовые сводные отчеты за период (строки и xlsx)
+period_report_cache = PeriodReportCache(
+    max_entries=int(os.getenv('PERIOD_REPORT_CACHE_SIZE', 64)),
+    ttl=float(os.getenv('PERIOD_REPORT_CACHE_TTL', 900))
+)
+
+# Разбор загруженных файлов: inline - в процессе бота, queue - воркерами worker.py через таблицу ingest_jobs
+INGEST_MODE = os.getenv('INGEST_MODE', 'inline').lower()
+INGEST_POLL_INTERVAL = float(os.getenv('INGEST_POLL_INTERVAL', 1))
+
 # Константы
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50 MB
+MAX_ERRORS_IN_SUMMARY = 20
 BUTTON_FILES = "📁 Файлы"
 BUTTON_QUERIES = "📊 Запросы"
 BUTTON_REPORTS = "📈 Сформировать отчет"
@@ -155,6 +208,7 @@ def get_files_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("📄 Список файлов", callback_data="files_list")],
         [InlineKeyboardButton("📅 Даты отчётов по клубу", callback_data="files_dates_by_club")],
         [InlineKeyboardButton("🔄 Обновить все файлы", callback_data="files_reprocess_all")],
+        [InlineKeyboardButton("♻️ Пересохранить все файлы", callback_data="files_reprocess_all_force")],
         [InlineKeyboardButton("🧼 Очистить все файлы", callback_data="files_clear")],
         [InlineKeyboardButton("⬅️ Главное меню", callback_data="main_menu")]
     ]
@@ -320,6 +374,17 @@ def format_report_date(d: date) -> str:
     return d.strftime("%d.%m.%Y")
 
 
+# Загрузка архива отчетов: дата каждого отчета - из имени файла
+bulk_upload_engine = BulkUploadEngine(
+    db,
+    pools,
+    parse_date=parse_report_date_from_text,
+    batch_size=int(os.getenv('BULK_UPLOAD_BATCH_SIZE', 10)),
+    max_files=int(os.getenv('BULK_UPLOAD_MAX_FILES', 100)),
+    max_member_size=MAX_FILE_SIZE
+)
+
+
 def parse_expenses_from_text(text: str) -> List[tuple[str, Decimal]]:
     """Парсинг расходов из текста
     Поддерживает:
@@ -487,43 +552,76 @@ async def send_employees_menu_message(target_message):
     )
 
 
+async def cached_period_report(block_id: str, generate, club_name: str, start_date: date, end_date: date):
+    """Результат generate(club_name, start_date, end_date) из кэша, если данные периода не менялись"""
+    key = (club_name, block_id, start_date, end_date)
+    version = await adb.get_period_version(club_name, start_date, end_date)
+    entry = period_report_cache.get(key, version)
+    if entry is None:
+        entry = period_report_cache.put(key, version, await generate(club_name, start_date, end_date))
+    return entry['result']
+
+
+async def cached_period_excel(block_id: str, club_name: str, start_date: date, end_date: date, result, export, *args):
+    """Выгрузка xlsx для результата cached_period_report; повторно не формируется"""
+    entry = period_report_cache.find((club_name, block_id, start_date, end_date), result)
+    if entry is not None and entry['excel'] is not None:
+        return entry['excel']
+    excel_bytes = await pools.run_blocking(export, *args)
+    if entry is not None:
+        entry['excel'] = excel_bytes
+    return excel_bytes
+
+
 async def generate_full_period_report(club_name: str, start_date: date, end_date: date):
     """Генерация ПОЛНОГО комплексного отчета за период со всеми блоками"""
     
+    # Блоки независимы - запросы к БД выполняются параллельно в пуле потоков
+    (
+        income_data,
+        tickets_result,
+        payments_result,
+        expenses_result,
+        cash_result,
+        debts_result,
+        totals_result,
+    ) = await asyncio.gather(
+        generate_income_period_report(club_name, start_date, end_date),
+        generate_tickets_period_report(club_name, start_date, end_date),
+        generate_payment_types_period_report(club_name, start_date, end_date),
+        generate_expenses_period_report(club_name, start_date, end_date),
+        generate_cash_collection_period_report(club_name, start_date, end_date),
+        generate_staff_debts_period_report(club_name, start_date, end_date),
+        generate_totals_summary_period_report(club_name, start_date, end_date),
+    )
+    
     all_blocks = {}
     
     # 1. Доходы
-    income_data = await generate_income_period_report(club_name, start_date, end_date)
     if income_data:
         all_blocks['Доходы'] = income_data
     
     # 2. Входные билеты
-    tickets_result = await generate_tickets_period_report(club_name, start_date, end_date)
     if tickets_result:
         all_blocks['Входные билеты'] = tickets_result[0]  # tickets_result = (data, total_qty, total_amt)
     
     # 3. Типы оплат
-    payments_result = await generate_payment_types_period_report(club_name, start_date, end_date)
     if payments_result:
         all_blocks['Типы оплат'] = payments_result[0]  # payments_result = (data, total_amt)
     
     # 4. Расходы
-    expenses_result = await generate_expenses_period_report(club_name, start_date, end_date)
     if expenses_result:
         all_blocks['Расходы'] = expenses_result[0]
     
     # 5. Инкассация
-    cash_result = await generate_cash_collection_period_report(club_name, start_date, end_date)
     if cash_result:
         all_blocks['Инкассация'] = cash_result[0]
     
     # 6. Долги по персоналу
-    debts_result = await generate_staff_debts_period_report(club_name, start_date, end_date)
     if debts_result:
         all_blocks['Долги по персоналу'] = debts_result[0]
     
     # 7. Итоговый баланс
-    totals_result = await generate_totals_summary_period_report(club_name, start_date, end_date)
     if totals_result:
         all_blocks['Итоговый баланс'] = totals_result[0]  # Берем только display_rows
     
@@ -532,91 +630,29 @@ async def generate_full_period_report(club_name: str, start_date: date, end_date
 
 async def generate_totals_summary_period_report(club_name: str, start_date: date, end_date: date):
     """Генерация сводного отчета по итоговому балансу за период"""
-    from collections import defaultdict
-    
-    # Получаем все файлы за период
-    files = db.get_files_by_period(start_date, end_date, club_name)
+    # Файлы периода и суммы читаются одновременно. Суммы по типам оплат считаются в БД (вместе с прочими расходами вне смены)
+    files, records = await asyncio.gather(
+        adb.get_files_by_period(start_date, end_date, club_name),
+        adb.get_totals_summary_period(club_name, start_date, end_date)
+    )
     
     if not files:
         return None
     
-    # Словарь для суммирования: {payment_type: {'income': sum, 'expense': sum, 'profit': sum}}
-    totals_summary = defaultdict(lambda: {'income': Decimal('0'), 'expense': Decimal('0'), 'profit': Decimal('0')})
-    # Список для сохранения порядка типов оплат
-    payment_order = []
-    
-    # ШАГ 1: Собираем ВСЕ уникальные типы оплат из ВСЕХ файлов периода
-    all_payments_by_file = []
-    
-    for file_info in files:
-        file_id = file_info['id']
-        records = db.list_totals_summary(file_id)
-        
-        file_payments = []
-        for rec in records:
-            payment_type = rec.get('payment_type')
-            
-            # ПРОПУСКАЕМ строку "Итого" - это не тип оплаты, а итоговая строка!
-            if payment_type and 'итого' in payment_type.lower():
-                continue
-            
-            income_amount = rec.get('income_amount') or Decimal('0')
-            expense_amount = rec.get('expense_amount') or Decimal('0')
-            net_profit = rec.get('net_profit') or Decimal('0')
-            
-            # Суммируем
-            totals_summary[payment_type]['income'] += income_amount
-            totals_summary[payment_type]['expense'] += expense_amount
-            totals_summary[payment_type]['profit'] += net_profit
-            
-            # Запоминаем порядок для этого файла
-            if payment_type not in file_payments:
-                file_payments.append(payment_type)
-        
-        all_payments_by_file.append(file_payments)
-    
-    # ШАГ 2: Добавляем ПРОЧИЕ РАСХОДЫ (расходы вне смены) за этот период
-    off_shift_expenses = db.get_off_shift_expenses(club_name, start_date, end_date)
-    
-    if off_shift_expenses:
-        off_shift_payments = []
-        for exp in off_shift_expenses:
-            payment_type = exp.get('payment_type', 'Наличные')
-            amount = Decimal(str(exp.get('amount', 0)))
-            
-            # Добавляем к расходам для соответствующего типа оплаты
-            totals_summary[payment_type]['expense'] += amount
-            
-            # Запоминаем порядок
-            if payment_type not in off_shift_payments:
-                off_shift_payments.append(payment_type)
-        
-        all_payments_by_file.append(off_shift_payments)
-    
-    # ШАГ 3: Выбираем порядок из файла с максимумом типов оплат
-    if all_payments_by_file:
-        payment_order = max(all_payments_by_file, key=len)
-    
-    # ШАГ 4: Добавляем типы, которые есть в других файлах, но нет в payment_order
-    for file_payments in all_payments_by_file:
-        for payment in file_payments:
-            if payment not in payment_order:
-                payment_order.append(payment)
-    
-    # ШАГ 5: ПЕРЕСЧИТЫВАЕМ прибыль для ВСЕХ типов оплаты (чтобы учесть прочие расходы)
-    for payment_type in totals_summary:
-        totals_summary[payment_type]['profit'] = totals_summary[payment_type]['income'] - totals_summary[payment_type]['expense']
-    
-    # ШАГ 6: Формируем список для вывода
+    # Словарь: {payment_type: {'income': sum, 'expense': sum, 'profit': sum}}
+    totals_summary = {}
     display_rows = []
     total_income = Decimal('0')
     total_expense = Decimal('0')
     total_profit = Decimal('0')
     
-    for payment_type in payment_order:
-        income = totals_summary[payment_type]['income']
-        expense = totals_summary[payment_type]['expense']
-        profit = totals_summary[payment_type]['profit']
+    for rec in records:
+        payment_type = rec['payment_type']
+        income = rec['income_amount']
+        expense = rec['expense_amount']
+        # Прибыль пересчитываем, чтобы учесть прочие расходы
+        profit = income - expense
+        totals_summary[payment_type] = {'income': income, 'expense': expense, 'profit': profit}
         
         display_rows.append({
             'Тип оплаты': payment_type,
@@ -643,65 +679,24 @@ async def generate_totals_summary_period_report(club_name: str, start_date: date
 
 async def generate_staff_debts_period_report(club_name: str, start_date: date, end_date: date):
     """Генерация сводного отчета по долгам персонала за период"""
-    from collections import defaultdict
-    
-    # Получаем все файлы за период
-    files = db.get_files_by_period(start_date, end_date, club_name)
+    # Файлы периода и суммы читаются одновременно. Суммы по типам долгов считаются в БД, итоговые строки файлов не учитываются
+    files, records = await asyncio.gather(
+        adb.get_files_by_period(start_date, end_date, club_name),
+        adb.get_staff_debts_period(club_name, start_date, end_date)
+    )
     
     if not files:
         return None
     
-    # Словарь для суммирования: {debt_type: sum}
-    debt_summary = defaultdict(Decimal)
-    # Список для сохранения порядка типов долгов (берем из файла с максимумом типов)
-    debt_order = []
-    
-    # ШАГ 1: Собираем ВСЕ уникальные типы долгов из ВСЕХ файлов периода
-    all_debts_by_file = []
-    
-    for file_info in files:
-        file_id = file_info['id']
-        records = db.list_staff_debts(file_id)
-        
-        file_debts = []
-        for rec in records:
-            debt_type = rec.get('debt_type')
-            amount = rec.get('amount') or Decimal('0')
-            is_total = rec.get('is_total', False)
-            
-            if is_total:
-                # Это итоговая строка - пропускаем, посчитаем сами
-                continue
-            
-            # Суммируем
-            debt_summary[debt_type] += amount
-            
-            # Запоминаем порядок для этого файла
-            if debt_type not in file_debts:
-                file_debts.append(debt_type)
-        
-        all_debts_by_file.append(file_debts)
-    
-    # ШАГ 2: Выбираем порядок из файла с максимумом типов долгов
-    if all_debts_by_file:
-        debt_order = max(all_debts_by_file, key=len)
-    
-    # ШАГ 3: Добавляем типы, которые есть в других файлах, но нет в debt_order
-    for file_debts in all_debts_by_file:
-        for debt in file_debts:
-            if debt not in debt_order:
-                debt_order.append(debt)
-    
-    # ШАГ 4: Формируем список для вывода
     display_rows = []
     total_amount = Decimal('0')
     
-    for debt_type in debt_order:
-        amt = debt_summary.get(debt_type, Decimal('0'))
+    for rec in records:
+        amt = rec['amount']
         total_amount += amt
         
         display_rows.append({
-            'Тип долга': debt_type,
+            'Тип долга': rec['debt_type'],
             'Сумма': decimal_to_float(amt)
         })
     
@@ -716,74 +711,26 @@ async def generate_staff_debts_period_report(club_name: str, start_date: date, e
 
 async def generate_cash_collection_period_report(club_name: str, start_date: date, end_date: date):
     """Генерация сводного отчета по инкассации за период"""
-    from collections import defaultdict
-    
-    # Получаем все файлы за период
-    files = db.get_files_by_period(start_date, end_date, club_name)
+    # Файлы периода и суммы читаются одновременно. Суммы по парам (валюта, курс) считаются в БД, итоговые строки файлов не учитываются
+    files, records = await asyncio.gather(
+        adb.get_files_by_period(start_date, end_date, club_name),
+        adb.get_cash_collection_period(club_name, start_date, end_date)
+    )
     
     if not files:
         return None
     
-    # Словарь для суммирования: {(currency_label, exchange_rate): {'quantity': sum, 'amount': sum}}
-    cash_summary = defaultdict(lambda: {'quantity': 0, 'amount': Decimal('0')})
-    # Список для сохранения порядка (валюта, курс) пар
-    cash_order = []
-    
-    # ШАГ 1: Собираем ВСЕ уникальные пары (валюта + курс) из ВСЕХ файлов периода
-    all_cash_by_file = []
-    
-    for file_info in files:
-        file_id = file_info['id']
-        records = db.list_cash_collection(file_id)
-        
-        file_cash = []
-        for rec in records:
-            currency_label = rec.get('currency_label')
-            quantity = rec.get('quantity') or 0
-            exchange_rate = rec.get('exchange_rate') or Decimal('0')
-            amount = rec.get('amount') or Decimal('0')
-            is_total = rec.get('is_total', False)
-            
-            if is_total:
-                # Это итоговая строка - пропускаем, посчитаем сами
-                continue
-            
-            # Ключ: (валюта, курс)
-            key = (currency_label, exchange_rate)
-            
-            # Суммируем
-            cash_summary[key]['quantity'] += quantity
-            cash_summary[key]['amount'] += amount
-            
-            # Запоминаем порядок для этого файла
-            if key not in file_cash:
-                file_cash.append(key)
-        
-        all_cash_by_file.append(file_cash)
-    
-    # ШАГ 2: Выбираем порядок из файла с максимумом записей
-    if all_cash_by_file:
-        cash_order = max(all_cash_by_file, key=len)
-    
-    # ШАГ 3: Добавляем пары, которые есть в других файлах, но нет в cash_order
-    for file_cash in all_cash_by_file:
-        for key in file_cash:
-            if key not in cash_order:
-                cash_order.append(key)
-    
-    # ШАГ 4: Формируем список для вывода
     display_rows = []
     total_amount = Decimal('0')
     
-    for currency_label, exchange_rate in cash_order:
-        qty = cash_summary[(currency_label, exchange_rate)]['quantity']
-        amt = cash_summary[(currency_label, exchange_rate)]['amount']
+    for rec in records:
+        amt = rec['amount']
         total_amount += amt
         
         display_rows.append({
-            'Валюта': currency_label,
-            'Количество': qty,
-            'Курс': decimal_to_float(exchange_rate),
+            'Валюта': rec['currency_label'],
+            'Количество': rec['quantity'],
+            'Курс': decimal_to_float(rec['exchange_rate']),
             'Сумма': decimal_to_float(amt)
         })
     
@@ -800,85 +747,22 @@ async def generate_cash_collection_period_report(club_name: str, start_date: dat
 
 async def generate_expenses_period_report(club_name: str, start_date: date, end_date: date):
     """Генерация сводного отчета по расходам за период (включая прочие расходы вне смены)"""
-    from collections import defaultdict
-    
-    # Получаем все файлы за период
-    files = db.get_files_by_period(start_date, end_date, club_name)
-    
-    # Словарь для суммирования: {expense_item: sum}
-    expense_summary = defaultdict(Decimal)
-    # Список для сохранения порядка статей расходов (берем из файла с максимумом статей)
-    expense_order = []
-    
-    # ШАГ 1: Собираем ВСЕ уникальные статьи расходов из ВСЕХ файлов периода
-    all_expenses_by_file = []
-    
-    if files:
-        for file_info in files:
-            file_id = file_info['id']
-            records = db.list_expense_records(file_id)
-            
-            file_expenses = []
-            for rec in records:
-                expense_item = rec.get('expense_item')
-                amount = rec.get('amount') or Decimal('0')
-                is_total = rec.get('is_total', False)
-                
-                if is_total:
-                    # Это итоговая строка - пропускаем, посчитаем сами
-                    continue
-                
-                # Суммируем
-                expense_summary[expense_item] += amount
-                
-                # Запоминаем порядок для этого файла
-                if expense_item not in file_expenses:
-                    file_expenses.append(expense_item)
-            
-            all_expenses_by_file.append(file_expenses)
-    
-    # ШАГ 2: Добавляем ПРОЧИЕ РАСХОДЫ (расходы вне смены) за этот период
-    off_shift_expenses = db.get_off_shift_expenses(club_name, start_date, end_date)
-    
-    if off_shift_expenses:
-        off_shift_items = []
-        for exp in off_shift_expenses:
-            expense_item = exp.get('expense_item')
-            amount = Decimal(str(exp.get('amount', 0)))
-            
-            # Суммируем (добавляем к существующим или создаем новую статью)
-            expense_summary[expense_item] += amount
-            
-            # Запоминаем порядок
-            if expense_item not in off_shift_items:
-                off_shift_items.append(expense_item)
-        
-        all_expenses_by_file.append(off_shift_items)
+    # Суммы по статьям считаются в БД вместе с прочими расходами вне смены
+    records = await adb.get_expense_records_period(club_name, start_date, end_date)
     
     # Если нет ни расходов из файлов, ни прочих расходов - возвращаем None
-    if not expense_summary:
+    if not records:
         return None
     
-    # ШАГ 3: Выбираем порядок из файла с максимумом статей расходов
-    if all_expenses_by_file:
-        expense_order = max(all_expenses_by_file, key=len)
-    
-    # ШАГ 4: Добавляем статьи, которые есть в других файлах, но нет в expense_order
-    for file_expenses in all_expenses_by_file:
-        for expense in file_expenses:
-            if expense not in expense_order:
-                expense_order.append(expense)
-    
-    # ШАГ 5: Формируем список для вывода
     display_rows = []
     total_amount = Decimal('0')
     
-    for expense_item in expense_order:
-        amt = expense_summary.get(expense_item, Decimal('0'))
+    for rec in records:
+        amt = rec['amount']
         total_amount += amt
         
         display_rows.append({
-            'Статья расхода': expense_item,
+            'Статья расхода': rec['expense_item'],
             'Сумма': decimal_to_float(amt)
         })
     
@@ -893,60 +777,24 @@ async def generate_expenses_period_report(club_name: str, start_date: date, end_
 
 async def generate_staff_statistics_period_report(club_name: str, start_date: date, end_date: date):
     """Генерация сводного отчета по статистике персонала за период"""
-    from collections import defaultdict
-    
-    # Получаем все файлы за период
-    files = db.get_files_by_period(start_date, end_date, club_name)
+    # Файлы периода и суммы читаются одновременно. Суммы по должностям считаются в БД
+    files, records = await asyncio.gather(
+        adb.get_files_by_period(start_date, end_date, club_name),
+        adb.get_staff_statistics_period(club_name, start_date, end_date)
+    )
     
     if not files:
         return None
     
-    # Словарь для суммирования: {role_name: sum}
-    staff_summary = defaultdict(int)
-    # Список для сохранения порядка должностей (берем из файла с максимумом должностей)
-    role_order = []
-    
-    # ШАГ 1: Собираем ВСЕ уникальные должности из ВСЕХ файлов периода
-    all_roles_by_file = []
-    
-    for file_info in files:
-        file_id = file_info['id']
-        records = db.list_staff_statistics(file_id)
-        
-        file_roles = []
-        for rec in records:
-            role_name = rec.get('role_name')
-            staff_count = rec.get('staff_count') or 0
-            
-            # Суммируем
-            staff_summary[role_name] += staff_count
-            
-            # Запоминаем порядок для этого файла
-            if role_name not in file_roles:
-                file_roles.append(role_name)
-        
-        all_roles_by_file.append(file_roles)
-    
-    # ШАГ 2: Выбираем порядок из файла с максимумом должностей
-    if all_roles_by_file:
-        role_order = max(all_roles_by_file, key=len)
-    
-    # ШАГ 3: Добавляем должности, которые есть в других файлах, но нет в role_order
-    for file_roles in all_roles_by_file:
-        for role in file_roles:
-            if role not in role_order:
-                role_order.append(role)
-    
-    # ШАГ 4: Формируем список для вывода
     display_rows = []
     total_count = 0
     
-    for role_name in role_order:
-        count = staff_summary.get(role_name, 0)
+    for rec in records:
+        count = rec['staff_count']
         total_count += count
         
         display_rows.append({
-            'Должность': role_name,
+            'Должность': rec['role_name'],
             'Количество': count
         })
     
@@ -961,73 +809,25 @@ async def generate_staff_statistics_period_report(club_name: str, start_date: da
 
 async def generate_payment_types_period_report(club_name: str, start_date: date, end_date: date):
     """Генерация сводного отчета по типам оплат за период"""
-    from collections import defaultdict
-    
-    # Получаем все файлы за период
-    files = db.get_files_by_period(start_date, end_date, club_name)
+    # Файлы периода и суммы читаются одновременно. Суммы по типам оплат и "ИТОГО КАССА" считаются в БД
+    files, period_data = await asyncio.gather(
+        adb.get_files_by_period(start_date, end_date, club_name),
+        adb.get_payment_types_period(club_name, start_date, end_date)
+    )
     
     if not files:
         return None
+    cash_total_amount = period_data['cash_total']
     
-    # Словарь для суммирования: {payment_type: sum}
-    payment_summary = defaultdict(Decimal)
-    # Отдельная сумма для "ИТОГО КАССА" (не участвует в общем итоге)
-    cash_total_amount = Decimal('0')
-    # Список для сохранения порядка типов оплат (берем из файла с максимумом типов)
-    payment_order = []
-    
-    # ШАГ 1: Собираем ВСЕ уникальные типы оплат из ВСЕХ файлов периода
-    all_payments_by_file = []
-    
-    for file_info in files:
-        file_id = file_info['id']
-        records = db.list_payment_types(file_id)
-        
-        file_payments = []
-        for rec in records:
-            payment_type = rec.get('payment_type')
-            amount = rec.get('amount') or Decimal('0')
-            is_total = rec.get('is_total', False)
-            is_cash_total = rec.get('is_cash_total', False)
-            
-            if is_total:
-                # Это итоговая строка - пропускаем, посчитаем сами
-                continue
-            
-            if is_cash_total:
-                # Это "ИТОГО КАССА" - суммируем отдельно, но не добавляем в payment_summary
-                cash_total_amount += amount
-                continue
-            
-            # Суммируем
-            payment_summary[payment_type] += amount
-            
-            # Запоминаем порядок для этого файла
-            if payment_type not in file_payments:
-                file_payments.append(payment_type)
-        
-        all_payments_by_file.append(file_payments)
-    
-    # ШАГ 2: Выбираем порядок из файла с максимумом типов оплат
-    if all_payments_by_file:
-        payment_order = max(all_payments_by_file, key=len)
-    
-    # ШАГ 3: Добавляем типы, которые есть в других файлах, но нет в payment_order
-    for file_payments in all_payments_by_file:
-        for payment in file_payments:
-            if payment not in payment_order:
-                payment_order.append(payment)
-    
-    # ШАГ 4: Формируем список для вывода
     display_rows = []
     total_amount = Decimal('0')
     
-    for payment_type in payment_order:
-        amt = payment_summary.get(payment_type, Decimal('0'))
+    for rec in period_data['records']:
+        amt = rec['amount']
         total_amount += amt
         
         display_rows.append({
-            'Тип оплаты': payment_type,
+            'Тип оплаты': rec['payment_type'],
             'Сумма': decimal_to_float(amt)
         })
     
@@ -1049,73 +849,30 @@ async def generate_payment_types_period_report(club_name: str, start_date: date,
 
 async def generate_tickets_period_report(club_name: str, start_date: date, end_date: date):
     """Генерация сводного отчета по входным билетам за период"""
-    from collections import defaultdict
-    
-    # Получаем все файлы за период
-    files = db.get_files_by_period(start_date, end_date, club_name)
+    # Файлы периода и суммы читаются одновременно. Суммы по ценам считаются в БД, итоговые строки файлов не учитываются
+    files, records = await asyncio.gather(
+        adb.get_files_by_period(start_date, end_date, club_name),
+        adb.get_ticket_sales_period(club_name, start_date, end_date)
+    )
     
     if not files:
         return None
     
-    # Словарь для суммирования: {price_label: {'quantity': sum, 'amount': sum}}
-    tickets_summary = defaultdict(lambda: {'quantity': 0, 'amount': Decimal('0')})
-    # Список для сохранения порядка цен (берем из файла с максимумом цен)
-    price_order = []
-    
-    # ШАГ 1: Собираем ВСЕ уникальные цены из ВСЕХ файлов периода
-    all_prices_by_file = []
+    display_rows = []
     total_quantity = 0
     total_amount = Decimal('0')
     
-    for file_info in files:
-        file_id = file_info['id']
-        records = db.list_ticket_sales(file_id)
-        
-        file_prices = []
-        for rec in records:
-            price_label = rec.get('price_label')
-            quantity = rec.get('quantity') or 0
-            amount = rec.get('amount') or Decimal('0')
-            is_total = rec.get('is_total', False)
-            
-            if is_total:
-                # Это итоговая строка - пропускаем в суммировании, посчитаем сами
-                continue
-            
-            # Суммируем
-            tickets_summary[price_label]['quantity'] += quantity
-            tickets_summary[price_label]['amount'] += amount
-            
-            # Запоминаем порядок для этого файла
-            if price_label not in file_prices:
-                file_prices.append(price_label)
+    for rec in records:
+        qty = rec['quantity']
+        amt = rec['amount']
+        total_quantity += qty
+        total_amount += amt
         
-        all_prices_by_file.append(file_prices)
-    
-    # ШАГ 2: Выбираем порядок из файла с максимумом цен
-    if all_prices_by_file:
-        price_order = max(all_prices_by_file, key=len)
-    
-    # ШАГ 3: Добавляем цены, которые есть в других файлах, но нет в price_order
-    for file_prices in all_prices_by_file:
-        for price in file_prices:
-            if price not in price_order:
-                price_order.append(price)
-    
-    # ШАГ 4: Формируем список для вывода
-    display_rows = []
-    for price_label in price_order:
-        if price_label in tickets_summary:
-            qty = tickets_summary[price_label]['quantity']
-            amt = tickets_summary[price_label]['amount']
-            total_quantity += qty
-            total_amount += amt
-            
-            display_rows.append({
-                'Цена': price_label,
-                'Количество': qty,
-                'Сумма': decimal_to_float(amt)
-            })
+        display_rows.append({
+            'Цена': rec['price_label'],
+            'Количество': qty,
+            'Сумма': decimal_to_float(amt)
+        })
     
     # Добавляем ИТОГО
     display_rows.append({
@@ -1131,10 +888,10 @@ async def generate_week_report(target_message, club_name: str, week_start: date,
     """Генерация отчета за неделю"""
     from datetime import timedelta
     
-    # Получаем все файлы за неделю
-    files = db.get_files_by_period(week_start, week_end, club_name)
+    # Дневные показатели за неделю - одна строка на дату отчета
+    facts = await adb.get_daily_facts_period(club_name, week_start, week_end)
     
-    if not files:
+    if not facts:
         await target_message.reply_text(
             f"📭 Нет данных за период {format_report_date(week_start)} - {format_report_date(week_end)} для клуба {club_name}",
             reply_markup=get_main_menu_keyboard()
@@ -1143,45 +900,20 @@ async def generate_week_report(target_message, club_name: str, week_start: date,
     
     # Проверяем, полная ли неделя (7 дней)
     expected_days = 7
-    actual_dates = set(f['report_date'] for f in files if f.get('report_date'))
-    actual_days = len(actual_dates)
+    actual_days = len(facts)
     
     is_full_week = actual_days == expected_days
     week_warning = ""
     if not is_full_week:
         week_warning = f"\n⚠️ ВНИМАНИЕ: Неполная неделя! Данных за {actual_days} из {expected_days} дней.\n"
     
-    # 1. Получаем итого доходов за неделю (категория "итого" или "итого за смену" из блока доходов)
-    income_total = Decimal('0.00')
-    staff_amount = Decimal('0.00')
-    staff_hookah_amount = Decimal('0.00')
-    
-    for file_info in files:
-        file_id = file_info['id']
-        records = db.list_income_records(file_id)
-        
-        for rec in records:
-            category_lower = rec['category'].strip().lower()
-            amount = rec['amount']
-            
-            # Ищем ИТОГО ЗА СМЕНУ (только эта категория, не "итого касса"!)
-            if category_lower == 'итого за смену':
-                income_total += amount
-            
-            # Ищем стафф
-            if 'стафф' in category_lower and 'кальян' not in category_lower:
-                staff_amount += amount
-            
-            # Ищем стафф кальян
-            if 'стафф' in category_lower and 'кальян' in category_lower:
-                staff_hookah_amount += amount
+    # 1. Итого доходов за неделю (категория "итого за смену", не "итого касса"), стафф и стафф кальян
+    income_total = sum((day['shift_income_total'] for day in facts), Decimal('0.00'))
+    staff_amount = sum((day['staff_amount'] for day in facts), Decimal('0.00'))
+    staff_hookah_amount = sum((day['staff_hookah_amount'] for day in facts), Decimal('0.00'))
     
-    # 2. Получаем количество гостей (билетов) за неделю
-    tickets_result = await generate_tickets_period_report(club_name, week_start, week_end)
-    if tickets_result:
-        _, guests_count, _ = tickets_result
-    else:
-        guests_count = 0
+    # 2. Количество гостей (билетов) за неделю
+    guests_count = sum(day['guests_count'] for day in facts)
     
     # 3. Рассчитываем средний чек
     # Средний чек = (Итого доходов - (стафф + стафф кальян)) / количество гостей
@@ -1240,7 +972,8 @@ async def generate_week_report(target_message, club_name: str, week_start: date,
     ]
     
     # Используем существующую функцию для экспорта периода
-    excel_bytes = excel_processor.export_period_report_to_excel(
+    excel_bytes = await pools.run_blocking(
+        excel_processor.export_period_report_to_excel,
         display_rows, club_name, week_start, week_end, "Неделя"
     )
     
@@ -1254,56 +987,22 @@ async def generate_week_report(target_message, club_name: str, week_start: date,
 
 async def generate_income_period_report(club_name: str, start_date: date, end_date: date):
     """Генерация сводного отчета по доходам за период"""
-    from collections import defaultdict
-    
-    # Получаем все файлы за период
-    files = db.get_files_by_period(start_date, end_date, club_name)
+    # Файлы периода и суммы читаются одновременно. Суммы по категориям считаются в БД; порядок — из файла с максимумом категорий,
+    # затем категории остальных файлов
+    files, records = await asyncio.gather(
+        adb.get_files_by_period(start_date, end_date, club_name),
+        adb.get_income_period(club_name, start_date, end_date)
+    )
     
     if not files:
         return None
     
-    # Словарь для суммирования: {категория: сумма}
-    income_summary = defaultdict(Decimal)
-    # Список для сохранения порядка категорий (берем из первого файла который имеет максимум категорий)
-    category_order = []
-    
-    # ШАГ 1: Собираем ВСЕ уникальные категории из ВСЕХ файлов периода и запоминаем порядок
-    all_categories_by_file = []
-    for file_info in files:
-        file_id = file_info['id']
-        records = db.list_income_records(file_id)
-        
-        file_categories = []
-        for rec in records:
-            category = rec['category']
-            amount = rec['amount']
-            
-            # Суммируем
-            income_summary[category] += amount
-            
-            # Запоминаем порядок для этого файла
-            if category not in file_categories:
-                file_categories.append(category)
-        
-        all_categories_by_file.append(file_categories)
-    
-    # ШАГ 2: Выбираем порядок из файла, у которого больше всего категорий (наиболее полный)
-    if all_categories_by_file:
-        category_order = max(all_categories_by_file, key=len)
-    
-    # ШАГ 3: Добавляем категории, которые есть в других файлах, но нет в category_order
-    for file_cats in all_categories_by_file:
-        for cat in file_cats:
-            if cat not in category_order:
-                category_order.append(cat)
-    
-    # ШАГ 4: Формируем список для вывода В ПРАВИЛЬНОМ ПОРЯДКЕ
     # ВАЖНО: Показываем ВСЕ категории, даже если сумма = 0!
     display_rows = []
-    for category in category_order:
+    for rec in records:
         display_rows.append({
-            'Категория': category,
-            'Сумма за период': decimal_to_float(income_summary.get(category, Decimal('0')))
+            'Категория': rec['category'],
+            'Сумма за период': decimal_to_float(rec['amount'] or Decimal('0'))
         })
     
     return display_rows
@@ -1319,7 +1018,7 @@ async def send_queries_menu_message(target_message, context=None):
 
 async def send_report_dates_menu(target_message, context=None):
     club_name = context.user_data.get('current_club') if context else None
-    dates = db.get_report_dates(club_name=club_name)
+    dates = await adb.get_report_dates(club_name=club_name)
     if not dates:
         club_text = f" для клуба {club_name}" if club_name and club_name != 'Оба' else ""
         await target_message.reply_text(
@@ -1343,7 +1042,7 @@ async def send_blocks_menu_message(target_message, report_date: date):
 
 async def send_report_block_data(target_message, report_date: date, block_id: str, context=None):
     club_name = context.user_data.get('current_club') if context else None
-    file_info = db.get_file_by_report_date(report_date, club_name=club_name)
+    file_info = await adb.get_file_by_report_date(report_date, club_name=club_name)
     if not file_info:
         await target_message.reply_text("⚠️ Отчёт на эту дату не найден.")
         return
@@ -1357,7 +1056,7 @@ async def send_report_block_data(target_message, report_date: date, block_id: st
     block_label = next((label for bid, label in QUERY_BLOCKS if bid == block_id), block_id)
 
     if block_id == 'income':
-        records = db.list_income_records(file_id)
+        records = await adb.list_income_records(file_id)
         if not records:
             await target_message.reply_text("📭 Нет данных по доходам для этой даты.")
             return
@@ -1376,12 +1075,12 @@ async def send_report_block_data(target_message, report_date: date, block_id: st
                 'Сумма': decimal_to_float(rec['amount'])
             })
         await target_message.reply_text("\n".join(lines))
-        excel_bytes = excel_processor.export_to_excel_with_header(display_rows, report_date, f"Доходы - {club_label}", club_label)
+        excel_bytes = await pools.run_blocking(excel_processor.export_to_excel_with_header, display_rows, report_date, f"Доходы - {club_label}", club_label)
         await target_message.reply_document(excel_bytes, filename=f"доходы_{club_label}_{format_report_date(report_date)}.xlsx", caption=f"📅 Дата: {format_report_date(report_date)} | Клуб: {club_label}")
         return
 
     if block_id == 'tickets':
-        records = db.list_ticket_sales(file_id)
+        records = await adb.list_ticket_sales(file_id)
         if not records:
             await target_message.reply_text("📭 Нет данных по входным билетам для этой даты.")
             return
@@ -1417,12 +1116,12 @@ async def send_report_block_data(target_message, report_date: date, block_id: st
         
         await target_message.reply_text("\n".join(lines))
         
-        excel_bytes = excel_processor.export_to_excel_with_header(display_rows, report_date, f"Входные билеты - {club_label}", club_label)
+        excel_bytes = await pools.run_blocking(excel_processor.export_to_excel_with_header, display_rows, report_date, f"Входные билеты - {club_label}", club_label)
         await target_message.reply_document(excel_bytes, filename=f"входные_билеты_{club_label}_{format_report_date(report_date)}.xlsx", caption=f"📅 Дата: {format_report_date(report_date)} | Клуб: {club_label}")
         return
 
     if block_id == 'payments':
-        records = db.list_payment_types(file_id)
+        records = await adb.list_payment_types(file_id)
         if not records:
             await target_message.reply_text("📭 Нет данных по типам оплат для этой даты.")
             return
@@ -1436,12 +1135,12 @@ async def send_report_block_data(target_message, report_date: date, block_id: st
                 'Сумма': decimal_to_float(rec['amount'])
             })
         await target_message.reply_text("\n".join(lines))
-        excel_bytes = excel_processor.export_to_excel_with_header(display_rows, report_date, f"Типы оплат - {club_label}", club_label)
+        excel_bytes = await pools.run_blocking(excel_processor.export_to_excel_with_header, display_rows, report_date, f"Типы оплат - {club_label}", club_label)
         await target_message.reply_document(excel_bytes, filename=f"типы_оплат_{club_label}_{format_report_date(report_date)}.xlsx", caption=f"📅 Дата: {format_report_date(report_date)} | Клуб: {club_label}")
         return
 
     if block_id == 'staff':
-        records = db.list_staff_statistics(file_id)
+        records = await adb.list_staff_statistics(file_id)
         if not records:
             await target_message.reply_text("📭 Нет данных по персоналу для этой даты.")
             return
@@ -1464,12 +1163,12 @@ async def send_report_block_data(target_message, report_date: date, block_id: st
         
         lines.append(f"Всего персонала: {total_staff}")
         await target_message.reply_text("\n".join(lines))
-        excel_bytes = excel_processor.export_to_excel_with_header(display_rows, report_date, f"Статистика персонала - {club_label}", club_label)
+        excel_bytes = await pools.run_blocking(excel_processor.export_to_excel_with_header, display_rows, report_date, f"Статистика персонала - {club_label}", club_label)
         await target_message.reply_document(excel_bytes, filename=f"персонал_{club_label}_{format_report_date(report_date)}.xlsx", caption=f"📅 Дата: {format_report_date(report_date)} | Клуб: {club_label}")
         return
 
     if block_id == 'expenses':
-        records = db.list_expense_records(file_id)
+        records = await adb.list_expense_records(file_id)
         if not records:
             await target_message.reply_text("📭 Нет данных по расходам для этой даты.")
             return
@@ -1492,12 +1191,12 @@ async def send_report_block_data(target_message, report_date: date, block_id: st
             })
         lines.append(f"Итого: {decimal_to_str(total)}")
         await target_message.reply_text("\n".join(lines))
-        excel_bytes = excel_processor.export_to_excel_with_header(display_rows, report_date, f"Расходы - {club_label}", club_label)
+        excel_bytes = await pools.run_blocking(excel_processor.export_to_excel_with_header, display_rows, report_date, f"Расходы - {club_label}", club_label)
         await target_message.reply_document(excel_bytes, filename=f"расходы_{club_label}_{format_report_date(report_date)}.xlsx", caption=f"📅 Дата: {format_report_date(report_date)} | Клуб: {club_label}")
         return
 
     if block_id == 'cash':
-        records = db.list_cash_collection(file_id)
+        records = await adb.list_cash_collection(file_id)
         if not records:
             await target_message.reply_text("📭 Нет данных по инкассации для этой даты.")
             return
@@ -1534,12 +1233,12 @@ async def send_report_block_data(target_message, report_date: date, block_id: st
             lines.append(f"\n💰 ИТОГО: {decimal_to_str(total_amount)}")
         
         await target_message.reply_text("\n".join(lines))
-        excel_bytes = excel_processor.export_to_excel_with_header(display_rows, report_date, f"Инкассация - {club_label}", club_label)
+        excel_bytes = await pools.run_blocking(excel_processor.export_to_excel_with_header, display_rows, report_date, f"Инкассация - {club_label}", club_label)
         await target_message.reply_document(excel_bytes, filename=f"инкассация_{club_label}_{format_report_date(report_date)}.xlsx", caption=f"📅 Дата: {format_report_date(report_date)} | Клуб: {club_label}")
         return
 
     if block_id == 'debts':
-        records = db.list_staff_debts(file_id)
+        records = await adb.list_staff_debts(file_id)
         if not records:
             await target_message.reply_text("📭 Нет данных по долгам персонала для этой даты.")
             return
@@ -1569,12 +1268,12 @@ async def send_report_block_data(target_message, report_date: date, block_id: st
             lines.append(f"\n💰 ИТОГО: {decimal_to_str(total_amount)}")
         
         await target_message.reply_text("\n".join(lines))
-        excel_bytes = excel_processor.export_to_excel_with_header(display_rows, report_date, f"Долги по персоналу - {club_label}", club_label)
+        excel_bytes = await pools.run_blocking(excel_processor.export_to_excel_with_header, display_rows, report_date, f"Долги по персоналу - {club_label}", club_label)
         await target_message.reply_document(excel_bytes, filename=f"долги_{club_label}_{format_report_date(report_date)}.xlsx", caption=f"📅 Дата: {format_report_date(report_date)} | Клуб: {club_label}")
         return
 
     if block_id == 'notes':
-        records = db.list_notes_entries(file_id)
+        records = await adb.list_notes_entries(file_id)
         if not records:
             await target_message.reply_text("📭 Нет примечаний для этой даты.")
             return
@@ -1621,111 +1320,36 @@ async def send_report_block_data(target_message, report_date: date, block_id: st
             
             display_rows.append(row)
         
-        excel_bytes = excel_processor.export_to_excel_with_header(display_rows, report_date, f"Примечания - {club_label}", club_label)
+        excel_bytes = await pools.run_blocking(excel_processor.export_to_excel_with_header, display_rows, report_date, f"Примечания - {club_label}", club_label)
         await target_message.reply_document(excel_bytes, filename=f"примечания_{club_label}_{format_report_date(report_date)}.xlsx", caption=f"📅 Дата: {format_report_date(report_date)} | Клуб: {club_label}")
         return
 
     if block_id == 'misc_expenses':
         # Получаем содержимое файла из базы данных
-        with db.get_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT file_content FROM uploaded_files WHERE id = %s", (file_id,))
-                result = cur.fetchone()
-                if not result or not result[0]:
-                    await target_message.reply_text("📭 Нет прочих расходов для этой даты.")
-                    return
-                file_content = result[0]
+        file_content = await adb.get_file_content(file_id)
+        if not file_content:
+            await target_message.reply_text("📭 Нет прочих расходов для этой даты.")
+            return
         
         # Извлекаем прочие расходы через парсер
-        misc_expenses_text = excel_processor.extract_misc_expenses_from_notes_after_total(file_content)
+        misc_expenses_text = await pools.run_cpu(executors.extract_misc_expenses_text, bytes(file_content))
         
         if not misc_expenses_text:
             await target_message.reply_text("📭 Нет прочих расходов для этой даты.")
             return
         
         # Парсим прочие расходы: формат "сумма-статья расхода"
-        # В одной строке может быть несколько записей: "1000- т. анар и сразу дальше 2000-т. бобр"
         # Примеры: "8.000-депозит т.Анар", "12.000-депозит т.Фарид", "250-доставка (62)"
-        parsed_expenses = []
-        total_amount = Decimal('0.00')
-        
-        # Парсим прочие расходы: в одной строке может быть несколько записей
-        # Формат: "сумма-статья", примеры: "1000- т. анар и сразу дальше 2000-т. бобр"
-        for line in misc_expenses_text.split('\n'):
-            line = line.strip()
-            if not line:
-                continue
-            
-            # Пропускаем строки с ИТОГО
-            if line.lower().startswith('итого'):
-                continue
-            
-            # Находим все числа в строке (с учетом точек/запятых как разделителей тысяч)
-            # Паттерн для поиска чисел: \d+(?:[.,]\d+)*
-            number_pattern = r'\d+(?:[.,]\d+)*'
-            number_positions = []
-            
-            for match in re.finditer(number_pattern, line):
-                start_pos = match.start()
-                end_pos = match.end()
-                number_str = match.group(0)
-                number_positions.append((start_pos, end_pos, number_str))
-            
-            # Обрабатываем каждое найденное число
-            for i, (start_pos, end_pos, number_str) in enumerate(number_positions):
-                # Проверяем, есть ли дефис сразу после числа (с возможными пробелами)
-                after_number = line[end_pos:].lstrip()
-                
-                if not after_number.startswith('-'):
-                    # Если после числа нет дефиса, пропускаем это число
-                    continue
-                
-                # Находим позицию дефиса
-                dash_pos = end_pos + len(line[end_pos:]) - len(after_number)
-                after_dash = line[dash_pos + 1:].lstrip()
-                
-                # Определяем конец статьи расхода:
-                # - До следующего числа с дефисом после него
-                # - Или до конца строки
-                expense_end = len(line)
-                
-                # Ищем следующее число с дефисом
-                for j in range(i + 1, len(number_positions)):
-                    next_start, next_end, next_number = number_positions[j]
-                    # Проверяем, есть ли дефис после следующего числа
-                    after_next = line[next_end:].lstrip()
-                    if after_next.startswith('-'):
-                        # Нашли следующее число с дефисом - статья заканчивается перед ним
-                        expense_end = next_start
-                        break
-                
-                # Извлекаем статью расхода
-                expense_item = line[dash_pos + 1:expense_end].strip()
-                
-                # Убираем точки и запятые из суммы
-                amount_clean = number_str.replace('.', '').replace(',', '').replace(' ', '')
-                
-                try:
-                    amount = Decimal(amount_clean)
-                    
-                    parsed_expenses.append({
-                        'expense_item': expense_item,
-                        'amount': amount,
-                        'is_total': False
-                    })
-                    
-                    total_amount += amount
-                    
-                except (ValueError, InvalidOperation) as e:
-                    logger.warning(f"Failed to parse amount from '{number_str}': {e}")
-                    continue
+        parsed_expenses = excel_processor.parse_misc_expenses_text(misc_expenses_text)
+        total_amount = sum((exp['amount'] for exp in parsed_expenses), Decimal('0.00'))
         
         if not parsed_expenses:
             await target_message.reply_text("📭 Не удалось распарсить прочие расходы.")
             return
         
         # Сохраняем в БД в отдельную таблицу для прочих расходов
-        db.save_misc_expenses_records(file_id, parsed_expenses)
+        await adb.save_misc_expenses_records(file_id, parsed_expenses)
+        period_report_cache.invalidate(stored_club_name, report_date)
         
         # Показываем предпросмотр
         lines = [f"💸 Прочие расходы ({format_report_date(report_date)}) - {club_label}:"]
@@ -1750,12 +1374,12 @@ async def send_report_block_data(target_message, report_date: date, block_id: st
             'Статья расхода': 'ИТОГО'
         })
         
-        excel_bytes = excel_processor.export_to_excel_with_header(display_rows, report_date, f"Прочие расходы - {club_label}", club_label)
+        excel_bytes = await pools.run_blocking(excel_processor.export_to_excel_with_header, display_rows, report_date, f"Прочие расходы - {club_label}", club_label)
         await target_message.reply_document(excel_bytes, filename=f"прочие_расходы_{club_label}_{format_report_date(report_date)}.xlsx", caption=f"📅 Дата: {format_report_date(report_date)} | Клуб: {club_label}")
         return
 
     if block_id == 'totals':
-        records = db.list_totals_summary(file_id)
+        records = await adb.list_totals_summary(file_id)
         if not records:
             await target_message.reply_text("📭 Нет итогового баланса для этой даты.")
             return
@@ -1771,7 +1395,7 @@ async def send_report_block_data(target_message, report_date: date, block_id: st
             }
         
         # Добавляем прочие расходы за эту дату
-        off_shift_expenses = db.get_off_shift_expenses(club_name, report_date, report_date)
+        off_shift_expenses = await adb.get_off_shift_expenses(club_name, report_date, report_date)
         if off_shift_expenses:
             for exp in off_shift_expenses:
                 payment_type = exp.get('payment_type', 'Наличные')
@@ -1803,24 +1427,20 @@ async def send_report_block_data(target_message, report_date: date, block_id: st
                 'Чистая прибыль': decimal_to_float(values['profit'])
             })
         await target_message.reply_text("\n".join(lines))
-        excel_bytes = excel_processor.export_to_excel_with_header(display_rows, report_date, f"Итоговый баланс - {club_label}", club_label)
+        excel_bytes = await pools.run_blocking(excel_processor.export_to_excel_with_header, display_rows, report_date, f"Итоговый баланс - {club_label}", club_label)
         await target_message.reply_document(excel_bytes, filename=f"итого_{club_label}_{format_report_date(report_date)}.xlsx", caption=f"📅 Дата: {format_report_date(report_date)} | Клуб: {club_label}")
         return
 
     if block_id == 'taxi':
         # Получаем содержимое файла из базы данных
-        with db.get_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT file_content FROM uploaded_files WHERE id = %s", (file_id,))
-                result = cur.fetchone()
-                if not result or not result[0]:
-                    await target_message.reply_text("📭 Нет данных по такси для этой даты.")
-                    return
-                file_content = result[0]
+        file_content = await adb.get_file_content(file_id)
+        if not file_content:
+            await target_message.reply_text("📭 Нет данных по такси для этой даты.")
+            return
         
         # Извлекаем данные по такси через парсер
         logger.info(f"=== Extracting taxi expenses for file_id={file_id}, date={report_date} ===")
-        taxi_data = excel_processor.extract_taxi_expenses(file_content)
+        taxi_data = await pools.run_cpu(executors.extract_taxi_expenses, bytes(file_content))
         logger.info(f"Taxi data extracted: {taxi_data}")
         
         taxi_amount = taxi_data.get('taxi_amount', Decimal('0.00'))
@@ -1834,7 +1454,8 @@ async def send_report_block_data(target_message, report_date: date, block_id: st
         total_amount = taxi_amount + taxi_percent_amount + deposits_total
         
         # Сохраняем в БД
-        db.save_taxi_expenses(file_id, taxi_amount, taxi_percent_amount, deposits_total, total_amount)
+        await adb.save_taxi_expenses(file_id, taxi_amount, taxi_percent_amount, deposits_total, total_amount)
+        period_report_cache.invalidate(stored_club_name, report_date)
         
         # Показываем предпросмотр
         lines = [f"🚕 ТАКСИ ({format_report_date(report_date)}) - {club_label}:"]
@@ -1880,7 +1501,7 @@ async def send_report_block_data(target_message, report_date: date, block_id: st
             'Сумма': decimal_to_float(total_amount)
         })
         
-        excel_bytes = excel_processor.export_to_excel_with_header(display_rows, report_date, f"ТАКСИ - {club_label}", club_label)
+        excel_bytes = await pools.run_blocking(excel_processor.export_to_excel_with_header, display_rows, report_date, f"ТАКСИ - {club_label}", club_label)
         await target_message.reply_document(excel_bytes, filename=f"такси_{club_label}_{format_report_date(report_date)}.xlsx", caption=f"📅 Дата: {format_report_date(report_date)} | Клуб: {club_label}")
         return
 
@@ -1898,6 +1519,120 @@ async def setup_bot_commands(application: Application):
     await application.bot.set_my_commands(commands)
 
 
+def build_reprocess_progress(progress: Dict[str, Any]) -> str:
+    """Сообщение о ходе переобработки файлов"""
+    text = (
+        f"🔄 Переобработка файлов: {progress['processed']}/{progress['total']}\n"
+        f"✅ Готово: {progress['done']}"
+    )
+    if progress['skipped']:
+        text += f"\n⏭ Без изменений: {progress['skipped']}"
+    if progress['error']:
+        text += f"\n❌ Ошибок: {progress['error']}"
+    if progress['resumed']:
+        text += "\n↩️ Продолжение прерванной переобработки"
+    return text
+
+
+async def send_upload_followup(bot, chat_id: int, user_data: Dict[str, Any], result: Dict[str, Any]):
+    """Запрос даты отчета (если она не определена) и кнопки дальнейших действий после загрузки файла"""
+    if result.get('report_date') is None:
+        user_data['awaiting_report_date'] = {'file_id': result['file_id']}
+        await bot.send_message(chat_id, "🗓 Укажите дату отчёта в формате ГГГГ-ММ-ДД или ДД.ММ.ГГГГ")
+
+    if result.get('duplicate'):
+        return
+
+    keyboard = [
+        [InlineKeyboardButton("📊 Мои файлы", callback_data="my_files")],
+        [InlineKeyboardButton("🔍 Задать вопрос", callback_data="ask_question")]
+    ]
+    await bot.send_message(chat_id, "Что дальше?", reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def build_job_reply(job: Dict[str, Any]) -> str:
+    """Сообщение о завершенной задаче, результат которой не дождался обработчик (например, после перезапуска)"""
+    if job['status'] == 'error':
+        if job['kind'] == 'reprocess':
+            return f"❌ Ошибка: {job.get('error_message')}"
+        return f"❌ Ошибка при обработке файла:\n{job.get('error_message')}"
+    if job['kind'] == 'reprocess':
+        return build_reprocess_summary(job['result'] or {})
+    result = result_from_job(job['result'])
+    if not result.get('duplicate'):
+        result['blocks'] = await adb.get_cached_blocks(result['file_hash'], result.get('parser_version')) or {}
+    return build_upload_reply(result, (job['payload'] or {}).get('club_name'))
+
+
+def invalidate_job_reports(job: Dict[str, Any]):
+    """Сброс кэша отчетов по данным, измененным задачей очереди"""
+    if job['kind'] == 'upload' and job['result']:
+        report_date = job['result'].get('report_date')
+        period_report_cache.invalidate(
+            (job['payload'] or {}).get('club_name'),
+            date.fromisoformat(report_date) if report_date else None
+        )
+    else:
+        period_report_cache.invalidate()
+
+
+async def notify_finished_jobs(application: Application):
+    """
+    Сообщения о задачах очереди: ход переобработки и результат задачи
+
+    Обработчики только ставят задачу в очередь и отвечают сразу (чат не ждет окончания разбора),
+    прогресс и результат показываются здесь в сообщении, сохраненном при постановке задачи.
+    """
+    shown_progress: Dict[int, Any] = {}
+
+    async def show(job: Dict[str, Any], text: str):
+        if job['message_id']:
+            await application.bot.edit_message_text(text, chat_id=job['chat_id'], message_id=job['message_id'])
+        else:
+            await application.bot.send_message(job['chat_id'], text)
+
+    while True:
+        try:
+            jobs = await adb.get_unnotified_jobs()
+            for job in jobs:
+                if job['status'] not in ('done', 'error'):
+                    if job['kind'] == 'reprocess' and job['progress'] != shown_progress.get(job['id']):
+                        shown_progress[job['id']] = job['progress']
+                        try:
+                            await show(job, build_reprocess_progress(job['progress']))
+                        except Exception as e:
+                            logger.warning(f"Failed to show progress of job {job['id']}: {e}")
+                    continue
+
+                shown_progress.pop(job['id'], None)
+                if job['status'] == 'done':
+                    invalidate_job_reports(job)
+                text = await build_job_reply(job)
+                try:
+                    await show(job, text)
+                    if job['kind'] == 'upload' and job['status'] == 'done':
+                        await send_upload_followup(
+                            application.bot, job['chat_id'], application.user_data[job['user_id']], job['result']
+                        )
+                except Exception as e:
+                    logger.warning(f"Failed to notify chat {job['chat_id']} about job {job['id']}: {e}")
+                await adb.mark_job_notified(job['id'])
+        except Exception as e:
+            logger.error(f"Error notifying about finished jobs: {e}")
+        await asyncio.sleep(INGEST_POLL_INTERVAL)
+
+
+async def post_init(application: Application):
+    await adb.open()
+    await setup_bot_commands(application)
+    if INGEST_MODE == 'queue':
+        application.create_task(notify_finished_jobs(application))
+
+
+async def post_shutdown(application: Application):
+    await adb.close()
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /start"""
     if not update.message:
@@ -2003,7 +1738,7 @@ async def my_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     try:
-        files = db.get_user_files(user_id)
+        files = await adb.get_user_files(user_id)
         
         if not files:
             await update.message.reply_text("У вас пока нет загруженных файлов 📁")
@@ -2030,7 +1765,7 @@ async def show_schema(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        schema = db.get_database_schema()
+        schema = await adb.get_database_schema()
         
         # Разбиваем на части если слишком длинное
         max_length = 4000
@@ -2054,7 +1789,7 @@ async def debug_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         # Проверяем последний файл
-        latest_file = db.get_latest_file()
+        latest_file = await adb.get_latest_file()
         if not latest_file:
             await update.message.reply_text("📭 Нет загруженных файлов")
             return
@@ -2062,7 +1797,7 @@ async def debug_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
         file_id = latest_file['id']
         
         # Проверяем данные доходов
-        income_recs = db.list_income_records(file_id)
+        income_recs = await adb.list_income_records(file_id)
         
         msg = f"🔍 Отладка данных файла: {latest_file['file_name']}\n"
         msg += f"File ID: {file_id}\n\n"
@@ -2074,6 +1809,34 @@ async def debug_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if len(income_recs) > 5:
             msg += f"... и ещё {len(income_recs) - 5} записей\n"
         
+        pool_stats = db.pool_stats()
+        msg += (
+            f"\n🔌 Пул подключений движков: занято {pool_stats['in_use']}/{pool_stats['max_size']}, "
+            f"свободно {pool_stats['idle']}\n"
+            f"Ожиданий: {pool_stats['waits']}, время ожидания: {pool_stats['wait_time_total']:.2f} с "
+            f"(макс. {pool_stats['wait_time_max']:.2f} с), таймаутов: {pool_stats['timeouts']}\n"
+        )
+        statement_stats = db.statement_stats()
+        msg += (
+            f"Подготовленные запросы: {statement_stats['statements']}, "
+            f"подготовок {statement_stats['prepared']}, повторных выполнений {statement_stats['reused']}\n"
+        )
+        
+        worker_stats = pools.stats()
+        msg += (
+            f"\n⚙️ Разбор файлов: в работе {worker_stats['cpu_in_flight']}, "
+            f"в очереди {worker_stats['cpu_waiting']} (процессов: {worker_stats['process_workers']})\n"
+            f"Запросы движков к БД и выгрузки: в работе {worker_stats['blocking_in_flight']}, "
+            f"в очереди {worker_stats['blocking_waiting']} (потоков: {worker_stats['thread_workers']})\n"
+        )
+        db_stats = adb.stats()
+        msg += (
+            f"\n⚡ Пул подключений обработчиков: открыто {db_stats['size']}/{db_stats['max_size']}, "
+            f"свободно {db_stats['idle']}\n"
+            f"Запросы обработчиков: в работе {db_stats['in_flight']} (макс. {db_stats['max_in_flight']}), "
+            f"всего {db_stats['calls']}, таймаутов: {db_stats['timeouts']}\n"
+        )
+        
         await update.message.reply_text(msg)
         
     except Exception as e:
@@ -2130,197 +1893,80 @@ async def show_excel_structure(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
-async def reprocess_all_files(query, context: ContextTypes.DEFAULT_TYPE):
-    """Переобработать все загруженные файлы пользователя с новыми парсерами"""
+def build_reprocess_summary(result: Dict[str, Any]) -> str:
+    """Итоговое сообщение по переобработке файлов"""
+    if not result.get('total'):
+        return "📭 У вас нет загруженных файлов"
+    result_msg = f"✅ Переобработка завершена!\n\n"
+    result_msg += f"📊 Обработано файлов: {result['done']}\n"
+    if result['cached'] > 0:
+        result_msg += f"♻️ Из кэша разбора: {result['cached']}\n"
+    if result['skipped'] > 0:
+        result_msg += f"⏭ Без изменений (уже разобраны текущей версией): {result['skipped']}\n"
+    if result['error'] > 0:
+        result_msg += f"❌ Ошибок: {result['error']}\n"
+    result_msg += f"⏱ Время: {result['elapsed']:.0f} с\n"
+    result_msg += f"\nВсе данные обновлены, включая ТАКСИ."
+    return result_msg
+
+
+async def reprocess_all_files(query, context: ContextTypes.DEFAULT_TYPE, force: bool = False):
+    """
+    Переобработать все загруженные файлы пользователя с новыми парсерами
+
+    force - переобработать и файлы, уже разобранные текущей версией парсера
+    """
     if not user_is_authorized(query.from_user.id, context):
         await request_password(query.message, context)
         return
     
     try:
         user_id = query.from_user.id
+        processing_msg = None
         
-        # Получаем все файлы пользователя
-        with db.get_connection() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
-                    """
-                    SELECT id, file_name, row_count, report_date, club_name
-                    FROM uploaded_files
-                    WHERE user_id = %s
-                    ORDER BY upload_date DESC
-                    """,
-                    (user_id,)
-                )
-                files = cur.fetchall()
+        async def show_progress(progress: Dict[str, Any]):
+            nonlocal processing_msg
+            text = build_reprocess_progress(progress)
+            if processing_msg is None:
+                processing_msg = await query.message.reply_text(text)
+            else:
+                await processing_msg.edit_text(text)
         
-        if not files:
-            await query.answer("📭 У вас нет загруженных файлов")
+        if INGEST_MODE == 'queue':
+            # Переобработку выполняет воркер; прогресс и итог показывает notify_finished_jobs
+            if await adb.get_active_job('reprocess', user_id):
+                await query.answer("⏳ Переобработка уже выполняется")
+                return
+            processing_msg = await query.message.reply_text("⏳ Переобработка поставлена в очередь...")
+            await adb.enqueue_job(
+                'reprocess',
+                user_id,
+                payload={'force': force},
+                chat_id=query.message.chat_id,
+                message_id=processing_msg.message_id
+            )
+            await query.answer("⏳ Переобработка поставлена в очередь")
+            return
+
+        try:
+            result = await reprocess_engine.run(user_id, on_progress=show_progress, force=force)
+        except ReprocessAlreadyRunningError:
+            await query.answer("⏳ Переобработка уже выполняется")
             return
         
-        processing_msg = await query.message.reply_text(f"🔄 Переобработка {len(files)} файлов...")
-        
-        processed_count = 0
-        errors_count = 0
-        
-        for file_info in files:
-            file_id = file_info['id']
-            file_name = file_info['file_name']
-            
-            try:
-                # Читаем содержимое файла из базы
-                with db.get_connection() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute("SELECT file_content FROM uploaded_files WHERE id = %s", (file_id,))
-                        result = cur.fetchone()
-                        if not result or not result[0]:
-                            logger.warning(f"File {file_id} has no content, skipping")
-                            errors_count += 1
-                            continue
-                        file_content = result[0]
-                
-                logger.info(f"Reprocessing file_id={file_id}, file_name={file_name}")
-                
-                # Переобрабатываем все блоки (как при загрузке файла)
-                file_content_bytes = bytes(file_content)
-                
-                # Доходы
-                income_records = excel_processor.extract_income_records(file_content_bytes)
-                if income_records:
-                    db.save_income_records(file_id, income_records)
-                
-                # Входные билеты
-                ticket_sales_data = excel_processor.extract_ticket_sales(file_content_bytes)
-                if ticket_sales_data.get('records'):
-                    db.save_ticket_sales(file_id, ticket_sales_data['records'])
-                
-                # Типы оплат
-                payment_types_data = excel_processor.extract_payment_types(file_content_bytes)
-                if payment_types_data.get('records'):
-                    db.save_payment_types(file_id, payment_types_data['records'])
-                
-                # Статистика персонала
-                staff_stats = excel_processor.extract_staff_statistics(file_content_bytes)
-                if staff_stats:
-                    db.save_staff_statistics(file_id, staff_stats)
-                
-                # Расходы
-                expense_data = excel_processor.extract_expense_records(file_content_bytes)
-                if expense_data.get('records'):
-                    db.save_expense_records(file_id, expense_data['records'])
-                
-                # Долги по персоналу
-                staff_debts_data = excel_processor.extract_staff_debts(file_content_bytes)
-                if staff_debts_data.get('records'):
-                    db.save_staff_debts(file_id, staff_debts_data['records'])
-                
-                # Инкассация
-                cash_collection_data = excel_processor.extract_cash_collection(file_content_bytes)
-                if cash_collection_data.get('records'):
-                    db.save_cash_collection(file_id, cash_collection_data['records'])
-                
-                # Примечания
-                notes_data = excel_processor.extract_notes_entries(file_content_bytes)
-                if notes_data:
-                    notes_records = []
-                    for entry in notes_data.get('безнал', []):
-                        notes_records.append({
-                            'category': entry.get('category', 'безнал'),
-                            'entry_text': entry.get('entry_text', ''),
-                            'is_total': entry.get('is_total', False),
-                            'amount': entry.get('amount')
-                        })
-                    for entry in notes_data.get('нал', []):
-                        notes_records.append({
-                            'category': entry.get('category', 'нал'),
-                            'entry_text': entry.get('entry_text', ''),
-                            'is_total': entry.get('is_total', False),
-                            'amount': entry.get('amount')
-                        })
-                    for text in notes_data.get('extra', []):
-                        notes_records.append({
-                            'category': 'прочее',
-                            'entry_text': text,
-                            'is_total': False,
-                            'amount': None
-                        })
-                    if notes_records:
-                        db.save_notes_entries(file_id, notes_records)
-                
-                # Итого
-                totals_summary = excel_processor.extract_totals_summary(file_content_bytes)
-                if totals_summary:
-                    db.save_totals_summary(file_id, totals_summary)
-                
-                # ТАКСИ (новый парсер)
-                taxi_data = excel_processor.extract_taxi_expenses(file_content_bytes)
-                taxi_amount = taxi_data.get('taxi_amount', Decimal('0.00'))
-                taxi_percent_amount = taxi_data.get('taxi_percent_amount', Decimal('0.00'))
-                deposits_total = taxi_data.get('deposits_total', Decimal('0.00'))
-                total_amount = taxi_amount + taxi_percent_amount + deposits_total
-                db.save_taxi_expenses(file_id, taxi_amount, taxi_percent_amount, deposits_total, total_amount)
-                
-                # Прочие расходы
-                misc_expenses_text = excel_processor.extract_misc_expenses_from_notes_after_total(file_content_bytes)
-                if misc_expenses_text:
-                    parsed_expenses = []
-                    for line in misc_expenses_text.split('\n'):
-                        line = line.strip()
-                        if not line or line.lower().startswith('итого'):
-                            continue
-                        
-                        number_pattern = r'\d+(?:[.,]\d+)*'
-                        number_positions = []
-                        for match in re.finditer(number_pattern, line):
-                            start_pos = match.start()
-                            end_pos = match.end()
-                            number_str = match.group(0)
-                            number_positions.append((start_pos, end_pos, number_str))
-                        
-                        for i, (start_pos, end_pos, number_str) in enumerate(number_positions):
-                            after_number = line[end_pos:].lstrip()
-                            if not after_number.startswith('-'):
-                                continue
-                            
-                            dash_pos = end_pos + len(line[end_pos:]) - len(after_number)
-                            expense_end = len(line)
-                            
-                            for j in range(i + 1, len(number_positions)):
-                                next_start, next_end, next_number = number_positions[j]
-                                after_next = line[next_end:].lstrip()
-                                if after_next.startswith('-'):
-                                    expense_end = next_start
-                                    break
-                            
-                            expense_item = line[dash_pos + 1:expense_end].strip()
-                            amount_clean = number_str.replace('.', '').replace(',', '').replace(' ', '')
-                            
-                            try:
-                                amount = Decimal(amount_clean)
-                                parsed_expenses.append({
-                                    'expense_item': expense_item,
-                                    'amount': amount,
-                                    'is_total': False
-                                })
-                            except (ValueError, InvalidOperation):
-                                continue
-                    
-                    if parsed_expenses:
-                        db.save_misc_expenses_records(file_id, parsed_expenses)
-                
-                processed_count += 1
-                logger.info(f"File {file_id} ({file_name}) reprocessed successfully")
-                
-            except Exception as e:
-                logger.error(f"Error reprocessing file {file_id} ({file_name}): {e}", exc_info=True)
-                errors_count += 1
+        if not result:
+            if processing_msg is not None:
+                await processing_msg.edit_text("📭 У вас нет загруженных файлов")
+            await query.answer("📭 У вас нет загруженных файлов")
+            return
         
-        result_msg = f"✅ Переобработка завершена!\n\n"
-        result_msg += f"📊 Обработано файлов: {processed_count}\n"
-        if errors_count > 0:
-            result_msg += f"❌ Ошибок: {errors_count}\n"
-        result_msg += f"\nВсе данные обновлены, включая ТАКСИ."
+        period_report_cache.invalidate()
+        result_msg = build_reprocess_summary(result)
         
-        await processing_msg.edit_text(result_msg)
+        if processing_msg is None:
+            await query.message.reply_text(result_msg)
+        else:
+            await processing_msg.edit_text(result_msg)
         await query.answer("✅ Готово!")
         
     except Exception as e:
@@ -2338,19 +1984,7 @@ async def reprocess_last_file(update: Update, context: ContextTypes.DEFAULT_TYPE
         user_id = update.effective_user.id
         
         # Получаем последний файл пользователя
-        with db.get_connection() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
-                    """
-                    SELECT id, file_name, row_count, report_date
-                    FROM uploaded_files
-                    WHERE user_id = %s
-                    ORDER BY upload_date DESC
-                    LIMIT 1
-                    """,
-                    (user_id,)
-                )
-                file_info = cur.fetchone()
+        file_info = await adb.get_latest_user_file(user_id)
         
         if not file_info:
             await update.message.reply_text("📭 У вас нет загруженных файлов")
@@ -2360,28 +1994,26 @@ async def reprocess_last_file(update: Update, context: ContextTypes.DEFAULT_TYPE
         file_name = file_info['file_name']
         
         # Читаем содержимое файла из базы
-        with db.get_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT file_content FROM uploaded_files WHERE id = %s", (file_id,))
-                result = cur.fetchone()
-                if not result or not result[0]:
-                    await update.message.reply_text("❌ Не удалось получить содержимое файла")
-                    return
-                file_content = result[0]
+        file_content = await adb.get_file_content(file_id)
+        if not file_content:
+            await update.message.reply_text("❌ Не удалось получить содержимое файла")
+            return
         
         await update.message.reply_text(f"🔄 Переобработка файла {file_name}...")
         
-        # Переобрабатываем все блоки
-        income_records = excel_processor.extract_income_records(file_content)
+        # Переобрабатываем все блоки в пуле процессов
+        blocks = await pools.run_cpu(executors.extract_report_blocks, bytes(file_content))
+        income_records = blocks['income']
         if income_records:
-            db.save_income_records(file_id, income_records)
+            await adb.save_income_records(file_id, income_records)
             await update.message.reply_text(f"✅ Доходы: {len(income_records)} записей")
         
-        ticket_sales_data = excel_processor.extract_ticket_sales(file_content)
+        ticket_sales_data = blocks['tickets']
         if ticket_sales_data.get('records'):
-            db.save_ticket_sales(file_id, ticket_sales_data['records'])
+            await adb.save_ticket_sales(file_id, ticket_sales_data['records'])
             await update.message.reply_text(f"✅ Входные билеты: {len(ticket_sales_data['records'])} записей, итого: {ticket_sales_data.get('total_amount', 0)}")
         
+        period_report_cache.invalidate(file_info.get('club_name'), file_info.get('report_date'))
         await update.message.reply_text("✅ Переобработка завершена! Теперь данные должны отображаться правильно.")
         
     except Exception as e:
@@ -2445,11 +2077,16 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
+    # Архив отчетов загружается целиком
+    if document.file_name and document.file_name.lower().endswith('.zip'):
+        await handle_report_archive(update, context, current_club)
+        return
+
     # Проверка формата файла
     if not excel_processor.validate_file(document.file_name):
         await update.message.reply_text(
             "❌ Неподдерживаемый формат файла!\n"
-            "Поддерживаются: .xlsx, .xls, .xlsm, .csv"
+            "Поддерживаются: .xlsx, .xls, .xlsm, .csv и .zip архив отчётов"
         )
         return
     
@@ -2459,243 +2096,208 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # Скачивание файла
         file = await context.bot.get_file(document.file_id)
-        file_content = await file.download_as_bytearray()
+        file_content = bytes(await file.download_as_bytearray())
 
         caption_text = update.message.caption if update.message else None
         report_date = parse_report_date_from_text(caption_text) if caption_text else None
 
-        # Обработка Excel файла
-        data, stats = excel_processor.process_file(bytes(file_content), document.file_name)
-        
-        # Сохранение в БД с указанием клуба
-        file_id = db.save_uploaded_file(
+        if INGEST_MODE == 'queue':
+            # Разбор выполняет воркер (worker.py); результат сообщает notify_finished_jobs
+            await adb.enqueue_job(
+                'upload',
+                user.id,
+                payload={
+                    'username': user.username or user.first_name,
+                    'club_name': current_club,
+                    'file_name': document.file_name,
+                    'report_date': report_date.isoformat() if report_date else None,
+                },
+                file_content=file_content,
+                chat_id=update.effective_chat.id,
+                message_id=processing_msg.message_id
+            )
+            await processing_msg.edit_text("⏳ Файл поставлен в очередь на обработку...")
+            return
+
+        result = await ingest_report(
+            db,
+            pools,
             user_id=user.id,
             username=user.username or user.first_name,
+            club_name=current_club,
             file_name=document.file_name,
-            file_content=bytes(file_content),
-            row_count=len(data),
-            report_date=report_date,
-            club_name=current_club
+            file_content=file_content,
+            report_date=report_date
         )
-        
-        db.save_excel_data(file_id, data)
 
-        # Собираем все сообщения о блоках в один список
-        summary_lines = []
-        
-        income_records = excel_processor.extract_income_records(bytes(file_content))
+        period_report_cache.invalidate(current_club, result['report_date'])
+        await processing_msg.edit_text(build_upload_reply(result, current_club))
+        await send_upload_followup(context.bot, update.effective_chat.id, context.user_data, result)
+    
+    except Exception as e:
+        logger.error(f"Error processing document: {e}")
+        await processing_msg.edit_text(
+            f"❌ Ошибка при обработке файла:\n{str(e)}"
+        )
+
+
+def build_upload_summary(blocks: Dict[str, Any]) -> str:
+    """Итоговое сообщение по блокам разобранного отчета"""
+    # Собираем все сообщения о блоках в один список
+    summary_lines = []
+    
+    income_records = blocks.get('income') or []
+    if income_records:
+        income_total = next(
+            (record['amount'] for record in income_records if record['category'].strip().lower() == 'итого за смену'),
+            None
+        )
+        if income_total is not None:
+            total_str = format(income_total, '0.0f')
+            summary_lines.append(f"💰 Блок 'Доходы' обработан. Итог за смену: {total_str}")
+ 
+    ticket_sales_data = blocks.get('tickets') or {}
+    if ticket_sales_data.get('records'):
+        ticket_total_amount = ticket_sales_data.get('total_amount')
+
+        if ticket_total_amount is not None:
+            tickets_total_str = format(ticket_total_amount, '0.0f')
+            summary_lines.append(f"🎟 Блок 'Входные билеты' обработан. Итого сумма: {tickets_total_str}")
+
+    payment_types_data = blocks.get('payments') or {}
+    if payment_types_data.get('records'):
+        payment_total = payment_types_data.get('reported_total') or Decimal('0.00')
+        cash_total = payment_types_data.get('cash_total')
+        
+        msg_lines = ["💳 Блок 'Типы оплат' обработан."]
+        if cash_total is not None:
+            msg_lines.append(f"Итого касса: {format(cash_total, '0.0f')}")
+        msg_lines.append(f"Итого: {format(payment_total, '0.0f')}")
+        summary_lines.append("\n".join(msg_lines))
+
+    staff_stats = blocks.get('staff') or []
+    if staff_stats:
+        total_staff = sum(item.get('staff_count', 0) for item in staff_stats)
+        summary_lines.append(
+            "👥 Блок 'Статистика персонала' обработан.\n"
+            f"Всего персонала на смене: {total_staff}"
+        )
+ 
+    expense_data = blocks.get('expenses') or {}
+    if expense_data.get('records'):
+        expenses_total = expense_data.get('reported_total') or Decimal('0.00')
+        income_total = None
         if income_records:
-            db.save_income_records(file_id, income_records)
             income_total = next(
-                (record['amount'] for record in income_records if record['category'].strip().lower() == 'итого за смену'),
+                (record['amount'] for record in income_records if record['category'].strip().lower() == 'итого'),
                 None
             )
-            if income_total is not None:
-                total_str = format(income_total, '0.0f')
-                summary_lines.append(f"💰 Блок 'Доходы' обработан. Итог за смену: {total_str}")
- 
-        ticket_sales_data = excel_processor.extract_ticket_sales(bytes(file_content))
-        if ticket_sales_data.get('records'):
-            db.save_ticket_sales(file_id, ticket_sales_data['records'])
 
-            ticket_total_amount = ticket_sales_data.get('total_amount')
+        msg_lines = ["💸 Блок 'Расходы' обработан."]
+        msg_lines.append(f"Итого расходы: {format(expenses_total, '0.0f')}")
 
-            if ticket_total_amount is not None:
-                tickets_total_str = format(ticket_total_amount, '0.0f')
-                summary_lines.append(f"🎟 Блок 'Входные билеты' обработан. Итого сумма: {tickets_total_str}")
+        if income_total is not None:
+            balance = income_total - expenses_total
+            msg_lines.append(f"Финансовый результат (Итого доходы - Расходы): {format(balance, '0.0f')}")
 
-        payment_types_data = excel_processor.extract_payment_types(bytes(file_content))
-        if payment_types_data.get('records'):
-            db.save_payment_types(file_id, payment_types_data['records'])
+        summary_lines.append("\n".join(msg_lines))
 
-            payment_total = payment_types_data.get('reported_total') or Decimal('0.00')
-            cash_total = payment_types_data.get('cash_total')
-            
-            msg_lines = ["💳 Блок 'Типы оплат' обработан."]
-            if cash_total is not None:
-                msg_lines.append(f"Итого касса: {format(cash_total, '0.0f')}")
-            msg_lines.append(f"Итого: {format(payment_total, '0.0f')}")
-            summary_lines.append("\n".join(msg_lines))
-
-        staff_stats = excel_processor.extract_staff_statistics(bytes(file_content))
-        if staff_stats:
-            db.save_staff_statistics(file_id, staff_stats)
-            total_staff = sum(item.get('staff_count', 0) for item in staff_stats)
-            summary_lines.append(
-                "👥 Блок 'Статистика персонала' обработан.\n"
-                f"Всего персонала на смене: {total_staff}"
-            )
+    staff_debts_data = blocks.get('debts') or {}
+    if staff_debts_data.get('records'):
+        debts_total = staff_debts_data.get('reported_total') or Decimal('0.00')
+        summary_lines.append(
+            "📌 Блок 'Долги по персоналу' обработан.\n"
+            f"Итого задолженность: {format(debts_total, '0.0f')}"
+        )
  
-        expense_data = excel_processor.extract_expense_records(bytes(file_content))
-        if expense_data.get('records'):
-            db.save_expense_records(file_id, expense_data['records'])
-
-            expenses_total = expense_data.get('reported_total') or Decimal('0.00')
-            income_total = None
-            if income_records:
-                income_total = next(
-                    (record['amount'] for record in income_records if record['category'].strip().lower() == 'итого'),
-                    None
-                )
-
-            msg_lines = ["💸 Блок 'Расходы' обработан."]
-            msg_lines.append(f"Итого расходы: {format(expenses_total, '0.0f')}")
-
-            if income_total is not None:
-                balance = income_total - expenses_total
-                msg_lines.append(f"Финансовый результат (Итого доходы - Расходы): {format(balance, '0.0f')}")
-
-            summary_lines.append("\n".join(msg_lines))
+    cash_collection_data = blocks.get('cash') or {}
+    if cash_collection_data.get('records'):
+        collection_total = cash_collection_data.get('reported_total') or Decimal('0.00')
+        summary_lines.append(
+            "🏦 Блок 'Инкассация' обработан.\n"
+            f"Итого наличных после смены: {format(collection_total, '0.0f')}"
+        )
+ 
+    if blocks.get('notes'):
+        summary_lines.append("📝 Блок 'Примечание' сохранён.")
 
-        # Парсим и сохраняем «Прочие расходы» при загрузке файла
-        try:
-            logger.info(f"=== Parsing misc expenses on file upload for file_id={file_id} ===")
-            misc_expenses_text = excel_processor.extract_misc_expenses_from_notes_after_total(bytes(file_content))
-            parsed_expenses = []
-            if misc_expenses_text:
-                for line in misc_expenses_text.split('\n'):
-                    line = line.strip()
-                    if not line or line.lower().startswith('итого'):
-                        continue
-                    # Ищем все числа и пары "сумма-статья" в одной строке
-                    number_pattern = r'\d+(?:[.,]\d+)*'
-                    number_positions = []
-                    for match in re.finditer(number_pattern, line):
-                        start_pos = match.start()
-                        end_pos = match.end()
-                        number_str = match.group(0)
-                        number_positions.append((start_pos, end_pos, number_str))
-                    for i, (start_pos, end_pos, number_str) in enumerate(number_positions):
-                        after_number = line[end_pos:].lstrip()
-                        if not after_number.startswith('-'):
-                            continue
-                        dash_pos = end_pos + len(line[end_pos:]) - len(after_number)
-                        expense_end = len(line)
-                        # обрезаем по следующему числу с дефисом
-                        for j in range(i + 1, len(number_positions)):
-                            next_start, next_end, _ = number_positions[j]
-                            after_next = line[next_end:].lstrip()
-                            if after_next.startswith('-'):
-                                expense_end = next_start
-                                break
-                        expense_item = line[dash_pos + 1:expense_end].strip()
-                        amount_clean = number_str.replace('.', '').replace(',', '').replace(' ', '')
-                        try:
-                            amount = Decimal(amount_clean)
-                            parsed_expenses.append({
-                                'expense_item': expense_item,
-                                'amount': amount,
-                                'is_total': False
-                            })
-                        except (ValueError, InvalidOperation):
-                            continue
-            if parsed_expenses:
-                db.save_misc_expenses_records(file_id, parsed_expenses)
-                logger.info(f"Saved {len(parsed_expenses)} misc expense items for file_id={file_id}")
-        except Exception as e:
-            logger.error(f"Error parsing misc expenses on upload for file_id={file_id}: {e}", exc_info=True)
+    if blocks.get('totals'):
+        summary_lines.append("📊 Блок 'Итого' обработан.")
 
-        # Парсим и сохраняем данные по такси при загрузке файла
-        logger.info(f"=== Parsing taxi expenses on file upload for file_id={file_id} ===")
-        taxi_data = excel_processor.extract_taxi_expenses(bytes(file_content))
-        logger.info(f"Taxi data extracted: {taxi_data}")
-        
-        taxi_amount = taxi_data.get('taxi_amount', Decimal('0.00'))
-        taxi_percent_amount = taxi_data.get('taxi_percent_amount', Decimal('0.00'))
-        deposits_total = taxi_data.get('deposits_total', Decimal('0.00'))
-        total_amount = taxi_amount + taxi_percent_amount + deposits_total
-        
-        # Сохраняем данные по такси в БД
-        db.save_taxi_expenses(file_id, taxi_amount, taxi_percent_amount, deposits_total, total_amount)
-        logger.info(f"Taxi expenses saved: taxi={taxi_amount}, taxi_percent={taxi_percent_amount}, deposits={deposits_total}, total={total_amount}")
+    return "✅ Файл успешно обработан и сохранен!\n\n" + "\n\n".join(summary_lines)
 
-        staff_debts_data = excel_processor.extract_staff_debts(bytes(file_content))
-        if staff_debts_data.get('records'):
-            db.save_staff_debts(file_id, staff_debts_data['records'])
 
-            debts_total = staff_debts_data.get('reported_total') or Decimal('0.00')
-            summary_lines.append(
-                "📌 Блок 'Долги по персоналу' обработан.\n"
-                f"Итого задолженность: {format(debts_total, '0.0f')}"
-            )
-        else:
-            staff_debts_data = {}
- 
-        cash_collection_data = excel_processor.extract_cash_collection(bytes(file_content))
-        if cash_collection_data.get('records'):
-            db.save_cash_collection(file_id, cash_collection_data['records'])
- 
-            collection_total = cash_collection_data.get('reported_total') or Decimal('0.00')
-            summary_lines.append(
-                "🏦 Блок 'Инкассация' обработан.\n"
-                f"Итого наличных после смены: {format(collection_total, '0.0f')}"
-            )
- 
-        notes_data = excel_processor.extract_notes_entries(bytes(file_content))
-        if notes_data:
-            notes_records = []
-
-            for entry in notes_data.get('безнал', []):
-                notes_records.append({
-                    'category': entry.get('category', 'безнал'),
-                    'entry_text': entry.get('entry_text', ''),
-                    'is_total': entry.get('is_total', False),
-                    'amount': entry.get('amount')
-                })
+def build_upload_reply(result: Dict[str, Any], club_name: str) -> str:
+    """Сообщение по результату ingest_report (в том числе для повторно загруженного файла)"""
+    if result['duplicate']:
+        date_text = format_report_date(result['report_date']) if result['report_date'] else "не указана"
+        return (
+            "♻️ Этот файл уже загружен для клуба "
+            f"{club_name} ({result['file_name']}, дата отчёта: {date_text}).\n"
+            "Повторный разбор не нужен - используются сохранённые данные."
+        )
+    return build_upload_summary(result.get('blocks') or {})
 
-            for entry in notes_data.get('нал', []):
-                notes_records.append({
-                    'category': entry.get('category', 'нал'),
-                    'entry_text': entry.get('entry_text', ''),
-                    'is_total': entry.get('is_total', False),
-                    'amount': entry.get('amount')
-                })
 
-            for text in notes_data.get('extra', []):
-                notes_records.append({
-                    'category': 'прочее',
-                    'entry_text': text,
-                    'is_total': False,
-                    'amount': None
-                })
+def build_bulk_upload_summary(result: Dict[str, Any], club_name: str) -> str:
+    """Итоговое сообщение по загрузке архива"""
+    lines = [
+        f"📦 Архив обработан для клуба {club_name}",
+        f"Файлов в архиве: {result['total']}",
+        f"✅ Сохранено отчётов: {len(result['saved'])}",
+    ]
+    if result['saved']:
+        dates = [report_date for _, report_date, _ in result['saved']]
+        lines.append(f"📅 Даты: {format_report_date(min(dates))} — {format_report_date(max(dates))}")
+    if result['duplicates']:
+        lines.append(f"♻️ Уже были загружены: {len(result['duplicates'])}")
+    if result['errors']:
+        lines.append(f"❌ Ошибки: {len(result['errors'])}")
+        lines.append("")
+        for file_name, error in result['errors'][:MAX_ERRORS_IN_SUMMARY]:
+            lines.append(f"• {file_name}: {error}")
+        if len(result['errors']) > MAX_ERRORS_IN_SUMMARY:
+            lines.append(f"… и ещё {len(result['errors']) - MAX_ERRORS_IN_SUMMARY}")
+    lines.append("")
+    lines.append(f"⏱ {result['elapsed']:.1f} с")
+    return "\n".join(lines)[:4000]
 
-            if notes_records:
-                db.save_notes_entries(file_id, notes_records)
 
-            summary_lines.append("📝 Блок 'Примечание' сохранён.")
+async def handle_report_archive(update: Update, context: ContextTypes.DEFAULT_TYPE, current_club: str):
+    """Загрузка ZIP архива с отчетами: параллельный разбор и одно итоговое сообщение"""
+    document = update.message.document
+    user = update.effective_user
+    processing_msg = await update.message.reply_text("⏳ Распаковываю архив...")
 
-        totals_summary = excel_processor.extract_totals_summary(bytes(file_content))
-        if totals_summary:
-            db.save_totals_summary(file_id, totals_summary)
-            summary_lines.append("📊 Блок 'Итого' обработан.")
+    async def show_progress(progress: Dict[str, Any]):
+        if not progress['total']:
+            return
+        await processing_msg.edit_text(
+            "⏳ Обрабатываю архив...\n"
+            f"Разобрано: {progress['parsed']}/{progress['total']}\n"
+            f"Сохранено: {progress['saved']}, ошибок: {progress['errors']}"
+        )
 
-        # Отправка единого сообщения с итогами по всем блокам
-        final_summary = "✅ Файл успешно обработан и сохранен!\n\n" + "\n\n".join(summary_lines)
-        await processing_msg.edit_text(final_summary)
-        
-        if report_date is None:
-            context.user_data['awaiting_report_date'] = {'file_id': file_id}
-            await update.message.reply_text(
-                "🗓 Укажите дату отчёта в формате ГГГГ-ММ-ДД или ДД.ММ.ГГГГ"
-            )
+    try:
+        file = await context.bot.get_file(document.file_id)
+        archive_content = bytes(await file.download_as_bytearray())
 
-        # Предложение действий
-        keyboard = [
-            [InlineKeyboardButton("📊 Мои файлы", callback_data="my_files")],
-            [InlineKeyboardButton("🔍 Задать вопрос", callback_data="ask_question")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(
-            "Что дальше?",
-            reply_markup=reply_markup
+        result = await bulk_upload_engine.run(
+            user_id=user.id,
+            username=user.username or user.first_name,
+            club_name=current_club,
+            archive_content=archive_content,
+            caption=update.message.caption,
+            on_progress=show_progress
         )
-    
+        if result['saved'] or result['duplicates']:
+            period_report_cache.invalidate(current_club)
+        await processing_msg.edit_text(build_bulk_upload_summary(result, current_club))
+    except ArchiveError as e:
+        await processing_msg.edit_text(f"❌ {e}")
     except Exception as e:
-        logger.error(f"Error processing document: {e}")
-        await processing_msg.edit_text(
-            f"❌ Ошибка при обработке файла:\n{str(e)}"
-        )
+        logger.error(f"Error processing report archive: {e}", exc_info=True)
+        await processing_msg.edit_text(f"❌ Ошибка при обработке архива:\n{str(e)}")
 
 
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2724,7 +2326,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             return
 
-        db.set_uploaded_file_report_date(pending['file_id'], report_date)
+        await adb.set_uploaded_file_report_date(pending['file_id'], report_date)
+        # Файл переходит из одного периода в другой
+        period_report_cache.invalidate()
         context.user_data.pop('awaiting_report_date', None)
         await update.message.reply_text(
             f"🗓 Дата отчёта установлена: {format_report_date(report_date)}"
@@ -2880,7 +2484,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             if block_id == 'full':
                 processing_msg = await update.message.reply_text("⏳ Формирую ПОЛНЫЙ комплексный отчет за период...")
                 
-                all_blocks = await generate_full_period_report(club_name, start_date, end_date)
+                all_blocks = await cached_period_report(block_id, generate_full_period_report, club_name, start_date, end_date)
                 
                 if not all_blocks:
                     await processing_msg.edit_text(
@@ -2898,7 +2502,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await processing_msg.edit_text("\n".join(lines))
                 
                 # Отправляем Excel файл
-                excel_bytes = excel_processor.export_full_period_report_to_excel(
+                excel_bytes = await cached_period_excel(
+                    block_id, club_name, start_date, end_date, all_blocks,
+                    excel_processor.export_full_period_report_to_excel,
                     all_blocks, club_name, start_date, end_date
                 )
                 
@@ -2912,7 +2518,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             elif block_id == 'debts':
                 processing_msg = await update.message.reply_text("⏳ Формирую сводный отчет по долгам персонала...")
                 
-                result = await generate_staff_debts_period_report(club_name, start_date, end_date)
+                result = await cached_period_report(block_id, generate_staff_debts_period_report, club_name, start_date, end_date)
                 
                 if not result:
                     await processing_msg.edit_text(
@@ -2937,7 +2543,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await processing_msg.edit_text("\n".join(lines))
                 
                 # Отправляем Excel файл
-                excel_bytes = excel_processor.export_period_report_to_excel(
+                excel_bytes = await cached_period_excel(
+                    block_id, club_name, start_date, end_date, result,
+                    excel_processor.export_period_report_to_excel,
                     report_data, club_name, start_date, end_date, "Долги по персоналу"
                 )
                 
@@ -2951,7 +2559,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             elif block_id == 'cash':
                 processing_msg = await update.message.reply_text("⏳ Формирую сводный отчет по инкассации...")
                 
-                result = await generate_cash_collection_period_report(club_name, start_date, end_date)
+                result = await cached_period_report(block_id, generate_cash_collection_period_report, club_name, start_date, end_date)
                 
                 if not result:
                     await processing_msg.edit_text(
@@ -2981,7 +2589,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await processing_msg.edit_text("\n".join(lines))
                 
                 # Отправляем Excel файл
-                excel_bytes = excel_processor.export_period_report_to_excel(
+                excel_bytes = await cached_period_excel(
+                    block_id, club_name, start_date, end_date, result,
+                    excel_processor.export_period_report_to_excel,
                     report_data, club_name, start_date, end_date, "Инкассация"
                 )
                 
@@ -2995,7 +2605,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             elif block_id == 'expenses':
                 processing_msg = await update.message.reply_text("⏳ Формирую сводный отчет по расходам...")
                 
-                result = await generate_expenses_period_report(club_name, start_date, end_date)
+                result = await cached_period_report(block_id, generate_expenses_period_report, club_name, start_date, end_date)
                 
                 if not result:
                     await processing_msg.edit_text(
@@ -3020,7 +2630,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await processing_msg.edit_text("\n".join(lines))
                 
                 # Отправляем Excel файл
-                excel_bytes = excel_processor.export_period_report_to_excel(
+                excel_bytes = await cached_period_excel(
+                    block_id, club_name, start_date, end_date, result,
+                    excel_processor.export_period_report_to_excel,
                     report_data, club_name, start_date, end_date, "Расходы"
                 )
                 
@@ -3034,7 +2646,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             elif block_id == 'staff':
                 processing_msg = await update.message.reply_text("⏳ Формирую сводный отчет по персоналу...")
                 
-                result = await generate_staff_statistics_period_report(club_name, start_date, end_date)
+                result = await cached_period_report(block_id, generate_staff_statistics_period_report, club_name, start_date, end_date)
                 
                 if not result:
                     await processing_msg.edit_text(
@@ -3059,7 +2671,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await processing_msg.edit_text("\n".join(lines))
                 
                 # Отправляем Excel файл
-                excel_bytes = excel_processor.export_period_report_to_excel(
+                excel_bytes = await cached_period_excel(
+                    block_id, club_name, start_date, end_date, result,
+                    excel_processor.export_period_report_to_excel,
                     report_data, club_name, start_date, end_date, "Статистика персонала"
                 )
                 
@@ -3073,7 +2687,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             elif block_id == 'payments':
                 processing_msg = await update.message.reply_text("⏳ Формирую сводный отчет по типам оплат...")
                 
-                result = await generate_payment_types_period_report(club_name, start_date, end_date)
+                result = await cached_period_report(block_id, generate_payment_types_period_report, club_name, start_date, end_date)
                 
                 if not result:
                     await processing_msg.edit_text(
@@ -3098,7 +2712,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await processing_msg.edit_text("\n".join(lines))
                 
                 # Отправляем Excel файл
-                excel_bytes = excel_processor.export_period_report_to_excel(
+                excel_bytes = await cached_period_excel(
+                    block_id, club_name, start_date, end_date, result,
+                    excel_processor.export_period_report_to_excel,
                     report_data, club_name, start_date, end_date, "Типы оплат"
                 )
                 
@@ -3112,7 +2728,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             elif block_id == 'tickets':
                 processing_msg = await update.message.reply_text("⏳ Формирую сводный отчет по входным билетам...")
                 
-                result = await generate_tickets_period_report(club_name, start_date, end_date)
+                result = await cached_period_report(block_id, generate_tickets_period_report, club_name, start_date, end_date)
                 
                 if not result:
                     await processing_msg.edit_text(
@@ -3138,7 +2754,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await processing_msg.edit_text("\n".join(lines))
                 
                 # Отправляем Excel файл
-                excel_bytes = excel_processor.export_period_report_to_excel(
+                excel_bytes = await cached_period_excel(
+                    block_id, club_name, start_date, end_date, result,
+                    excel_processor.export_period_report_to_excel,
                     report_data, club_name, start_date, end_date, "Входные билеты"
                 )
                 
@@ -3152,7 +2770,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             elif block_id == 'totals':
                 processing_msg = await update.message.reply_text("⏳ Формирую сводный отчет по итоговому балансу...")
                 
-                result = await generate_totals_summary_period_report(club_name, start_date, end_date)
+                result = await cached_period_report(block_id, generate_totals_summary_period_report, club_name, start_date, end_date)
                 
                 if not result:
                     await processing_msg.edit_text(
@@ -3179,7 +2797,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await processing_msg.edit_text("\n".join(lines))
                 
                 # Отправляем Excel файл
-                excel_bytes = excel_processor.export_period_report_to_excel(
+                excel_bytes = await cached_period_excel(
+                    block_id, club_name, start_date, end_date, result,
+                    excel_processor.export_period_report_to_excel,
                     report_data, club_name, start_date, end_date, "Итоговый баланс"
                 )
                 
@@ -3194,7 +2814,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 processing_msg = await update.message.reply_text("⏳ Формирую сводный отчет по такси...")
                 
                 # Получаем данные за период из БД
-                period_data = db.get_taxi_expenses_period(club_name, start_date, end_date)
+                period_data = await cached_period_report(
+                    block_id, adb.get_taxi_expenses_period, club_name, start_date, end_date
+                )
                 
                 taxi_amount = Decimal(str(period_data.get('total_taxi_amount', 0)))
                 taxi_percent_amount = Decimal(str(period_data.get('total_taxi_percent_amount', 0)))
@@ -3218,7 +2840,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                     {'Статья': 'ИТОГО', 'Сумма': decimal_to_float(total_amount)}
                 ]
                 
-                excel_bytes = excel_processor.export_period_report_to_excel(
+                excel_bytes = await cached_period_excel(
+                    block_id, club_name, start_date, end_date, period_data,
+                    excel_processor.export_period_report_to_excel,
                     report_data, club_name, start_date, end_date, "ТАКСИ"
                 )
                 
@@ -3233,7 +2857,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 processing_msg = await update.message.reply_text("⏳ Формирую сводный отчет по прочим расходам...")
                 
                 # Получаем данные за период из БД
-                misc_expenses = db.get_misc_expenses_period(club_name, start_date, end_date)
+                misc_expenses = await cached_period_report(
+                    block_id, adb.get_misc_expenses_period, club_name, start_date, end_date
+                )
                 
                 if not misc_expenses:
                     await processing_msg.edit_text(
@@ -3268,7 +2894,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await processing_msg.edit_text("\n".join(lines))
                 
                 # Формируем Excel файл
-                excel_bytes = excel_processor.export_period_report_to_excel(
+                excel_bytes = await cached_period_excel(
+                    block_id, club_name, start_date, end_date, misc_expenses,
+                    excel_processor.export_period_report_to_excel,
                     report_data, club_name, start_date, end_date, "Прочие расходы"
                 )
                 
@@ -3282,7 +2910,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             else:  # income (по умолчанию)
                 processing_msg = await update.message.reply_text("⏳ Формирую сводный отчет по доходам...")
                 
-                report_data = await generate_income_period_report(club_name, start_date, end_date)
+                report_data = await cached_period_report(block_id, generate_income_period_report, club_name, start_date, end_date)
                 
                 if not report_data:
                     await processing_msg.edit_text(
@@ -3301,7 +2929,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await processing_msg.edit_text("\n".join(lines))
                 
                 # Отправляем Excel файл
-                excel_bytes = excel_processor.export_period_report_to_excel(
+                excel_bytes = await cached_period_excel(
+                    block_id, club_name, start_date, end_date, report_data,
+                    excel_processor.export_period_report_to_excel,
                     report_data, club_name, start_date, end_date, "Доходы"
                 )
                 
@@ -3369,12 +2999,12 @@ def normalize_column_name(column: str) -> str:
 
 
 async def send_excel_record_count(target_message):
-    count = db.count_excel_records()
-    await target_message.reply_text(f"🔢 Записей в данных Excel: {count}")
+    count = await adb.count_sheet_rows()
+    await target_message.reply_text(f"🔢 Строк в данных Excel: {count}")
 
 
 async def send_recent_files(target_message):
-    files = db.list_recent_files()
+    files = await adb.list_recent_files()
 
     if not files:
         await target_message.reply_text(
@@ -3406,13 +3036,13 @@ def format_row_data(row_data: Dict[str, Any]) -> str:
 
 
 async def send_latest_records(target_message, limit: int = 5):
-    latest = db.get_latest_file()
+    latest = await adb.get_latest_file()
 
     if not latest:
         await target_message.reply_text("📭 Пока нет загруженных файлов")
         return
 
-    preview = db.get_file_preview(latest['id'], limit=limit)
+    preview = await adb.get_file_preview(latest['id'], limit=limit)
 
     if not preview:
         await target_message.reply_text("⚠️ Не удалось получить данные последнего файла")
@@ -3435,7 +3065,7 @@ async def send_latest_records(target_message, limit: int = 5):
 
 async def send_search_results(target_message, column: str, value: str):
     normalized_column = normalize_column_name(column)
-    matches = db.search_excel_by_column(normalized_column, value, limit=10)
+    matches = await adb.search_excel_by_column(normalized_column, value, limit=10)
 
     if not matches:
         await target_message.reply_text(
@@ -3509,7 +3139,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         club_name = data.split("|", 1)[1]
         
         # Получаем все даты для клуба
-        dates = db.get_report_dates(club_name=club_name)
+        dates = await adb.get_report_dates(club_name=club_name)
         
         if not dates:
             await query.message.reply_text(
@@ -3550,6 +3180,10 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     elif data == "files_reprocess_all":
         await query.answer("⏳ Начинаю переобработку всех файлов...")
         await reprocess_all_files(query, context)
+
+    elif data == "files_reprocess_all_force":
+        await query.answer("⏳ Начинаю переобработку всех файлов без пропуска...")
+        await reprocess_all_files(query, context, force=True)
     
     elif data == "files_clear":
         confirmation_keyboard = InlineKeyboardMarkup([
@@ -3563,7 +3197,8 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         )
 
     elif data == "files_clear_confirm":
-        deleted = db.clear_uploaded_files()
+        deleted = await adb.clear_uploaded_files()
+        period_report_cache.invalidate()
         await query.message.reply_text(
             f"🧼 Очистка завершена.\n"
             f"✅ Удалены все файлы и связанные данные\n"
@@ -3593,7 +3228,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         from datetime import timedelta
         
-        dates = db.get_report_dates(club_name=selected_club)
+        dates = await adb.get_report_dates(club_name=selected_club)
         if not dates:
             await query.message.reply_text(
                 f"📭 Нет отчётов для клуба {selected_club}",
@@ -3769,7 +3404,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
 
     elif data == "employee_search":
         context.user_data['employee_action'] = 'search'
-        await query.message.reply_text("🔍 Введите код сотрудника для поиска")
+        await query.message.reply_text("🔍 Введите код сотрудника или часть ФИО")
 
     elif data == "employee_list":
         await send_employee_list(query, context)
@@ -3859,7 +3494,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         username = query.from_user.username or query.from_user.full_name
         
         # Сохраняем в БД
-        db.add_off_shift_expense(
+        await adb.add_off_shift_expense(
             user_id=user_id,
             username=username,
             club_name=club_name,
@@ -3868,6 +3503,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             payment_type=payment_type,
             expense_date=expense_date
         )
+        period_report_cache.invalidate(club_name, expense_date)
         
         # Очищаем данные сессии
         context.user_data.pop('expense_action', None)
@@ -3972,7 +3608,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     
     elif data.startswith("edit_expense|"):
         expense_id = int(data.split("|", 1)[1])
-        expense = db.get_off_shift_expense_by_id(expense_id)
+        expense = await adb.get_off_shift_expense_by_id(expense_id)
         
         if not expense:
             await query.answer("❌ Расход не найден")
@@ -4014,7 +3650,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         expense_id = int(parts[1])
         field = parts[2]
         
-        expense = db.get_off_shift_expense_by_id(expense_id)
+        expense = await adb.get_off_shift_expense_by_id(expense_id)
         if not expense:
             await query.answer("❌ Расход не найден")
             return
@@ -4068,10 +3704,11 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         expense_id = int(parts[1])
         payment_type = parts[2]
         
-        success = db.update_off_shift_expense(expense_id, payment_type=payment_type)
+        success = await adb.update_off_shift_expense(expense_id, payment_type=payment_type)
         if success:
+            period_report_cache.invalidate()
             await query.answer("✅ Тип оплаты обновлен")
-            expense = db.get_off_shift_expense_by_id(expense_id)
+            expense = await adb.get_off_shift_expense_by_id(expense_id)
             expense_item = expense.get('expense_item', '')
             amount = decimal_to_str(expense.get('amount', 0))
             expense_date = format_report_date(expense.get('expense_date'))
@@ -4102,16 +3739,15 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     
     elif data.startswith("delete_expense|"):
         expense_id = int(data.split("|", 1)[1])
-        expense = db.get_off_shift_expense_by_id(expense_id)
+        expense = await adb.get_off_shift_expense_by_id(expense_id)
         
         if not expense:
             await query.answer("❌ Расход не найден")
             return
         
         # Удаляем из БД
-        with db.get_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("DELETE FROM off_shift_expenses WHERE id = %s", (expense_id,))
+        await adb.delete_off_shift_expense(expense_id)
+        period_report_cache.invalidate(expense.get('club_name'), expense.get('expense_date'))
         
         expense_item = expense.get('expense_item', '')
         await query.answer("✅ Расход удален")
@@ -4148,14 +3784,14 @@ async def handle_employee_text_action(update: Update, context: ContextTypes.DEFA
         await delete_employee_by_code(update, user_message)
 
     elif action == 'search':
-        await search_employee_by_code(update, user_message)
+        await search_employee(update, user_message)
 
     elif action == 'import_text':
         await import_employees_from_text(update, user_message)
 
     elif action == 'clear_confirm':
         if user_message.strip().upper() == 'УДАЛИТЬ ВСЕХ':
-            deleted = db.clear_employees()
+            deleted = await adb.clear_employees()
             await update.message.reply_text(
                 f"🧼 Удалено сотрудников: {deleted}")
         else:
@@ -4310,9 +3946,10 @@ async def handle_expense_text_action(update: Update, context: ContextTypes.DEFAU
             await update.message.reply_text("❌ Название не может быть пустым. Попробуйте еще раз:")
             return
         
-        success = db.update_off_shift_expense(expense_id, expense_item=new_item)
+        success = await adb.update_off_shift_expense(expense_id, expense_item=new_item)
         if success:
-            expense = db.get_off_shift_expense_by_id(expense_id)
+            period_report_cache.invalidate()
+            expense = await adb.get_off_shift_expense_by_id(expense_id)
             expense_item = expense.get('expense_item', '')
             amount = decimal_to_str(expense.get('amount', 0))
             payment_type = expense.get('payment_type', '')
@@ -4349,9 +3986,10 @@ async def handle_expense_text_action(update: Update, context: ContextTypes.DEFAU
             if new_amount <= 0:
                 raise ValueError("Сумма должна быть больше 0")
             
-            success = db.update_off_shift_expense(expense_id, amount=new_amount)
+            success = await adb.update_off_shift_expense(expense_id, amount=new_amount)
             if success:
-                expense = db.get_off_shift_expense_by_id(expense_id)
+                period_report_cache.invalidate()
+                expense = await adb.get_off_shift_expense_by_id(expense_id)
                 expense_item = expense.get('expense_item', '')
                 amount = decimal_to_str(expense.get('amount', 0))
                 payment_type = expense.get('payment_type', '')
@@ -4396,9 +4034,10 @@ async def handle_expense_text_action(update: Update, context: ContextTypes.DEFAU
             )
             return
         
-        success = db.update_off_shift_expense(expense_id, expense_date=new_date)
+        success = await adb.update_off_shift_expense(expense_id, expense_date=new_date)
         if success:
-            expense = db.get_off_shift_expense_by_id(expense_id)
+            period_report_cache.invalidate()
+            expense = await adb.get_off_shift_expense_by_id(expense_id)
             expense_item = expense.get('expense_item', '')
             amount = decimal_to_str(expense.get('amount', 0))
             payment_type = expense.get('payment_type', '')
@@ -4463,7 +4102,7 @@ async def save_expenses(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         payment_type = context.user_data.get('expense_payment_type', 'Наличные')
         for expense_item, amount in expense_list:
-            db.add_off_shift_expense(
+            await adb.add_off_shift_expense(
                 user_id=user_id,
                 username=username,
                 club_name=club_name,
@@ -4474,6 +4113,7 @@ async def save_expenses(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             saved_count += 1
             total_amount += amount
+        period_report_cache.invalidate(club_name, expense_date)
         
         # Очищаем данные сессии
         context.user_data.pop('expense_action', None)
@@ -4527,7 +4167,7 @@ async def show_off_shift_expenses_report(update: Update, context: ContextTypes.D
                                         club_name: str, start_date: date, end_date: date):
     """Показ отчета по расходам вне смены"""
     try:
-        expenses = db.get_off_shift_expenses(club_name, start_date, end_date)
+        expenses = await adb.get_off_shift_expenses(club_name, start_date, end_date)
         
         if not expenses:
             period_text = format_report_date(start_date)
@@ -4640,7 +4280,7 @@ async def add_employee_from_text(update: Update, text: str):
     
     code, name = result
     
-    db.add_employee(code, name)
+    await adb.add_employee(code, name)
     await update.message.reply_text(
         f"✅ Сотрудник добавлен/обновлён:\n• Код: {code}\n• ФИО: {name}")
  
@@ -4653,7 +4293,7 @@ async def delete_employee_by_code(update: Update, code: str):
         await update.message.reply_text("❌ Код не распознан")
         return
  
-    deleted = db.delete_employee(code)
+    deleted = await adb.delete_employee(code)
  
     if deleted:
         await update.message.reply_text(f"🗑 Удалено сотрудников: {deleted}")
@@ -4661,22 +4301,31 @@ async def delete_employee_by_code(update: Update, code: str):
         await update.message.reply_text("ℹ️ Сотрудник с таким кодом не найден")
  
  
-async def search_employee_by_code(update: Update, code: str):
-    """Поиск сотрудника по коду"""
-    code = code.strip().upper()
+async def search_employee(update: Update, text: str):
+    """Поиск сотрудника по коду, а если такого кода нет - по части ФИО"""
+    text = text.strip()
  
-    if not code:
-        await update.message.reply_text("❌ Код не распознан")
+    if not text:
+        await update.message.reply_text("❌ Запрос не распознан")
+        return
+ 
+    employee = await adb.get_employee(text.upper())
+ 
+    if employee:
+        await update.message.reply_text(
+            f"👤 Сотрудник найден:\n• Код: {employee['employee_code']}\n• ФИО: {employee['full_name']}")
         return
  
-    employee = db.get_employee(code)
+    employees = await adb.search_employees(text, limit=10)
  
-    if not employee:
+    if not employees:
         await update.message.reply_text("ℹ️ Сотрудник не найден")
         return
  
-    await update.message.reply_text(
-        f"👤 Сотрудник найден:\n• Код: {employee['employee_code']}\n• ФИО: {employee['full_name']}")
+    lines = [f"🔍 Найдено сотрудников: {len(employees)}"]
+    for emp in employees:
+        lines.append(f"• {emp['employee_code']} — {emp['full_name']}")
+    await update.message.reply_text("\n".join(lines))
  
  
 async def import_employees_from_text(update: Update, text: str):
@@ -4687,7 +4336,7 @@ async def import_employees_from_text(update: Update, text: str):
         await update.message.reply_text("❌ Не удалось распознать сотрудников. Проверьте формат")
         return
  
-    result = db.save_employees(employees)
+    result = await adb.save_employees(employees)
     total = len(employees)
     await update.message.reply_text(
         f"📥 Импорт завершён:\n• Всего в тексте: {total}\n• Добавлено: {result['inserted']}\n• Обновлено: {result['updated']}")
@@ -4695,8 +4344,7 @@ async def import_employees_from_text(update: Update, text: str):
  
 async def send_employee_list(query, context):
     """Отправка списка сотрудников пользователю"""
-    employees = db.list_employees(limit=20)
-    total = db.count_employees()
+    employees, total = await asyncio.gather(adb.list_employees(limit=20), adb.count_employees())
  
     if not employees:
         await query.message.reply_text("📭 Список сотрудников пуст")
@@ -4716,7 +4364,7 @@ async def send_employee_list(query, context):
  
 async def export_employee_list(query, context):
     """Экспорт списка сотрудников в Excel"""
-    employees = db.list_employees(limit=10000)
+    employees = await adb.list_employees(limit=10000)
  
     if not employees:
         await query.message.reply_text("📭 Нет сотрудников для экспорта")
@@ -4750,10 +4398,11 @@ def build_help_text() -> str:
    • Поддерживаемые форматы: .xlsx, .xls, .xlsm, .csv
    • Максимальный размер: 50 МБ
    • Отправьте файл как документ — бот сохранит данные в БД
+   • Несколько отчётов сразу — .zip архив, дата каждого отчёта берётся из имени файла (например, 01.11.xlsx)
 
 **3. Быстрые запросы к данным:**
    • Кнопка "📊 Запросы к данным" в главном меню
-   • "🔢 Количество записей" — общее число строк в `excel_data`
+   • "🔢 Количество записей" — общее число строк загруженных таблиц
    • "📄 Последние строки" — предпросмотр последнего загруженного файла
    • "🔍 Поиск по колонке" — используйте формат `колонка=значение`
 
@@ -4874,9 +4523,17 @@ def main():
         logger.error("TELEGRAM_BOT_TOKEN not found in environment variables!")
         return
     
-    application = Application.builder().token(token).build()
+    # Обновления разных чатов обрабатываются параллельно, одного чата - по порядку
+    builder = Application.builder().token(token).concurrent_updates(
+        ChatOrderedUpdateProcessor(concurrency=int(os.getenv('UPDATE_CONCURRENCY', 8)))
+    )
+    base_url = os.getenv('TELEGRAM_BASE_URL')
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
 
-    application.post_init = setup_bot_commands
+    application.post_init = post_init
+    application.post_shutdown = post_shutdown
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("moskvich", moskvich_command))
@@ -4899,8 +4556,27 @@ def main():
     
     application.add_error_handler(error_handler)
     
+    # Процессы для разбора Excel запускаются до старта цикла событий
+    pools.start()
+    
     logger.info("Bot started!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        if os.getenv('BOT_MODE', 'polling').lower() == 'webhook':
+            asyncio.run(serve_webhook(
+                application,
+                listen=os.getenv('WEBHOOK_LISTEN', '127.0.0.1'),
+                port=int(os.getenv('WEBHOOK_PORT', 8080)),
+                path=os.getenv('WEBHOOK_PATH', '/telegram'),
+                webhook_url=os.getenv('WEBHOOK_URL'),
+                secret_token=os.getenv('WEBHOOK_SECRET')
+            ))
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
+    except KeyboardInterrupt:
+        logger.info("Bot stopped")
+    finally:
+        pools.shutdown()
+        db.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,247 @@
+"""
+Пакетная загрузка отчетов из ZIP архива
+
+Отчеты архива разбираются параллельно в пуле процессов, дата отчета берется из имени файла
+(для архива с одним отчетом - также из подписи к архиву). Разобранные отчеты сохраняются
+пачками, по одной транзакции на пачку; если пачка не сохранилась, ее отчеты сохраняются
+по одному, чтобы ошибка одного файла не отменяла остальные.
+"""
+import asyncio
+import io
+import logging
+import os
+import time
+import zipfile
+from datetime import date
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import executors
+from database import Database
+from excel_processor import PARSER_VERSION
+from executors import WorkerPools
+
+logger = logging.getLogger(__name__)
+
+ProgressCallback = Callable[[Dict[str, Any]], Awaitable[None]]
+
+REPORT_EXTENSIONS = ('.xlsx', '.xls', '.xlsm')
+
+
+class ArchiveError(ValueError):
+    """Архив не удалось прочитать или в нем слишком много файлов"""
+
+
+def _member_name(info: zipfile.ZipInfo) -> str:
+    """Имя файла архива; имена из архивов Windows без флага UTF-8 записаны в cp866"""
+    name = info.filename
+    if not info.flag_bits & 0x800:
+        try:
+            name = name.encode('cp437').decode('cp866')
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            pass
+    return name
+
+
+def read_report_archive(archive_content: bytes, max_files: int,
+                        max_member_size: int) -> Tuple[List[Tuple[str, bytes]], List[Tuple[str, str]]]:
+    """
+    Отчеты Excel из ZIP архива
+
+    Returns:
+        (reports, rejected): reports - (имя файла, содержимое), rejected - (имя файла, причина)
+    """
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(archive_content))
+    except zipfile.BadZipFile as e:
+        raise ArchiveError(f"Не удалось открыть архив: {e}")
+
+    reports: List[Tuple[str, bytes]] = []
+    rejected: List[Tuple[str, str]] = []
+    with archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            name = _member_name(info)
+            base_name = os.path.basename(name)
+            # Служебные файлы macOS и временные файлы Excel
+            if name.startswith('__MACOSX/') or base_name.startswith(('.', '~$')):
+                continue
+            if not base_name.lower().endswith(REPORT_EXTENSIONS):
+                rejected.append((name, "не отчёт Excel"))
+                continue
+            if info.file_size > max_member_size:
+                rejected.append((name, f"больше {max_member_size // 1024 // 1024} МБ"))
+                continue
+            if len(reports) >= max_files:
+                raise ArchiveError(f"В архиве больше {max_files} отчётов")
+            try:
+                reports.append((name, archive.read(info)))
+            except (zipfile.BadZipFile, RuntimeError, OSError) as e:
+                rejected.append((name, f"не удалось распаковать: {e}"))
+
+    return reports, rejected
+
+
+class BulkUploadEngine:
+    """Загрузка архива отчетов: параллельный разбор и сохранение пачками"""
+
+    def __init__(self, db: Database, pools: WorkerPools, parse_date: Callable[[str], Optional[date]],
+                 batch_size: int = 10, max_files: int = 100, max_member_size: int = 50 * 1024 * 1024,
+                 progress_interval: float = 2.0):
+        self.db = db
+        self.pools = pools
+        self.parse_date = parse_date
+        self.batch_size = max(batch_size, 1)
+        self.max_files = max_files
+        self.max_member_size = max_member_size
+        self.progress_interval = progress_interval
+
+    def _report_date(self, file_name: str, caption: Optional[str], single_report: bool) -> Optional[date]:
+        stem = os.path.splitext(os.path.basename(file_name))[0]
+        report_date = self.parse_date(stem)
+        if report_date is None and single_report and caption:
+            report_date = self.parse_date(caption)
+        return report_date
+
+    async def run(self, user_id: int, username: str, club_name: str, archive_content: bytes,
+                  caption: Optional[str] = None, on_progress: Optional[ProgressCallback] = None) -> Dict[str, Any]:
+        """
+        Загрузка всех отчетов архива в клуб
+
+        Returns:
+            Итоги: total, saved (имя, дата, id файла), duplicates (имя, дата), errors (имя, причина), elapsed
+        """
+        started_at = time.monotonic()
+        reports, rejected = await self.pools.run_blocking(
+            read_report_archive, archive_content, self.max_files, self.max_member_size
+        )
+
+        result: Dict[str, Any] = {
+            'total': len(reports) + len(rejected),
+            'saved': [],
+            'duplicates': [],
+            'errors': list(rejected),
+        }
+
+        # Дата и хэш каждого отчета; повторы внутри архива отбрасываются сразу
+        pending: List[Dict[str, Any]] = []
+        seen_hashes: Dict[str, str] = {}
+        for file_name, file_content in reports:
+            report_date = self._report_date(file_name, caption, len(reports) == 1)
+            if report_date is None:
+                result['errors'].append((file_name, "не удалось определить дату отчёта по имени файла"))
+                continue
+            file_hash = Database.compute_file_hash(file_content)
+            if file_hash in seen_hashes:
+                result['errors'].append((file_name, f"повторяет файл {seen_hashes[file_hash]}"))
+                continue
+            seen_hashes[file_hash] = file_name
+            pending.append({
+                'user_id': user_id,
+                'username': username,
+                'club_name': club_name,
+                'file_name': os.path.basename(file_name),
+                'file_content': file_content,
+                'file_hash': file_hash,
+                'report_date': report_date,
+            })
+
+        # Уже загруженные в этот клуб файлы не разбираются повторно, у них только уточняется дата
+        existing = await self.pools.run_blocking(
+            self.db.get_uploaded_files_by_hashes, club_name, [report['file_hash'] for report in pending]
+        )
+        new_reports = []
+        for report in pending:
+            existing_file = existing.get(report['file_hash'])
+            if existing_file is None:
+                new_reports.append(report)
+                continue
+            if existing_file.get('report_date') != report['report_date']:
+                await self.pools.run_blocking(
+                    self.db.set_uploaded_file_report_date, existing_file['id'], report['report_date']
+                )
+            result['duplicates'].append((report['file_name'], report['report_date']))
+
+        progress = {'total': len(new_reports), 'parsed': 0, 'saved': 0, 'errors': 0}
+        last_report = 0.0
+
+        async def report_progress(force: bool = False):
+            nonlocal last_report
+            if on_progress is None:
+                return
+            now = time.monotonic()
+            if not force and now - last_report < self.progress_interval:
+                return
+            last_report = now
+            try:
+                await on_progress(dict(progress, elapsed=now - started_at))
+            except Exception as e:
+                logger.warning(f"Bulk upload progress callback failed: {e}")
+
+        await report_progress(force=True)
+
+        # Разбор параллельно; готовые отчеты сохраняются пачками, пока разбираются остальные
+        batch: List[Dict[str, Any]] = []
+        for parsed in asyncio.as_completed([self._parse(report) for report in new_reports]):
+            report, error = await parsed
+            progress['parsed'] += 1
+            if error:
+                result['errors'].append((report['file_name'], error))
+                progress['errors'] += 1
+            else:
+                batch.append(report)
+                if len(batch) >= self.batch_size:
+                    await self._save_batch(batch, result, progress)
+                    batch = []
+            await report_progress()
+
+        if batch:
+            await self._save_batch(batch, result, progress)
+        await report_progress(force=True)
+
+        result['saved'].sort(key=lambda item: item[1])
+        result['elapsed'] = time.monotonic() - started_at
+        logger.info(
+            f"Bulk upload for {club_name} by user {user_id}: total={result['total']}, saved={len(result['saved'])}, "
+            f"duplicates={len(result['duplicates'])}, errors={len(result['errors'])}, elapsed={result['elapsed']:.1f}s"
+        )
+        return result
+
+    async def _parse(self, report: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+        """Разбор одного отчета (блоки - из кэша разбора, если это содержимое уже встречалось)"""
+        try:
+            cached_blocks = await self.pools.run_blocking(self.db.get_cached_blocks, report['file_hash'], PARSER_VERSION)
+            if cached_blocks is not None:
+                report['data'] = await self.pools.run_cpu(
+                    executors.parse_excel_rows, report['file_content'], report['file_name']
+                )
+                report['blocks'] = cached_blocks
+            else:
+                parsed = await self.pools.run_cpu(
+                    executors.parse_report_file, report['file_content'], report['file_name']
+                )
+                report['data'] = parsed['data']
+                report['blocks'] = parsed['blocks']
+            return report, None
+        except Exception as e:
+            logger.error(f"Error parsing archived report {report['file_name']}: {e}", exc_info=True)
+            return report, str(e)
+
+    async def _save_batch(self, batch: List[Dict[str, Any]], result: Dict[str, Any], progress: Dict[str, Any]):
+        try:
+            file_ids = await self.pools.run_blocking(self.db.save_report_files, batch, PARSER_VERSION)
+            saved = list(zip(batch, file_ids))
+        except Exception as e:
+            logger.warning(f"Batch of {len(batch)} reports failed ({e}), saving one by one")
+            saved = []
+            for report in batch:
+                try:
+                    file_ids = await self.pools.run_blocking(self.db.save_report_files, [report], PARSER_VERSION)
+                    saved.append((report, file_ids[0]))
+                except Exception as report_error:
+                    result['errors'].append((report['file_name'], f"ошибка сохранения: {report_error}"))
+                    progress['errors'] += 1
+
+        for report, file_id in saved:
+            result['saved'].append((report['file_name'], report['report_date'], file_id))
+        progress['saved'] += len(saved)
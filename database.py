@@ -2,14 +2,26 @@
 Модуль для работы с PostgreSQL базой данных
 """
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import Json, RealDictCursor, execute_values
 from contextlib import contextmanager
 import logging
-from typing import List, Dict, Any, Optional
-from datetime import date
+from typing import List, Dict, Any, Optional, Tuple
+from datetime import date, datetime
 from decimal import Decimal
 import hashlib
-from collections import defaultdict
+import io
+import json
+import re
+import threading
+import time
+import zlib
+from collections import defaultdict, deque
+
+try:
+    import zstandard
+except ImportError:  # без zstandard новые файлы сжимаются zlib
+    zstandard = None
 
 # Логирование настроено в bot.py, здесь только получаем logger
 import logging
@@ -17,9 +29,412 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+# Таблицы блоков отчета, которые перезаписываются целиком при сохранении разобранного файла
+REPORT_BLOCK_TABLES = (
+    'income_records',
+    'ticket_sales',
+    'payment_types',
+    'staff_statistics',
+    'expense_records',
+    'misc_expenses_records',
+    'taxi_expenses',
+    'cash_collection',
+    'staff_debts',
+    'notes_entries',
+    'totals_summary',
+)
+
+
+# Уровень сжатия исходных файлов в file_blobs (xlsx уже zip-архив, выигрыш 10-15%; xls и csv сжимаются сильнее)
+BLOB_ZSTD_LEVEL = 10
+BLOB_ZLIB_LEVEL = 6
+# Сколько файлов переносится из uploaded_files.file_content в file_blobs за один запрос
+BLOB_MIGRATION_BATCH = 50
+
+
+# Поля задачи очереди разбора без BYTEA file_content
+INGEST_JOB_COLUMNS = (
+    "id, kind, status, user_id, chat_id, message_id, payload, progress, result, error_message, attempts, "
+    "worker_id, created_at, started_at, heartbeat_at, finished_at, notified_at"
+)
+
+
+# Версия правил подсчета daily_club_facts: строки другой версии пересчитываются при запуске
+DAILY_FACTS_VERSION = 2
+
+# Пересчет строки daily_club_facts из блоков текущего (последнего загруженного) файла клуба за день
+DAILY_FACTS_UPSERT_SQL = """
+    INSERT INTO daily_club_facts (
+        club_name, report_date, file_count, shift_income_total, staff_amount, staff_hookah_amount,
+        guests_count, tickets_amount, cash_income, cash_expense, noncash_income, noncash_expense,
+        net_profit, taxi_amount, taxi_percent_amount, deposits_total, taxi_total, debts_total,
+        facts_version, updated_at
+    )
+    SELECT uf.club_name, uf.report_date,
+           (SELECT COUNT(*) FROM uploaded_files a WHERE a.club_name = uf.club_name AND a.report_date = uf.report_date),
+           COALESCE(inc.shift_income_total, 0), COALESCE(inc.staff_amount, 0), COALESCE(inc.staff_hookah_amount, 0),
+           COALESCE(ts.guests_count, 0), COALESCE(ts.tickets_amount, 0),
+           COALESCE(tot.cash_income, 0), COALESCE(tot.cash_expense, 0),
+           COALESCE(tot.noncash_income, 0), COALESCE(tot.noncash_expense, 0),
+           COALESCE(tot.net_profit, 0),
+           COALESCE(tx.taxi_amount, 0), COALESCE(tx.taxi_percent_amount, 0),
+           COALESCE(tx.deposits_total, 0), COALESCE(tx.taxi_total, 0),
+           COALESCE(d.debts_total, 0),
+           %(facts_version)s,
+           CURRENT_TIMESTAMP
+    FROM current_uploaded_files uf
+    CROSS JOIN LATERAL (
+        SELECT SUM(amount) FILTER (WHERE LOWER(TRIM(category)) = 'итого за смену') AS shift_income_total,
+               SUM(amount) FILTER (
+                   WHERE LOWER(category) LIKE '%%стафф%%' AND LOWER(category) NOT LIKE '%%кальян%%'
+               ) AS staff_amount,
+               SUM(amount) FILTER (
+                   WHERE LOWER(category) LIKE '%%стафф%%' AND LOWER(category) LIKE '%%кальян%%'
+               ) AS staff_hookah_amount
+        FROM income_records WHERE file_id = uf.id
+    ) inc
+    CROSS JOIN LATERAL (
+        SELECT SUM(quantity) AS guests_count, SUM(amount) AS tickets_amount
+        FROM ticket_sales WHERE file_id = uf.id AND is_total = FALSE
+    ) ts
+    CROSS JOIN LATERAL (
+        SELECT SUM(income_amount) FILTER (WHERE LOWER(TRIM(payment_type)) LIKE 'нал%%') AS cash_income,
+               SUM(expense_amount) FILTER (WHERE LOWER(TRIM(payment_type)) LIKE 'нал%%') AS cash_expense,
+               SUM(income_amount) FILTER (
+                   WHERE COALESCE(LOWER(TRIM(payment_type)), '') NOT LIKE 'нал%%'
+               ) AS noncash_income,
+               SUM(expense_amount) FILTER (
+                   WHERE COALESCE(LOWER(TRIM(payment_type)), '') NOT LIKE 'нал%%'
+               ) AS noncash_expense,
+               SUM(income_amount - expense_amount) AS net_profit
+        FROM totals_summary
+        WHERE file_id = uf.id AND (payment_type IS NULL OR payment_type NOT ILIKE '%%итого%%')
+    ) tot
+    CROSS JOIN LATERAL (
+        SELECT SUM(taxi_amount) AS taxi_amount, SUM(taxi_percent_amount) AS taxi_percent_amount,
+               SUM(deposits_total) AS deposits_total, SUM(total_amount) AS taxi_total
+        FROM taxi_expenses WHERE file_id = uf.id
+    ) tx
+    CROSS JOIN LATERAL (
+        SELECT SUM(amount) AS debts_total
+        FROM staff_debts WHERE file_id = uf.id AND is_total = FALSE
+    ) d
+    WHERE uf.club_name = %(club_name)s AND uf.report_date = %(report_date)s
+    ON CONFLICT (club_name, report_date) DO UPDATE SET
+        file_count = EXCLUDED.file_count,
+        shift_income_total = EXCLUDED.shift_income_total,
+        staff_amount = EXCLUDED.staff_amount,
+        staff_hookah_amount = EXCLUDED.staff_hookah_amount,
+        guests_count = EXCLUDED.guests_count,
+        tickets_amount = EXCLUDED.tickets_amount,
+        cash_income = EXCLUDED.cash_income,
+        cash_expense = EXCLUDED.cash_expense,
+        noncash_income = EXCLUDED.noncash_income,
+        noncash_expense = EXCLUDED.noncash_expense,
+        net_profit = EXCLUDED.net_profit,
+        taxi_amount = EXCLUDED.taxi_amount,
+        taxi_percent_amount = EXCLUDED.taxi_percent_amount,
+        deposits_total = EXCLUDED.deposits_total,
+        taxi_total = EXCLUDED.taxi_total,
+        debts_total = EXCLUDED.debts_total,
+        facts_version = EXCLUDED.facts_version,
+        updated_at = EXCLUDED.updated_at
+"""
+
+DAILY_FACT_COLUMNS = (
+    "club_name, report_date, file_count, shift_income_total, staff_amount, staff_hookah_amount, "
+    "guests_count, tickets_amount, cash_income, cash_expense, noncash_income, noncash_expense, "
+    "net_profit, taxi_amount, taxi_percent_amount, deposits_total, taxi_total, debts_total"
+)
+
+
+# Сводные блоки за период: таблица, колонки строки источника, условие, колонки статьи, агрегаты
+PERIOD_BLOCKS = {
+    'income': ('income_records', "r.category, r.amount", "", ['category'], ["SUM(amount) AS amount"]),
+    'ticket_sales': (
+        'ticket_sales', "r.price_label, r.quantity, r.amount", "AND r.is_total = FALSE",
+        ['price_label'], ["COALESCE(SUM(quantity), 0) AS quantity", "COALESCE(SUM(amount), 0) AS amount"]
+    ),
+    'payment_types': (
+        'payment_types', "r.payment_type, r.amount", "AND r.is_total = FALSE AND r.is_cash_total = FALSE",
+        ['payment_type'], ["COALESCE(SUM(amount), 0) AS amount"]
+    ),
+    'staff_statistics': (
+        'staff_statistics', "r.role_name, r.staff_count", "",
+        ['role_name'], ["COALESCE(SUM(staff_count), 0) AS staff_count"]
+    ),
+    'expense_records': (
+        'expense_records', "r.expense_item, r.amount", "AND r.is_total = FALSE",
+        ['expense_item'], ["COALESCE(SUM(amount), 0) AS amount"]
+    ),
+    'cash_collection': (
+        'cash_collection',
+        "r.currency_label, COALESCE(r.exchange_rate, 0) AS exchange_rate, r.quantity, r.amount",
+        "AND r.is_total = FALSE",
+        ['currency_label', 'exchange_rate'],
+        ["COALESCE(SUM(quantity), 0) AS quantity", "COALESCE(SUM(amount), 0) AS amount"]
+    ),
+    'staff_debts': (
+        'staff_debts', "r.debt_type, r.amount", "AND r.is_total = FALSE",
+        ['debt_type'], ["COALESCE(SUM(amount), 0) AS amount"]
+    ),
+    'totals_summary': (
+        'totals_summary', "r.payment_type, r.income_amount, r.expense_amount",
+        "AND (r.payment_type IS NULL OR r.payment_type NOT ILIKE '%%итого%%')",
+        ['payment_type'],
+        ["COALESCE(SUM(income_amount), 0) AS income_amount", "COALESCE(SUM(expense_amount), 0) AS expense_amount"]
+    ),
+}
+
+# Блоки, к которым за период добавляются расходы вне смены: колонки строки источника
+PERIOD_OFF_SHIFT_COLUMNS = {
+    'expense_records': "ose.expense_item, ose.amount",
+    'totals_summary': "ose.payment_type, 0::numeric AS income_amount, ose.amount AS expense_amount",
+}
+
+# «ИТОГО КАССА» блока «Типы оплат» за период
+PAYMENT_CASH_TOTAL_SQL = """
+    SELECT COALESCE(SUM(pt.amount), 0)
+    FROM payment_types pt
+    JOIN current_uploaded_files uf ON pt.file_id = uf.id
+    WHERE uf.club_name = %s
+    AND uf.report_date >= %s
+    AND uf.report_date <= %s
+    AND pt.is_total = FALSE
+    AND pt.is_cash_total = TRUE
+"""
+
+
+# Метаданные uploaded_files без BYTEA file_content (содержимое читается через get_file_content)
+UPLOADED_FILE_COLUMNS = (
+    "id, user_id, username, file_name, upload_date, file_hash, row_count, report_date, club_name, parser_version"
+)
+
+
+# Параметры запроса psycopg2 (%s, %(name)s) и экранированный %%
+QUERY_PARAM_RE = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+class PoolTimeoutError(psycopg2.OperationalError):
+    """Не удалось получить подключение из пула за отведенное время"""
+
+
+class PreparedStatementConnection(psycopg2.extensions.connection):
+    """Подключение с именами подготовленных на нем запросов (текст запроса -> имя)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements: Dict[str, str] = {}
+
+
+class ConnectionPool:
+    """Ограниченный потокобезопасный пул подключений psycopg2"""
+
+    def __init__(self, connection_params: Dict[str, Any], min_size: int = 1, max_size: int = 10,
+                 checkout_timeout: float = 30.0, max_idle: float = 300.0, ping_after: float = 30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool bounds: min={min_size}, max={max_size}")
+
+        self.connection_params = connection_params
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+
+        self._cond = threading.Condition()
+        self._idle: deque = deque()  # (conn, время возврата в пул)
+        self._size = 0  # открытые подключения: свободные + выданные
+        self._in_use = 0
+        self._closed = False
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'discarded': 0,
+        }
+
+        for _ in range(min_size):
+            conn = self._connect()
+            with self._cond:
+                self._size += 1
+                self._idle.append((conn, time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(connection_factory=PreparedStatementConnection, **self.connection_params)
+        with self._cond:
+            self._stats['created'] += 1
+        return conn
+
+    def _is_healthy(self, conn, idle_for: float) -> bool:
+        """Проверка подключения перед выдачей: закрытые и «зависшие» отбрасываются, давно простаивавшие пингуются"""
+        if conn.closed:
+            return False
+        if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            return False
+        if idle_for < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _recycle_idle_locked(self) -> None:
+        """Закрытие подключений, простаивающих дольше max_idle (сверх min_size). Вызывается под self._cond"""
+        now = time.monotonic()
+        # Самые старые свободные подключения лежат в начале очереди
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.max_idle:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            self._stats['recycled'] += 1
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def getconn(self):
+        """Получение подключения (ожидает, если пул исчерпан)"""
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+        waited = False
+
+        while True:
+            conn = None
+            idle_for = 0.0
+            with self._cond:
+                if self._closed:
+                    raise psycopg2.InterfaceError("Connection pool is closed")
+
+                self._recycle_idle_locked()
+
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    idle_for = time.monotonic() - returned_at
+                    self._in_use += 1
+                elif self._size < self.max_size:
+                    self._size += 1
+                    self._in_use += 1
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeoutError(
+                            f"No free database connection after {self.checkout_timeout:g}s "
+                            f"(pool size {self.max_size})"
+                        )
+                    if not waited:
+                        self._stats['waits'] += 1
+                        waited = True
+                    self._cond.wait(remaining)
+                    continue
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+            elif not self._is_healthy(conn, idle_for):
+                logger.warning("Discarding broken pooled database connection")
+                self._close_quietly(conn)
+                self._release_slot(discarded=True)
+                continue
+
+            wait_time = time.monotonic() - started
+            with self._cond:
+                self._stats['checkouts'] += 1
+                if waited:
+                    self._stats['wait_time_total'] += wait_time
+                    self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait_time)
+            return conn
+
+    def putconn(self, conn, discard: bool = False) -> None:
+        """Возврат подключения в пул; сломанные подключения закрываются"""
+        if not discard and not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            if discard or conn.closed or self._closed:
+                self._size -= 1
+                if discard:
+                    self._stats['discarded'] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+                conn = None
+            self._cond.notify()
+
+        if conn is not None:
+            self._close_quietly(conn)
+
+    def _release_slot(self, discarded: bool = False) -> None:
+        with self._cond:
+            self._size -= 1
+            self._in_use -= 1
+            if discarded:
+                self._stats['discarded'] += 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def closeall(self) -> None:
+        """Закрытие всех свободных подключений; выданные закроются при возврате"""
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика пула для мониторинга"""
+        with self._cond:
+            result = dict(self._stats)
+            result.update({
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+            })
+        return result
+
+
 class Database:
-    def __init__(self, host: str, port: int, database: str, user: str, password: str):
-        """Инициализация подключения к БД"""
+    def __init__(self, host: str, port: int, database: str, user: str, password: str,
+                 pool_min: int = 1, pool_max: int = 10, pool_timeout: float = 30.0,
+                 pool_max_idle: float = 300.0, prepared_statements: bool = True):
+        """
+        Инициализация подключения к БД
+
+        prepared_statements=False отключает подготовленные запросы (нужно за PgBouncer
+        в режиме pool_mode=transaction, где подключение к серверу меняется между транзакциями).
+        """
+        self.prepared_statements = prepared_statements
+        # Текст запроса -> (текст для PREPARE с $1..$n, имена именованных параметров)
+        self._statement_templates: Dict[str, Tuple[str, Optional[List[str]]]] = {}
+        self._unpreparable: set = set()
+        self._statement_lock = threading.Lock()
+        self._statement_stats = {'prepared': 0, 'reused': 0, 'unprepared': 0}
+        # Есть ли pg_trgm (поиск по похожести и триграммные индексы), проверяется при инициализации схемы
+        self.trigram_search = False
         self.connection_params = {
             'host': host,
             'port': port,
@@ -27,21 +442,120 @@ class Database:
             'user': user,
             'password': password
         }
+        self.pool = ConnectionPool(
+            self.connection_params,
+            min_size=pool_min,
+            max_size=pool_max,
+            checkout_timeout=pool_timeout,
+            max_idle=pool_max_idle
+        )
         self._init_database()
     
     @contextmanager
     def get_connection(self):
-        """Контекстный менеджер для работы с подключением"""
-        conn = psycopg2.connect(**self.connection_params)
+        """Контекстный менеджер для работы с подключением из пула"""
+        conn = self.pool.getconn()
+        broken = False
         try:
             yield conn
             conn.commit()
         except Exception as e:
-            conn.rollback()
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
             logger.error(f"Database error: {e}")
             raise
         finally:
-            conn.close()
+            self.pool.putconn(conn, discard=broken)
+
+    def pool_stats(self) -> Dict[str, Any]:
+        """Статистика пула подключений (занято, ожидания, время ожидания)"""
+        return self.pool.stats()
+
+    def close(self) -> None:
+        """Закрытие всех подключений пула"""
+        self.pool.closeall()
+
+    def statement_stats(self) -> Dict[str, int]:
+        """
+        Статистика подготовленных запросов
+
+        prepared - сколько раз запрос готовился на подключении, reused - сколько выполнений
+        обошлись без разбора и планирования, unprepared - выполнения без подготовки.
+        """
+        with self._statement_lock:
+            return dict(self._statement_stats, statements=len(self._statement_templates))
+
+    @staticmethod
+    def _statement_template(sql: str) -> Tuple[str, Optional[List[str]]]:
+        """Текст запроса для PREPARE: параметры psycopg2 заменяются на $1..$n"""
+        names: List[str] = []
+        positional = 0
+
+        def replace(match):
+            nonlocal positional
+            if match.group(0) == '%%':
+                return '%'
+            if match.group(1) is None:
+                positional += 1
+                return f"${positional}"
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return f"${names.index(match.group(1)) + 1}"
+
+        body = QUERY_PARAM_RE.sub(replace, sql)
+        return body, names or None
+
+    def _execute_prepared(self, cur, sql: str, params: Any = None) -> None:
+        """
+        Выполнение запроса через оператор, подготовленный на подключении (PREPARE/EXECUTE)
+
+        Запрос готовится при первом выполнении на подключении и переиспользуется, пока подключение
+        живо: PostgreSQL не разбирает и не планирует его заново. Если запрос подготовить нельзя,
+        он выполняется обычным образом.
+        """
+        statements = getattr(cur.connection, 'prepared_statements', None)
+        if not self.prepared_statements or statements is None or sql in self._unpreparable:
+            with self._statement_lock:
+                self._statement_stats['unprepared'] += 1
+            cur.execute(sql, params)
+            return
+
+        template = self._statement_templates.get(sql)
+        if template is None:
+            template = self._statement_template(sql)
+            self._statement_templates[sql] = template
+        body, names = template
+
+        name = statements.get(sql)
+        if name is None:
+            name = f"stmt_{len(statements) + 1}"
+            # Ошибка PREPARE не должна прерывать транзакцию вызывающего метода
+            cur.execute("SAVEPOINT prepare_statement")
+            try:
+                cur.execute(f"PREPARE {name} AS {body}")
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT prepare_statement")
+                logger.warning(f"Statement cannot be prepared, executing it directly: {e}")
+                with self._statement_lock:
+                    self._unpreparable.add(sql)
+                    self._statement_stats['unprepared'] += 1
+                cur.execute(sql, params)
+                return
+            cur.execute("RELEASE SAVEPOINT prepare_statement")
+            statements[sql] = name
+            with self._statement_lock:
+                self._statement_stats['prepared'] += 1
+        else:
+            with self._statement_lock:
+                self._statement_stats['reused'] += 1
+
+        values = [params[key] for key in names] if names else list(params or ())
+        if values:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(values))})", values)
+        else:
+            cur.execute(f"EXECUTE {name}")
     
     def _init_database(self):
         """Инициализация схемы БД"""
@@ -52,49 +566,315 @@ class Database:
             with self.get_connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute(schema)
+                    # Сообщения миграций схемы (RAISE NOTICE 'migration: ...') - в лог
+                    for notice in conn.notices:
+                        if 'migration:' in notice:
+                            logger.info(f"Schema {notice.strip()}")
+                    del conn.notices[:]
+                    self._dedupe_uploaded_files(cur)
+                    filled = self._backfill_daily_facts(cur)
+                    moved = self._migrate_file_blobs(cur)
+                    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+                    self.trigram_search = cur.fetchone()[0]
+            if not self.trigram_search:
+                logger.warning("pg_trgm extension is not installed, text search falls back to ILIKE without indexes")
+            if moved:
+                logger.info(f"Moved content of {moved} uploaded files to file_blobs")
+            if filled:
+                logger.info(f"Daily club facts filled for {filled} days")
             logger.info("Database schema initialized successfully")
         except Exception as e:
             logger.error(f"Error initializing database: {e}")
             raise
     
+    def _dedupe_uploaded_files(self, cur) -> int:
+        """
+        Однократная миграция: удаление повторных загрузок файла в клуб и создание уникального индекса
+
+        Из загрузок с одинаковыми (club_name, file_hash) остается одна: с датой отчета, самая новая.
+        Удаленные файлы (вместе с их блоками) записываются в лог. После создания индекса
+        миграция больше не выполняется.
+        """
+        cur.execute("SELECT to_regclass('idx_uploaded_files_club_hash') IS NOT NULL")
+        if cur.fetchone()[0]:
+            return 0
+
+        cur.execute(
+            """
+            SELECT id, club_name, file_name, report_date, upload_date, kept_id
+            FROM (
+                SELECT id, club_name, file_name, report_date, upload_date,
+                       FIRST_VALUE(id) OVER w AS kept_id,
+                       ROW_NUMBER() OVER w AS duplicate_rank
+                FROM uploaded_files
+                WHERE club_name IS NOT NULL AND file_hash IS NOT NULL
+                WINDOW w AS (
+                    PARTITION BY club_name, file_hash
+                    ORDER BY (report_date IS NULL), upload_date DESC, id DESC
+                )
+            ) ranked
+            WHERE duplicate_rank > 1
+            ORDER BY club_name, id
+            """
+        )
+        duplicates = cur.fetchall()
+        for file_id, club_name, file_name, report_date, upload_date, kept_id in duplicates:
+            logger.warning(
+                f"Removing duplicate upload {file_id} ({club_name}, {file_name}, report_date={report_date}, "
+                f"uploaded {upload_date}): same content as file {kept_id}"
+            )
+        if duplicates:
+            cur.execute("DELETE FROM uploaded_files WHERE id = ANY(%s)", ([row[0] for row in duplicates],))
+            self._refresh_daily_facts(cur, keys=[(row[1], row[3]) for row in duplicates])
+
+        cur.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_uploaded_files_club_hash ON uploaded_files(club_name, file_hash)"
+        )
+        if duplicates:
+            logger.warning(f"Removed {len(duplicates)} duplicate uploads before creating the unique file hash index")
+        return len(duplicates)
+
+    @staticmethod
+    def compute_file_hash(file_content: bytes) -> str:
+        """SHA-256 содержимого файла (ключ дедупликации загрузок)"""
+        return hashlib.sha256(file_content).hexdigest()
+
     def save_uploaded_file(self, user_id: int, username: str, file_name: str, 
                           file_content: bytes, row_count: int,
                           report_date: Optional[date] = None,
-                          club_name: Optional[str] = None) -> int:
+                          club_name: Optional[str] = None,
+                          file_hash: Optional[str] = None) -> int:
         """Сохранение информации о загруженном файле"""
-        file_hash = hashlib.sha256(file_content).hexdigest()
-        
         with self.get_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    INSERT INTO uploaded_files (user_id, username, file_name, file_hash, row_count, report_date, file_content, club_name)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    RETURNING id
-                    """,
-                    (user_id, username, file_name, file_hash, row_count, report_date, file_content, club_name)
+                return self._insert_uploaded_file(
+                    cur, user_id, username, file_name, file_content, row_count, report_date, club_name, file_hash
                 )
-                file_id = cur.fetchone()[0]
-                logger.info(f"File saved with ID: {file_id}, Club: {club_name}")
-                return file_id
-    
-    def save_excel_data(self, file_id: int, data: List[Dict[str, Any]]):
-        """Сохранение данных из Excel в БД"""
+
+    def _insert_uploaded_file(self, cur, user_id: int, username: str, file_name: str,
+                              file_content: bytes, row_count: int, report_date: Optional[date],
+                              club_name: Optional[str], file_hash: Optional[str]) -> int:
+        file_hash = file_hash or self.compute_file_hash(file_content)
+        self._store_blob(cur, file_hash, file_content)
+        cur.execute(
+            """
+            INSERT INTO uploaded_files (user_id, username, file_name, file_hash, row_count, report_date, club_name)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+            """,
+            (user_id, username, file_name, file_hash, row_count, report_date, club_name)
+        )
+        file_id = cur.fetchone()[0]
+        logger.info(f"File saved with ID: {file_id}, Club: {club_name}")
+        return file_id
+
+    # --- Хранилище исходных файлов (file_blobs) ---
+
+    @staticmethod
+    def _compress_blob(file_content: bytes) -> Tuple[str, bytes]:
+        """Сжатие содержимого файла; если сжатие не уменьшает размер, хранится как есть"""
+        if zstandard is not None:
+            codec, packed = 'zstd', zstandard.ZstdCompressor(level=BLOB_ZSTD_LEVEL).compress(file_content)
+        else:
+            codec, packed = 'zlib', zlib.compress(file_content, BLOB_ZLIB_LEVEL)
+        if len(packed) >= len(file_content):
+            return 'raw', bytes(file_content)
+        return codec, packed
+
+    @staticmethod
+    def _decompress_blob(codec: str, packed: bytes) -> bytes:
+        if codec == 'zstd':
+            if zstandard is None:
+                raise RuntimeError("File is stored with zstd compression, install the zstandard package")
+            return zstandard.ZstdDecompressor().decompress(packed)
+        if codec == 'zlib':
+            return zlib.decompress(packed)
+        if codec == 'raw':
+            return bytes(packed)
+        raise ValueError(f"Unknown blob codec: {codec}")
+
+    def _store_blob(self, cur, file_hash: str, file_content: bytes):
+        """Сохранение содержимого файла по хэшу (уже сохраненное содержимое не сжимается повторно)"""
+        cur.execute("SELECT 1 FROM file_blobs WHERE file_hash = %s", (file_hash,))
+        if cur.fetchone():
+            return
+        codec, packed = self._compress_blob(file_content)
+        cur.execute(
+            """
+            INSERT INTO file_blobs (file_hash, codec, size, content)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (file_hash) DO NOTHING
+            """,
+            (file_hash, codec, len(file_content), psycopg2.Binary(packed))
+        )
+
+    def _migrate_file_blobs(self, cur) -> int:
+        """
+        Перенос старого содержимого uploaded_files.file_content в file_blobs и удаление колонки
+
+        Старому файлу без хэша хэш ставится по содержимому. Если в клубе уже есть файл с тем же
+        содержимым, это повторная загрузка: как в _dedupe_uploaded_files, остается одна
+        (с датой отчета, самая новая), вторая удаляется с записью в лог.
+        """
+        cur.execute(
+            """
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'uploaded_files' AND column_name = 'file_content'
+            """
+        )
+        if not cur.fetchone():
+            return 0
+
+        moved = 0
+        last_id = 0
+        while True:
+            cur.execute(
+                """
+                SELECT id, club_name, file_hash, file_content
+                FROM uploaded_files
+                WHERE file_content IS NOT NULL AND id > %s
+                ORDER BY id
+                LIMIT %s
+                """,
+                (last_id, BLOB_MIGRATION_BATCH)
+            )
+            rows = cur.fetchall()
+            if not rows:
+                break
+
+            moved_ids = []
+            for file_id, club_name, file_hash, file_content in rows:
+                last_id = file_id
+                file_content = bytes(file_content)
+                if not file_hash:
+                    file_hash = self.compute_file_hash(file_content)
+                    if not self._resolve_legacy_duplicate(cur, file_id, club_name, file_hash):
+                        continue
+                    cur.execute("UPDATE uploaded_files SET file_hash = %s WHERE id = %s", (file_hash, file_id))
+                self._store_blob(cur, file_hash, file_content)
+                moved_ids.append(file_id)
+
+            if moved_ids:
+                cur.execute("UPDATE uploaded_files SET file_content = NULL WHERE id = ANY(%s)", (moved_ids,))
+                moved += len(moved_ids)
+
+        cur.execute("ALTER TABLE uploaded_files DROP COLUMN file_content")
+        logger.info("Column uploaded_files.file_content dropped, file content is stored in file_blobs only")
+        return moved
+
+    def _resolve_legacy_duplicate(self, cur, file_id: int, club_name: Optional[str], file_hash: str) -> bool:
+        """
+        Старый файл без хэша, совпадающий по содержимому с файлом клуба: удаляется менее подходящий
+
+        Returns:
+            True, если file_id остается (ему можно поставить file_hash)
+        """
+        cur.execute(
+            """
+            SELECT id, file_name, report_date, upload_date
+            FROM uploaded_files
+            WHERE club_name = %s AND file_hash = %s AND id <> %s
+            """,
+            (club_name, file_hash, file_id)
+        )
+        existing = cur.fetchone()
+        if existing is None:
+            return True
+
+        cur.execute(
+            "SELECT id, file_name, report_date, upload_date FROM uploaded_files WHERE id = %s",
+            (file_id,)
+        )
+        current = cur.fetchone()
+
+        def rank(row):
+            # Как в _dedupe_uploaded_files: с датой отчета, затем самая новая загрузка
+            return (row[2] is None, -(row[3].timestamp() if row[3] else 0), -row[0])
+
+        kept, removed = sorted([existing, current], key=rank)
+        logger.warning(
+            f"Removing duplicate upload {removed[0]} ({club_name}, {removed[1]}, report_date={removed[2]}, "
+            f"uploaded {removed[3]}): same content as file {kept[0]}"
+        )
+        cur.execute("DELETE FROM uploaded_files WHERE id = %s", (removed[0],))
+        self._refresh_daily_facts(cur, keys=[(club_name, removed[2])])
+        return kept[0] == file_id
+
+    @staticmethod
+    def _sheet_rows(file_id: int, data: List[Dict[str, Any]]) -> List[tuple]:
+        """Строки sheet_rows: file_id, row_number, JSON {колонка: значение} (значения - строки, как в файле)"""
+        return [
+            (
+                file_id,
+                row_idx,
+                json.dumps(
+                    {str(column_name): str(value) if value is not None else None
+                     for column_name, value in row_data.items()},
+                    ensure_ascii=False
+                )
+            )
+            for row_idx, row_data in enumerate(data, start=1)
+        ]
+
+    @staticmethod
+    def _copy_text_value(value) -> str:
+        """Экранирование значения для текстового формата COPY"""
+        if value is None:
+            return '\\N'
+        return (
+            str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r')
+        )
+
+    def _build_copy_buffer(self, rows: List[tuple]) -> io.StringIO:
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(self._copy_text_value(value) for value in row))
+            buffer.write('\n')
+        buffer.seek(0)
+        return buffer
+
+    def save_sheet_rows(self, file_id: int, data: List[Dict[str, Any]]):
+        """Сохранение строк листа Excel в БД (COPY FROM STDIN, при недоступности COPY — многострочный INSERT)"""
+        if not data:
+            return
+
         with self.get_connection() as conn:
             with conn.cursor() as cur:
-                for row_idx, row_data in enumerate(data, start=1):
-                    for column_name, value in row_data.items():
-                        # Определение типа данных
-                        data_type = type(value).__name__
-                        
-                        cur.execute(
-                            """
-                            INSERT INTO excel_data (file_id, row_number, column_name, column_value, data_type)
-                            VALUES (%s, %s, %s, %s, %s)
-                            """,
-                            (file_id, row_idx, column_name, str(value) if value is not None else None, data_type)
-                        )
-                logger.info(f"Saved {len(data)} rows of Excel data for file_id: {file_id}")
+                self._copy_sheet_rows(cur, file_id, data)
+
+    def _copy_sheet_rows(self, cur, file_id: int, data: List[Dict[str, Any]]):
+        rows = self._sheet_rows(file_id, data)
+        if not rows:
+            return
+
+        cur.execute("SAVEPOINT sheet_rows_copy")
+        try:
+            cur.copy_expert(
+                """
+                COPY sheet_rows (file_id, row_number, data)
+                FROM STDIN
+                """,
+                self._build_copy_buffer(rows)
+            )
+            cur.execute("RELEASE SAVEPOINT sheet_rows_copy")
+        except psycopg2.Error as e:
+            logger.warning(f"COPY into sheet_rows failed ({e}), falling back to multi-row INSERT")
+            cur.execute("ROLLBACK TO SAVEPOINT sheet_rows_copy")
+            execute_values(
+                cur,
+                """
+                INSERT INTO sheet_rows (file_id, row_number, data)
+                VALUES %s
+                """,
+                rows,
+                template="(%s, %s, %s::jsonb)",
+                page_size=1000
+            )
+        logger.info(f"Saved {len(rows)} sheet rows of Excel data for file_id: {file_id}")
  
     # --- Работа с сотрудниками ---
 
@@ -196,12 +976,14 @@ class Database:
                         for rec in records
                     ]
                 )
+                self._refresh_daily_facts(cur, file_ids=[file_id])
 
     def list_income_records(self, file_id: int) -> List[Dict[str, Any]]:
         """Получение данных блока «Доходы» по файлу"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
+                self._execute_prepared(
+                    cur,
                     """
                     SELECT category, amount, created_at
                     FROM income_records
@@ -241,12 +1023,14 @@ class Database:
                         for rec in records
                     ]
                 )
+                self._refresh_daily_facts(cur, file_ids=[file_id])
 
     def list_ticket_sales(self, file_id: int) -> List[Dict[str, Any]]:
         """Получение данных блока «Входные билеты» по файлу"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
+                self._execute_prepared(
+                    cur,
                     """
                     SELECT price_label, price_value, quantity, amount, is_total, created_at
                     FROM ticket_sales
@@ -290,7 +1074,8 @@ class Database:
         """Получение данных блока «Типы оплат за смену» по файлу"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
+                self._execute_prepared(
+                    cur,
                     """
                     SELECT payment_type, amount, is_total, is_cash_total, created_at
                     FROM payment_types
@@ -332,7 +1117,8 @@ class Database:
         """Получение данных блока «Статистика персонала» по файлу"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
+                self._execute_prepared(
+                    cur,
                     """
                     SELECT role_name, staff_count, created_at
                     FROM staff_statistics
@@ -375,7 +1161,8 @@ class Database:
         """Получение данных блока «Расходы» по файлу"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
+                self._execute_prepared(
+                    cur,
                     """
                     SELECT expense_item, amount, is_total, created_at
                     FROM expense_records
@@ -418,7 +1205,8 @@ class Database:
         """Получение данных блока «Прочие расходы» по файлу"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
+                self._execute_prepared(
+                    cur,
                     """
                     SELECT expense_item, amount, is_total, created_at
                     FROM misc_expenses_records
@@ -433,13 +1221,14 @@ class Database:
         """Получение данных блока «Прочие расходы» за период с группировкой по статьям"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
+                self._execute_prepared(
+                    cur,
                     """
                     SELECT 
                         mer.expense_item,
                         SUM(mer.amount) as total_amount
                     FROM misc_expenses_records mer
-                    JOIN uploaded_files uf ON mer.file_id = uf.id
+                    JOIN current_uploaded_files uf ON mer.file_id = uf.id
                     WHERE uf.club_name = %s
                     AND uf.report_date >= %s
                     AND uf.report_date <= %s
@@ -451,6 +1240,203 @@ class Database:
                 )
                 return [dict(row) for row in cur.fetchall()]
 
+    # --- Дневные показатели клубов (daily_club_facts) ---
+
+    def _refresh_daily_facts(self, cur, file_ids: Optional[List[int]] = None,
+                             keys: Optional[List[tuple]] = None) -> int:
+        """
+        Пересчет дневных показателей в текущей транзакции
+
+        Пересчитываются дни (клуб, дата) файлов file_ids и дополнительные keys;
+        день, в котором не осталось файлов, удаляется.
+        """
+        days = {key for key in (keys or []) if key[0] and key[1]}
+        if file_ids:
+            cur.execute(
+                """
+                SELECT DISTINCT club_name, report_date
+                FROM uploaded_files
+                WHERE id = ANY(%s) AND club_name IS NOT NULL AND report_date IS NOT NULL
+                """,
+                (list(file_ids),)
+            )
+            days.update(cur.fetchall())
+
+        for club_name, report_date in days:
+            params = {'club_name': club_name, 'report_date': report_date, 'facts_version': DAILY_FACTS_VERSION}
+            cur.execute(DAILY_FACTS_UPSERT_SQL, params)
+            if cur.rowcount == 0:
+                cur.execute(
+                    "DELETE FROM daily_club_facts WHERE club_name = %(club_name)s AND report_date = %(report_date)s",
+                    params
+                )
+        return len(days)
+
+    def _backfill_daily_facts(self, cur) -> int:
+        """
+        Дни с файлами, для которых еще нет строки daily_club_facts (после обновления схемы)
+        или строка посчитана по правилам другой версии (DAILY_FACTS_VERSION)
+        """
+        cur.execute(
+            """
+            SELECT DISTINCT uf.club_name, uf.report_date
+            FROM uploaded_files uf
+            WHERE uf.club_name IS NOT NULL AND uf.report_date IS NOT NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM daily_club_facts f
+                WHERE f.club_name = uf.club_name AND f.report_date = uf.report_date
+                AND f.facts_version = %s
+            )
+            """,
+            (DAILY_FACTS_VERSION,)
+        )
+        return self._refresh_daily_facts(cur, keys=cur.fetchall())
+
+    def rebuild_daily_facts(self) -> int:
+        """Полный пересчет daily_club_facts (например, после изменения правил подсчета)"""
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM daily_club_facts")
+                return self._backfill_daily_facts(cur)
+
+    def get_daily_facts_period(self, club_name: str, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+        """Дневные показатели клуба за период (по одной строке на дату отчета)"""
+        with self.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                self._execute_prepared(
+                    cur,
+                    f"""
+                    SELECT {DAILY_FACT_COLUMNS}
+                    FROM daily_club_facts
+                    WHERE club_name = %s AND report_date >= %s AND report_date <= %s
+                    ORDER BY report_date
+                    """,
+                    (club_name, start_date, end_date)
+                )
+                return [dict(row) for row in cur.fetchall()]
+
+    # --- Сводные данные блоков за период ---
+
+    # Позиция расходов вне смены среди «файлов» периода: они идут после всех файлов
+    OFF_SHIFT_GROUP_POS = 2 ** 62
+
+    @staticmethod
+    def _period_block_source(table: str, columns_sql: str, where_sql: str = "") -> str:
+        """Строки блока за период: group_pos — порядок файла в периоде, row_pos — порядок строки в файле"""
+        return f"""
+            SELECT DENSE_RANK() OVER (ORDER BY uf.report_date, uf.id) AS group_pos,
+                   r.id::bigint AS row_pos,
+                   {columns_sql}
+            FROM {table} r
+            JOIN current_uploaded_files uf ON r.file_id = uf.id
+            WHERE uf.club_name = %(club_name)s
+            AND uf.report_date >= %(start_date)s
+            AND uf.report_date <= %(end_date)s
+            {where_sql}
+        """
+
+    @classmethod
+    def _off_shift_block_source(cls, columns_sql: str) -> str:
+        """Расходы вне смены как дополнительный «файл» периода"""
+        return f"""
+            SELECT {cls.OFF_SHIFT_GROUP_POS}::bigint AS group_pos,
+                   ROW_NUMBER() OVER (ORDER BY ose.expense_date, ose.created_at, ose.id) AS row_pos,
+                   {columns_sql}
+            FROM off_shift_expenses ose
+            WHERE ose.club_name = %(club_name)s
+            AND ose.expense_date >= %(start_date)s
+            AND ose.expense_date <= %(end_date)s
+        """
+
+    @classmethod
+    def _block_period_sql(cls, block: str, include_off_shift: bool = True) -> str:
+        """
+        Запрос суммирования блока за период (PERIOD_BLOCKS), параметры club_name, start_date, end_date
+
+        Порядок статей как в сводных отчетах: сначала в порядке файла с наибольшим числом статей,
+        затем остальные статьи по первому появлению в периоде.
+        """
+        table, columns_sql, where_sql, item_columns, aggregates = PERIOD_BLOCKS[block]
+        source_sql = cls._period_block_source(table, columns_sql, where_sql)
+        if include_off_shift and table in PERIOD_OFF_SHIFT_COLUMNS:
+            source_sql += " UNION ALL " + cls._off_shift_block_source(PERIOD_OFF_SHIFT_COLUMNS[table])
+
+        items = ', '.join(item_columns)
+        return f"""
+            WITH source AS ({source_sql}),
+            file_items AS (
+                SELECT group_pos, {items}
+                FROM source
+                GROUP BY group_pos, {items}
+            ),
+            reference AS (
+                SELECT group_pos
+                FROM file_items
+                GROUP BY group_pos
+                ORDER BY COUNT(*) DESC, group_pos
+                LIMIT 1
+            )
+            SELECT {items}, {', '.join(aggregates)}
+            FROM source
+            GROUP BY {items}
+            ORDER BY
+                MIN(CASE WHEN group_pos = (SELECT group_pos FROM reference) THEN row_pos END) NULLS LAST,
+                MIN(ARRAY[group_pos, row_pos])
+        """
+
+    def _aggregate_block_period(self, block: str, club_name: str, start_date: date, end_date: date,
+                                include_off_shift: bool = True) -> List[Dict[str, Any]]:
+        """Суммирование блока за период одним запросом"""
+        with self.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                self._execute_prepared(
+                    cur,
+                    self._block_period_sql(block, include_off_shift),
+                    {'club_name': club_name, 'start_date': start_date, 'end_date': end_date}
+                )
+                return [dict(row) for row in cur.fetchall()]
+
+    def get_income_period(self, club_name: str, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+        """Суммы блока «Доходы» за период по категориям"""
+        return self._aggregate_block_period('income', club_name, start_date, end_date)
+
+    def get_ticket_sales_period(self, club_name: str, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+        """Суммы блока «Входные билеты» за период по ценам (без итоговых строк)"""
+        return self._aggregate_block_period('ticket_sales', club_name, start_date, end_date)
+
+    def get_payment_types_period(self, club_name: str, start_date: date, end_date: date) -> Dict[str, Any]:
+        """Суммы блока «Типы оплат» за период; «ИТОГО КАССА» считается отдельно"""
+        records = self._aggregate_block_period('payment_types', club_name, start_date, end_date)
+
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                self._execute_prepared(cur, PAYMENT_CASH_TOTAL_SQL, (club_name, start_date, end_date))
+                cash_total = cur.fetchone()[0]
+
+        return {'records': records, 'cash_total': cash_total}
+
+    def get_staff_statistics_period(self, club_name: str, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+        """Суммы блока «Статистика персонала» за период по должностям"""
+        return self._aggregate_block_period('staff_statistics', club_name, start_date, end_date)
+
+    def get_expense_records_period(self, club_name: str, start_date: date, end_date: date,
+                                   include_off_shift: bool = True) -> List[Dict[str, Any]]:
+        """Суммы блока «Расходы» за период по статьям (по умолчанию вместе с расходами вне смены)"""
+        return self._aggregate_block_period('expense_records', club_name, start_date, end_date, include_off_shift)
+
+    def get_cash_collection_period(self, club_name: str, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+        """Суммы блока «Инкассация» за период по парам (валюта, курс)"""
+        return self._aggregate_block_period('cash_collection', club_name, start_date, end_date)
+
+    def get_staff_debts_period(self, club_name: str, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+        """Суммы блока «Долги по персоналу» за период по типам долга"""
+        return self._aggregate_block_period('staff_debts', club_name, start_date, end_date)
+
+    def get_totals_summary_period(self, club_name: str, start_date: date, end_date: date,
+                                  include_off_shift: bool = True) -> List[Dict[str, Any]]:
+        """Суммы блока «Итоговый баланс» за период по типам оплаты (расходы вне смены идут в расход)"""
+        return self._aggregate_block_period('totals_summary', club_name, start_date, end_date, include_off_shift)
+
     def save_taxi_expenses(self, file_id: int, taxi_amount: Decimal, taxi_percent_amount: Decimal, deposits_total: Decimal, total_amount: Decimal) -> None:
         """Сохранение данных блока «ТАКСИ»"""
         with self.get_connection() as conn:
@@ -469,12 +1455,14 @@ class Database:
                     """,
                     (file_id, taxi_amount, taxi_percent_amount, deposits_total, total_amount)
                 )
+                self._refresh_daily_facts(cur, file_ids=[file_id])
 
     def get_taxi_expenses(self, file_id: int) -> Optional[Dict[str, Any]]:
         """Получение данных блока «ТАКСИ» по файлу"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
+                self._execute_prepared(
+                    cur,
                     """
                     SELECT taxi_amount, taxi_percent_amount, deposits_total, total_amount, created_at
                     FROM taxi_expenses
@@ -491,18 +1479,18 @@ class Database:
         """Получение данных блока «ТАКСИ» за период"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
+                self._execute_prepared(
+                    cur,
                     """
                     SELECT 
                         COALESCE(SUM(taxi_amount), 0) as total_taxi_amount,
                         COALESCE(SUM(taxi_percent_amount), 0) as total_taxi_percent_amount,
                         COALESCE(SUM(deposits_total), 0) as total_deposits_total,
-                        COALESCE(SUM(total_amount), 0) as total_amount
-                    FROM taxi_expenses te
-                    JOIN uploaded_files uf ON te.file_id = uf.id
-                    WHERE uf.club_name = %s
-                    AND uf.report_date >= %s
-                    AND uf.report_date <= %s
+                        COALESCE(SUM(taxi_total), 0) as total_amount
+                    FROM daily_club_facts
+                    WHERE club_name = %s
+                    AND report_date >= %s
+                    AND report_date <= %s
                     """,
                     (club_name, start_date, end_date)
                 )
@@ -550,7 +1538,8 @@ class Database:
         """Получение данных блока «Инкассация» по файлу"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
+                self._execute_prepared(
+                    cur,
                     """
                     SELECT currency_label, quantity, exchange_rate, amount, is_total, created_at
                     FROM cash_collection
@@ -588,12 +1577,14 @@ class Database:
                         for rec in records
                     ]
                 )
+                self._refresh_daily_facts(cur, file_ids=[file_id])
 
     def list_staff_debts(self, file_id: int) -> List[Dict[str, Any]]:
         """Получение данных блока «Долги по персоналу» по файлу"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
+                self._execute_prepared(
+                    cur,
                     """
                     SELECT debt_type, amount, is_total, created_at
                     FROM staff_debts
@@ -637,7 +1628,8 @@ class Database:
         """Получение данных блока «Примечание» по файлу"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
+                self._execute_prepared(
+                    cur,
                     """
                     SELECT category, entry_text, is_total, amount, created_at
                     FROM notes_entries
@@ -676,12 +1668,14 @@ class Database:
                         for row in rows
                     ]
                 )
+                self._refresh_daily_facts(cur, file_ids=[file_id])
 
     def list_totals_summary(self, file_id: int) -> List[Dict[str, Any]]:
         """Получение данных блока «Итого» по файлу"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
+                self._execute_prepared(
+                    cur,
                     """
                     SELECT payment_type, income_amount, expense_amount, net_profit, created_at
                     FROM totals_summary
@@ -692,6 +1686,299 @@ class Database:
                 )
                 return [dict(row) for row in cur.fetchall()]
 
+    @staticmethod
+    def _notes_records(notes_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Развертка блока «Примечание» (безнал / нал / прочее) в строки notes_entries"""
+        records: List[Dict[str, Any]] = []
+        if not notes_data:
+            return records
+
+        for category in ('безнал', 'нал'):
+            for entry in notes_data.get(category, []):
+                records.append({
+                    'category': entry.get('category', category),
+                    'entry_text': entry.get('entry_text', ''),
+                    'is_total': entry.get('is_total', False),
+                    'amount': entry.get('amount')
+                })
+
+        for text in notes_data.get('extra', []):
+            records.append({
+                'category': 'прочее',
+                'entry_text': text,
+                'is_total': False,
+                'amount': None
+            })
+
+        return records
+
+    def _report_block_rows(self, file_id: int, blocks: Dict[str, Any]) -> Dict[str, tuple]:
+        """Строки для вставки по таблицам: {table: (columns, rows)}"""
+        tickets = blocks.get('tickets') or {}
+        payments = blocks.get('payments') or {}
+        expenses = blocks.get('expenses') or {}
+        cash = blocks.get('cash') or {}
+        debts = blocks.get('debts') or {}
+        taxi = blocks.get('taxi') or {}
+
+        taxi_amount = taxi.get('taxi_amount', Decimal('0.00'))
+        taxi_percent_amount = taxi.get('taxi_percent_amount', Decimal('0.00'))
+        deposits_total = taxi.get('deposits_total', Decimal('0.00'))
+
+        return {
+            'income_records': (
+                ('file_id', 'category', 'amount'),
+                [(file_id, rec.get('category'), rec.get('amount')) for rec in blocks.get('income') or []]
+            ),
+            'ticket_sales': (
+                ('file_id', 'price_label', 'price_value', 'quantity', 'amount', 'is_total'),
+                [
+                    (file_id, rec.get('price_label'), rec.get('price_value'), rec.get('quantity'),
+                     rec.get('amount'), rec.get('is_total', False))
+                    for rec in tickets.get('records', [])
+                ]
+            ),
+            'payment_types': (
+                ('file_id', 'payment_type', 'amount', 'is_total', 'is_cash_total'),
+                [
+                    (file_id, rec.get('payment_type'), rec.get('amount'),
+                     rec.get('is_total', False), rec.get('is_cash_total', False))
+                    for rec in payments.get('records', [])
+                ]
+            ),
+            'staff_statistics': (
+                ('file_id', 'role_name', 'staff_count'),
+                [(file_id, rec.get('role_name'), rec.get('staff_count')) for rec in blocks.get('staff') or []]
+            ),
+            'expense_records': (
+                ('file_id', 'expense_item', 'amount', 'is_total'),
+                [
+                    (file_id, rec.get('expense_item'), rec.get('amount'), rec.get('is_total', False))
+                    for rec in expenses.get('records', [])
+                ]
+            ),
+            'misc_expenses_records': (
+                ('file_id', 'expense_item', 'amount', 'is_total'),
+                [
+                    (file_id, rec.get('expense_item'), rec.get('amount'), rec.get('is_total', False))
+                    for rec in blocks.get('misc_expenses_records') or []
+                ]
+            ),
+            'taxi_expenses': (
+                ('file_id', 'taxi_amount', 'taxi_percent_amount', 'deposits_total', 'total_amount'),
+                [(file_id, taxi_amount, taxi_percent_amount, deposits_total,
+                  taxi_amount + taxi_percent_amount + deposits_total)]
+            ),
+            'cash_collection': (
+                ('file_id', 'currency_label', 'quantity', 'exchange_rate', 'amount', 'is_total'),
+                [
+                    (file_id, rec.get('currency_label'), rec.get('quantity'), rec.get('exchange_rate'),
+                     rec.get('amount'), rec.get('is_total', False))
+                    for rec in cash.get('records', [])
+                ]
+            ),
+            'staff_debts': (
+                ('file_id', 'debt_type', 'amount', 'is_total'),
+                [
+                    (file_id, rec.get('debt_type'), rec.get('amount'), rec.get('is_total', False))
+                    for rec in debts.get('records', [])
+                ]
+            ),
+            'notes_entries': (
+                ('file_id', 'category', 'entry_text', 'is_total', 'amount'),
+                [
+                    (file_id, rec['category'], rec['entry_text'], rec['is_total'], rec['amount'])
+                    for rec in self._notes_records(blocks.get('notes'))
+                ]
+            ),
+            'totals_summary': (
+                ('file_id', 'payment_type', 'income_amount', 'expense_amount', 'net_profit'),
+                [
+                    (file_id, row.get('payment_type'), row.get('income_amount'),
+                     row.get('expense_amount'), row.get('net_profit'))
+                    for row in blocks.get('totals') or []
+                ]
+            ),
+        }
+
+    def save_parsed_report(self, file_id: int, blocks: Dict[str, Any],
+                           parser_version: Optional[str] = None) -> Dict[str, int]:
+        """
+        Сохранение всех блоков разобранного файла одной транзакцией
+
+        blocks — результат ExcelProcessor.extract_all_blocks. Прежние строки всех блоков
+        файла заменяются целиком, поэтому частично записанный отчет не виден другим запросам.
+        С parser_version в той же транзакции отмечается версия парсера файла
+        и блоки кладутся в кэш разбора по file_hash.
+
+        Returns:
+            Dict[str, int]: количество сохраненных строк по таблицам
+        """
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                saved = self._replace_report_blocks(cur, file_id, blocks, parser_version)
+
+        logger.info(f"Saved parsed report for file_id={file_id}: {saved}")
+        return saved
+
+    def _replace_report_blocks(self, cur, file_id: int, blocks: Dict[str, Any],
+                               parser_version: Optional[str]) -> Dict[str, int]:
+        rows_by_table = self._report_block_rows(file_id, blocks)
+        saved: Dict[str, int] = {}
+
+        # Все DELETE уходят одним запросом
+        cur.execute(
+            "; ".join(f"DELETE FROM {table} WHERE file_id = %(file_id)s" for table in REPORT_BLOCK_TABLES),
+            {'file_id': file_id}
+        )
+
+        # По одному INSERT ... VALUES на таблицу
+        for table, (columns, rows) in rows_by_table.items():
+            saved[table] = len(rows)
+            if not rows:
+                continue
+            execute_values(
+                cur,
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s",
+                rows,
+                page_size=len(rows)
+            )
+
+        if parser_version:
+            cur.execute(
+                "UPDATE uploaded_files SET parser_version = %s WHERE id = %s",
+                (parser_version, file_id)
+            )
+            cur.execute(
+                """
+                INSERT INTO parse_cache (file_hash, parser_version, blocks)
+                SELECT file_hash, %s, %s
+                FROM uploaded_files
+                WHERE id = %s AND file_hash IS NOT NULL
+                ON CONFLICT (file_hash, parser_version) DO NOTHING
+                """,
+                (parser_version, Json(blocks, dumps=self._dump_blocks), file_id)
+            )
+
+        self._refresh_daily_facts(cur, file_ids=[file_id])
+        return saved
+
+    def save_report_files(self, reports: List[Dict[str, Any]], parser_version: Optional[str] = None) -> List[int]:
+        """
+        Сохранение разобранных отчетов одной транзакцией (загрузка файла и пакетная загрузка)
+
+        Каждый элемент reports: user_id, username, file_name, file_content, file_hash, report_date,
+        club_name, data (строки листа для sheet_rows) и blocks (результат extract_all_blocks).
+        При ошибке откатывается весь пакет.
+
+        Returns:
+            List[int]: id сохраненных файлов в порядке reports
+        """
+        file_ids: List[int] = []
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                for report in reports:
+                    file_id = self._insert_uploaded_file(
+                        cur,
+                        report['user_id'],
+                        report['username'],
+                        report['file_name'],
+                        report['file_content'],
+                        len(report['data']),
+                        report.get('report_date'),
+                        report.get('club_name'),
+                        report.get('file_hash'),
+                    )
+                    self._copy_sheet_rows(cur, file_id, report['data'])
+                    self._replace_report_blocks(cur, file_id, report['blocks'], parser_version)
+                    file_ids.append(file_id)
+
+        logger.info(f"Saved batch of {len(file_ids)} reports: {file_ids}")
+        return file_ids
+
+    @staticmethod
+    def _encode_block_value(value: Any) -> Dict[str, str]:
+        """Значения, которых нет в JSON: {"$decimal": "..."}, {"$date": "..."}, {"$datetime": "..."}"""
+        if isinstance(value, Decimal):
+            return {'$decimal': str(value)}
+        if isinstance(value, datetime):
+            return {'$datetime': value.isoformat()}
+        if isinstance(value, date):
+            return {'$date': value.isoformat()}
+        raise TypeError(f"Cannot store {type(value).__name__} in parse cache")
+
+    @staticmethod
+    def _decode_block_value(obj: Dict[str, Any]) -> Any:
+        if len(obj) == 1:
+            if '$decimal' in obj:
+                return Decimal(obj['$decimal'])
+            if '$datetime' in obj:
+                return datetime.fromisoformat(obj['$datetime'])
+            if '$date' in obj:
+                return date.fromisoformat(obj['$date'])
+        return obj
+
+    @classmethod
+    def _dump_blocks(cls, blocks: Dict[str, Any]) -> str:
+        """Сериализация блоков для кэша разбора в JSON (Decimal и даты сохраняются без потерь)"""
+        return json.dumps(blocks, ensure_ascii=False, default=cls._encode_block_value)
+
+    @classmethod
+    def _load_blocks(cls, text: str) -> Dict[str, Any]:
+        return json.loads(text, object_hook=cls._decode_block_value)
+
+    def get_cached_blocks(self, file_hash: str, parser_version: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Блоки из кэша разбора для содержимого файла и версии парсера"""
+        if not file_hash or not parser_version:
+            return None
+
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT blocks::text FROM parse_cache WHERE file_hash = %s AND parser_version = %s",
+                    (file_hash, parser_version)
+                )
+                result = cur.fetchone()
+
+        if not result:
+            return None
+        try:
+            return self._load_blocks(result[0])
+        except Exception as e:
+            logger.warning(f"Broken parse cache entry for hash {file_hash}: {e}")
+            return None
+
+    def get_uploaded_file_by_hash(self, club_name: str, file_hash: str) -> Optional[Dict[str, Any]]:
+        """Ранее загруженный файл клуба с тем же содержимым"""
+        with self.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f"""
+                    SELECT {UPLOADED_FILE_COLUMNS}
+                    FROM uploaded_files
+                    WHERE club_name = %s AND file_hash = %s
+                    """,
+                    (club_name, file_hash)
+                )
+                return cur.fetchone()
+
+    def get_uploaded_files_by_hashes(self, club_name: str, file_hashes: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Ранее загруженные файлы клуба по хэшам содержимого (одним запросом): file_hash -> файл"""
+        if not file_hashes:
+            return {}
+
+        with self.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f"""
+                    SELECT {UPLOADED_FILE_COLUMNS}
+                    FROM uploaded_files
+                    WHERE club_name = %s AND file_hash = ANY(%s)
+                    """,
+                    (club_name, list(file_hashes))
+                )
+                return {row['file_hash']: row for row in cur.fetchall()}
+
     def clear_uploaded_files(self) -> int:
         """Полная очистка загруженных файлов и связанных данных"""
         with self.get_connection() as conn:
@@ -699,6 +1986,8 @@ class Database:
                 # Удаляем файлы (связанные данные удалятся через CASCADE)
                 cur.execute("DELETE FROM uploaded_files RETURNING id")
                 deleted_files = cur.fetchall()
+                cur.execute("DELETE FROM daily_club_facts")
+                cur.execute("DELETE FROM file_blobs")
                 
                 # Удаляем расходы вне смены
                 cur.execute("DELETE FROM off_shift_expenses RETURNING id")
@@ -744,30 +2033,53 @@ class Database:
                 cur.execute("SELECT COUNT(*) FROM employees")
                 return cur.fetchone()[0]
 
+    @staticmethod
+    def _like_pattern(text: str) -> str:
+        """Шаблон ILIKE «содержит text» (символы %, _ и \\ в тексте ищутся буквально)"""
+        escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return f"%{escaped}%"
+
     def search_employees(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
-        """Поиск сотрудников по ФИО"""
+        """
+        Поиск сотрудников по части ФИО или кода
+
+        С pg_trgm находятся и ФИО с опечатками (похожие слова), результаты упорядочены
+        по похожести; точное совпадение кода всегда первое.
+        """
+        query = query.strip()
+        if not query:
+            return []
+
+        if self.trigram_search:
+            match_sql = "OR %(query)s <%% full_name"
+            rank_sql = "GREATEST(word_similarity(%(query)s, full_name), similarity(employee_code, %(query)s)) DESC,"
+        else:
+            match_sql = ""
+            rank_sql = ""
+
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                like_query = f"%{query}%"
                 cur.execute(
-                    """
+                    f"""
                     SELECT employee_code, full_name, created_at
                     FROM employees
-                    WHERE full_name ILIKE %s
-                    ORDER BY full_name
-                    LIMIT %s
+                    WHERE full_name ILIKE %(pattern)s
+                    OR employee_code ILIKE %(pattern)s
+                    {match_sql}
+                    ORDER BY UPPER(employee_code) = UPPER(%(query)s) DESC, {rank_sql} full_name
+                    LIMIT %(limit)s
                     """,
-                    (like_query, limit)
+                    {'query': query, 'pattern': self._like_pattern(query), 'limit': limit}
                 )
                 return [dict(row) for row in cur.fetchall()]
 
     # --- Запросы к Excel данным ---
 
-    def count_excel_records(self) -> int:
-        """Количество записей в excel_data"""
+    def count_sheet_rows(self) -> int:
+        """Количество строк исходных листов (по row_count файлов, без чтения sheet_rows)"""
         with self.get_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM excel_data")
+                cur.execute("SELECT COALESCE(SUM(row_count), 0) FROM uploaded_files")
                 return cur.fetchone()[0]
 
     def list_recent_files(self, limit: int = 10) -> List[Dict[str, Any]]:
@@ -803,6 +2115,9 @@ class Database:
     def set_uploaded_file_report_date(self, file_id: int, report_date: date) -> None:
         with self.get_connection() as conn:
             with conn.cursor() as cur:
+                # Дневные показатели пересчитываются и для прежней даты файла
+                cur.execute("SELECT club_name, report_date FROM uploaded_files WHERE id = %s", (file_id,))
+                previous = cur.fetchone()
                 cur.execute(
                     """
                     UPDATE uploaded_files
@@ -811,12 +2126,15 @@ class Database:
                     """,
                     (report_date, file_id)
                 )
+                keys = [(previous[0], previous[1])] if previous else []
+                self._refresh_daily_facts(cur, file_ids=[file_id], keys=keys)
 
     def get_report_dates(self, club_name: Optional[str] = None) -> List[date]:
         with self.get_connection() as conn:
             with conn.cursor() as cur:
                 if club_name and club_name != 'Оба':
-                    cur.execute(
+                    self._execute_prepared(
+                        cur,
                         """
                         SELECT DISTINCT report_date
                         FROM uploaded_files
@@ -827,7 +2145,8 @@ class Database:
                     )
                 else:
                     # Режим "Оба" - показываем все даты
-                    cur.execute(
+                    self._execute_prepared(
+                        cur,
                         """
                         SELECT DISTINCT report_date
                         FROM uploaded_files
@@ -842,21 +2161,21 @@ class Database:
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
                 if club_name and club_name != 'Оба':
-                    cur.execute(
-                        """
-                        SELECT *
-                        FROM uploaded_files
+                    self._execute_prepared(
+                        cur,
+                        f"""
+                        SELECT {UPLOADED_FILE_COLUMNS}
+                        FROM current_uploaded_files
                         WHERE report_date = %s AND club_name = %s
-                        ORDER BY upload_date DESC
-                        LIMIT 1
                         """,
                         (report_date, club_name)
                     )
                 else:
                     # Режим "Оба" - берем последний файл за дату (любой клуб)
-                    cur.execute(
-                        """
-                        SELECT *
+                    self._execute_prepared(
+                        cur,
+                        f"""
+                        SELECT {UPLOADED_FILE_COLUMNS}
                         FROM uploaded_files
                         WHERE report_date = %s
                         ORDER BY upload_date DESC
@@ -868,13 +2187,14 @@ class Database:
                 return dict(result) if result else None
 
     def get_files_by_period(self, start_date: date, end_date: date, club_name: str) -> List[Dict[str, Any]]:
-        """Получить все файлы за период для клуба"""
+        """Файлы клуба за период: по одному (последнему загруженному) на дату отчета"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
-                    """
-                    SELECT *
-                    FROM uploaded_files
+                self._execute_prepared(
+                    cur,
+                    f"""
+                    SELECT {UPLOADED_FILE_COLUMNS}
+                    FROM current_uploaded_files
                     WHERE report_date >= %s AND report_date <= %s AND club_name = %s
                     ORDER BY report_date ASC
                     """,
@@ -883,86 +2203,413 @@ class Database:
                 results = cur.fetchall()
                 return [dict(row) for row in results]
 
-    def get_file_preview(self, file_id: int, limit: int = 10) -> List[Dict[str, Any]]:
-        """Предпросмотр строк конкретного файла"""
+    def get_period_version(self, club_name: str, start_date: date, end_date: date) -> Tuple[int, Optional[datetime]]:
+        """Версия данных периода для кэша отчетов: число файлов и последняя дата загрузки"""
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                self._execute_prepared(
+                    cur,
+                    """
+                    SELECT COUNT(*), MAX(upload_date)
+                    FROM uploaded_files
+                    WHERE report_date >= %s AND report_date <= %s AND club_name = %s
+                    """,
+                    (start_date, end_date, club_name)
+                )
+                count, last_upload = cur.fetchone()
+                return count, last_upload
+
+    def get_file_content(self, file_id: int) -> Optional[bytes]:
+        """Содержимое загруженного файла из file_blobs (читается только по запросу)"""
+        rows = self.get_file_contents([file_id])
+        return rows[0]['file_content'] if rows else None
+
+    def get_file_contents(self, file_ids: List[int]) -> List[Dict[str, Any]]:
+        """
+        Содержимое пачки файлов (для потоковой переобработки)
+
+        Содержимое читается из file_blobs и распаковывается.
+        """
+        if not file_ids:
+            return []
+
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
                 cur.execute(
                     """
-                    SELECT row_number, column_name, column_value
-                    FROM excel_data
-                    WHERE file_id = %s
-                    ORDER BY row_number, column_name
+                    SELECT uf.id, uf.file_name, uf.file_hash, b.codec, b.content
+                    FROM uploaded_files uf
+                    LEFT JOIN file_blobs b ON b.file_hash = uf.file_hash
+                    WHERE uf.id = ANY(%s)
+                    ORDER BY uf.id
                     """,
-                    (file_id,)
+                    (list(file_ids),)
                 )
+                rows = cur.fetchall()
 
-                preview: List[Dict[str, Any]] = []
-                current_row = None
-                row_data: Dict[str, Any] = {}
+        files = []
+        for row in rows:
+            if row['content'] is not None:
+                file_content = self._decompress_blob(row['codec'], bytes(row['content']))
+            else:
+                file_content = None
+            files.append({
+                'id': row['id'],
+                'file_name': row['file_name'],
+                'file_hash': row['file_hash'],
+                'file_content': file_content
+            })
+        return files
+
+    # --- Переобработка файлов ---
+
+    def start_reprocess_run(self, user_id: int, parser_version: Optional[str] = None,
+                            force: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Запуск переобработки всех файлов пользователя
+
+        Если предыдущий запуск не завершился (сбой, перезапуск бота), он продолжается:
+        обработанные файлы повторно не разбираются. Файлы, уже разобранные текущей
+        версией парсера, сразу отмечаются как skipped; с force переобрабатываются все файлы
+        (например, после исправления сохранения блоков). Возвращает None, если файлов нет.
+        """
+        with self.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    """
+                    SELECT id, user_id, status, total_files, started_at
+                    FROM reprocess_runs
+                    WHERE user_id = %s AND status = 'running'
+                    ORDER BY id DESC
+                    LIMIT 1
+                    FOR UPDATE
+                    """,
+                    (user_id,)
+                )
+                run = cur.fetchone()
+                if run:
+                    run = dict(run)
+                    run['resumed'] = True
+                    return run
 
-                for record in cur.fetchall():
-                    row_number = record['row_number']
-                    column_name = record['column_name']
-                    column_value = record['column_value']
+                cur.execute(
+                    """
+                    INSERT INTO reprocess_runs (user_id, total_files)
+                    SELECT %s, COUNT(*) FROM uploaded_files WHERE user_id = %s
+                    RETURNING id, user_id, status, total_files, started_at
+                    """,
+                    (user_id, user_id)
+                )
+                run = dict(cur.fetchone())
+                if not run['total_files']:
+                    conn.rollback()
+                    return None
 
-                    if current_row is None:
-                        current_row = row_number
+                cur.execute(
+                    """
+                    INSERT INTO reprocess_run_files (run_id, file_id, status, processed_at)
+                    SELECT %(run_id)s, id,
+                           CASE WHEN NOT %(force)s AND parser_version = %(parser_version)s
+                                THEN 'skipped' ELSE 'pending' END,
+                           CASE WHEN NOT %(force)s AND parser_version = %(parser_version)s
+                                THEN CURRENT_TIMESTAMP END
+                    FROM uploaded_files
+                    WHERE user_id = %(user_id)s
+                    """,
+                    {'run_id': run['id'], 'parser_version': parser_version, 'user_id': user_id, 'force': force}
+                )
+                run['resumed'] = False
+                return run
 
-                    if row_number != current_row:
-                        preview.append({'row_number': current_row, 'data': row_data})
-                        if len(preview) >= limit:
-                            break
-                        current_row = row_number
-                        row_data = {}
+    def get_pending_reprocess_files(self, run_id: int) -> List[int]:
+        """Файлы запуска, которые еще не обработаны (новые сначала, как в списке файлов)"""
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT rf.file_id
+                    FROM reprocess_run_files rf
+                    JOIN uploaded_files uf ON rf.file_id = uf.id
+                    WHERE rf.run_id = %s AND rf.status = 'pending'
+                    ORDER BY uf.upload_date DESC
+                    """,
+                    (run_id,)
+                )
+                return [row[0] for row in cur.fetchall()]
 
-                    row_data[column_name] = column_value
+    def mark_reprocess_file(self, run_id: int, file_id: int, status: str, error_message: Optional[str] = None):
+        """Фиксация результата обработки одного файла запуска"""
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE reprocess_run_files
+                    SET status = %s, error_message = %s, processed_at = CURRENT_TIMESTAMP
+                    WHERE run_id = %s AND file_id = %s
+                    """,
+                    (status, error_message, run_id, file_id)
+                )
 
-                if current_row is not None and len(preview) < limit:
-                    preview.append({'row_number': current_row, 'data': row_data})
+    def get_reprocess_run_progress(self, run_id: int) -> Dict[str, int]:
+        """Счетчики файлов запуска по статусам"""
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT status, COUNT(*)
+                    FROM reprocess_run_files
+                    WHERE run_id = %s
+                    GROUP BY status
+                    """,
+                    (run_id,)
+                )
+                counts = {'pending': 0, 'done': 0, 'error': 0, 'skipped': 0}
+                counts.update({status: count for status, count in cur.fetchall()})
+                return counts
 
-                return preview[:limit]
+    def finish_reprocess_run(self, run_id: int, status: str = 'finished'):
+        """Завершение запуска переобработки"""
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE reprocess_runs
+                    SET status = %s, finished_at = CURRENT_TIMESTAMP
+                    WHERE id = %s
+                    """,
+                    (status, run_id)
+                )
 
-    def search_excel_by_column(self, column_name: str, search_value: str, limit: int = 10) -> List[Dict[str, Any]]:
-        """Поиск строк по указанной колонке"""
+    # --- Очередь задач разбора ---
+
+    def enqueue_job(self, kind: str, user_id: int, payload: Optional[Dict[str, Any]] = None,
+                    file_content: Optional[bytes] = None, chat_id: Optional[int] = None,
+                    message_id: Optional[int] = None) -> int:
+        """Постановка задачи в очередь (upload - разбор загруженного файла, reprocess - переобработка)"""
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO ingest_jobs (kind, user_id, chat_id, message_id, payload, file_content)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    RETURNING id
+                    """,
+                    (kind, user_id, chat_id, message_id, Json(payload or {}),
+                     psycopg2.Binary(file_content) if file_content is not None else None)
+                )
+                job_id = cur.fetchone()[0]
+                logger.info(f"Job {job_id} ({kind}) queued for user {user_id}")
+                return job_id
+
+    def claim_job(self, worker_id: str, lease_seconds: float = 120, max_attempts: int = 3) -> Optional[Dict[str, Any]]:
+        """
+        Захват следующей задачи из очереди воркером
+
+        Задачи воркеров, переставших обновлять heartbeat_at дольше lease_seconds, возвращаются в очередь
+        (после max_attempts попыток - завершаются с ошибкой). Задача берется через FOR UPDATE SKIP LOCKED,
+        поэтому воркеры не ждут друг друга и не получают одну задачу дважды.
+        """
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
                 cur.execute(
                     """
-                    WITH matches AS (
-                        SELECT file_id, row_number
-                        FROM excel_data
-                        WHERE column_name = %s AND column_value ILIKE %s
-                        ORDER BY row_number
-                        LIMIT %s
-                    )
-                    SELECT m.file_id,
-                           m.row_number,
-                           e.column_name,
-                           e.column_value,
-                           u.file_name
-                    FROM matches m
-                    JOIN excel_data e ON e.file_id = m.file_id AND e.row_number = m.row_number
-                    JOIN uploaded_files u ON u.id = m.file_id
-                    ORDER BY u.upload_date DESC, m.row_number, e.column_name
+                    UPDATE ingest_jobs
+                    SET status = CASE WHEN attempts >= %(max_attempts)s THEN 'error' ELSE 'queued' END,
+                        error_message = CASE WHEN attempts >= %(max_attempts)s THEN 'worker lost' ELSE error_message END,
+                        finished_at = CASE WHEN attempts >= %(max_attempts)s THEN CURRENT_TIMESTAMP ELSE NULL END,
+                        worker_id = NULL
+                    WHERE status = 'running'
+                      AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %(lease_seconds)s)
+                    RETURNING id, status
                     """,
-                    (column_name, f"%{search_value}%", limit)
+                    {'max_attempts': max_attempts, 'lease_seconds': lease_seconds}
                 )
+                for row in cur.fetchall():
+                    logger.warning(f"Job {row['id']} lost its worker, now {row['status']}")
 
-                grouped: Dict[tuple, Dict[str, Any]] = {}
+                cur.execute(
+                    """
+                    UPDATE ingest_jobs AS job
+                    SET status = 'running',
+                        worker_id = %s,
+                        attempts = job.attempts + 1,
+                        started_at = CURRENT_TIMESTAMP,
+                        heartbeat_at = CURRENT_TIMESTAMP
+                    FROM (
+                        SELECT id
+                        FROM ingest_jobs
+                        WHERE status = 'queued'
+                        ORDER BY id
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    ) AS next_job
+                    WHERE job.id = next_job.id
+                    RETURNING job.*
+                    """,
+                    (worker_id,)
+                )
+                return cur.fetchone()
 
-                for record in cur.fetchall():
-                    key = (record['file_id'], record['row_number'])
-                    if key not in grouped:
-                        grouped[key] = {
-                            'file_name': record['file_name'],
-                            'row_number': record['row_number'],
-                            'data': {}
-                        }
-                    grouped[key]['data'][record['column_name']] = record['column_value']
+    def heartbeat_job(self, job_id: int, worker_id: str, progress: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        Отметка, что воркер жив, и текущий прогресс задачи
+
+        Returns:
+            False, если задача уже не принадлежит воркеру (срок аренды истек, задачу забрал другой воркер)
+        """
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE ingest_jobs
+                    SET heartbeat_at = CURRENT_TIMESTAMP, progress = COALESCE(%s, progress)
+                    WHERE id = %s AND worker_id = %s AND status = 'running'
+                    """,
+                    (Json(progress) if progress is not None else None, job_id, worker_id)
+                )
+                return cur.rowcount > 0
+
+    def finish_job(self, job_id: int, worker_id: str, status: str, result: Optional[Dict[str, Any]] = None,
+                   error_message: Optional[str] = None) -> bool:
+        """
+        Завершение задачи (done / error); содержимое файла больше не нужно и удаляется
+
+        Returns:
+            False, если задача уже не принадлежит воркеру - результат не записывается
+        """
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE ingest_jobs
+                    SET status = %s, result = %s, error_message = %s,
+                        finished_at = CURRENT_TIMESTAMP, file_content = NULL
+                    WHERE id = %s AND worker_id = %s AND status = 'running'
+                    """,
+                    (status, Json(result) if result is not None else None, error_message, job_id, worker_id)
+                )
+                return cur.rowcount > 0
+
+    def get_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Состояние задачи для показа прогресса"""
+        with self.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"SELECT {INGEST_JOB_COLUMNS} FROM ingest_jobs WHERE id = %s", (job_id,))
+                return cur.fetchone()
+
+    def get_active_job(self, kind: str, user_id: int) -> Optional[Dict[str, Any]]:
+        """Незавершенная задача пользователя этого вида (чтобы не ставить переобработку дважды)"""
+        with self.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f"""
+                    SELECT {INGEST_JOB_COLUMNS}
+                    FROM ingest_jobs
+                    WHERE kind = %s AND user_id = %s AND status IN ('queued', 'running')
+                    ORDER BY id
+                    LIMIT 1
+                    """,
+                    (kind, user_id)
+                )
+                return cur.fetchone()
+
+    def get_unnotified_jobs(self) -> List[Dict[str, Any]]:
+        """Задачи, о результате которых пользователю еще не сообщили: завершенные и выполняемые с прогрессом"""
+        with self.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f"""
+                    SELECT {INGEST_JOB_COLUMNS}
+                    FROM ingest_jobs
+                    WHERE notified_at IS NULL AND chat_id IS NOT NULL
+                    AND (status IN ('done', 'error') OR (status = 'running' AND progress IS NOT NULL))
+                    ORDER BY id
+                    """
+                )
+                return cur.fetchall()
+
+    def mark_job_notified(self, job_id: int):
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE ingest_jobs SET notified_at = CURRENT_TIMESTAMP WHERE id = %s",
+                    (job_id,)
+                )
+
+    @staticmethod
+    def _sheet_row_data(data: Dict[str, Any]) -> Dict[str, Any]:
+        """Ячейки строки в порядке колонок по алфавиту (JSONB не хранит порядок ключей)"""
+        return dict(sorted(data.items()))
+
+    def get_file_preview(self, file_id: int, limit: int = 10) -> List[Dict[str, Any]]:
+        """Предпросмотр первых строк файла (читаются только limit строк по первичному ключу)"""
+        with self.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                self._execute_prepared(
+                    cur,
+                    """
+                    SELECT row_number, data
+                    FROM sheet_rows
+                    WHERE file_id = %s
+                    ORDER BY row_number
+                    LIMIT %s
+                    """,
+                    (file_id, limit)
+                )
+                return [
+                    {'row_number': row['row_number'], 'data': self._sheet_row_data(row['data'])}
+                    for row in cur.fetchall()
+                ]
+
+    def search_excel_by_column(self, column_name: str, search_value: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        Поиск строк, в которых значение колонки содержит search_value
+
+        Строки с колонкой отбираются по GIN индексу sheet_rows (data ? колонка). С pg_trgm подстрока
+        сначала ищется по триграммному индексу текста строки, а строки упорядочены по похожести
+        значения на искомое (сначала ячейки, почти совпадающие с ним).
+        """
+        value_sql = "data->>%(column_name)s"
+        rank_sql = f"word_similarity(%(value)s, {value_sql})" if self.trigram_search else "0"
+        # В JSON тексте строки кавычки и обратная косая черта экранированы - такой текст индекс не найдет
+        prefilter_sql = (
+            "AND data::text ILIKE %(pattern)s"
+            if self.trigram_search and search_value.isprintable() and not set('"\\') & set(search_value)
+            else ""
+        )
+        with self.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f"""
+                    SELECT m.file_id, m.row_number, m.data, u.file_name
+                    FROM (
+                        SELECT file_id, row_number, data, {rank_sql} AS rank
+                        FROM sheet_rows
+                        WHERE data ? %(column_name)s
+                        AND {value_sql} ILIKE %(pattern)s
+                        {prefilter_sql}
+                        ORDER BY rank DESC, file_id DESC, row_number
+                        LIMIT %(limit)s
+                    ) m
+                    JOIN uploaded_files u ON u.id = m.file_id
+                    ORDER BY m.rank DESC, u.upload_date DESC, m.row_number
+                    """,
+                    {
+                        'column_name': column_name,
+                        'value': search_value,
+                        'pattern': self._like_pattern(search_value),
+                        'limit': limit
+                    }
+                )
+                return [
+                    {
+                        'file_name': row['file_name'],
+                        'row_number': row['row_number'],
+                        'data': self._sheet_row_data(row['data'])
+                    }
+                    for row in cur.fetchall()
+                ]
 
-                return list(grouped.values())
- 
     def execute_query(self, sql: str, params: tuple = None) -> List[Dict[str, Any]]:
         """Выполнение SQL запроса и возврат результатов"""
         with self.get_connection() as conn:
@@ -1015,6 +2662,7 @@ class Database:
                         is_nullable
                     FROM information_schema.columns
                     WHERE table_schema = 'public'
+                    AND table_name <> 'excel_data_legacy'
                     ORDER BY table_name, ordinal_position
                 """)
                 columns = cur.fetchall()
@@ -1060,6 +2708,23 @@ class Database:
                 )
                 return [dict(row) for row in cur.fetchall()]
 
+    def get_latest_user_file(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Последний загруженный файл пользователя"""
+        with self.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    """
+                    SELECT id, file_name, row_count, report_date, club_name
+                    FROM uploaded_files
+                    WHERE user_id = %s
+                    ORDER BY upload_date DESC
+                    LIMIT 1
+                    """,
+                    (user_id,)
+                )
+                result = cur.fetchone()
+                return dict(result) if result else None
+
     # --- Работа с расходами вне смены ---
 
     def add_off_shift_expense(self, user_id: int, username: str, club_name: str, 
@@ -1087,7 +2752,8 @@ class Database:
         """Получение расходов вне смены за период по клубу"""
         with self.get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
+                self._execute_prepared(
+                    cur,
                     """
                     SELECT id, expense_item, amount, payment_type, expense_date, created_at
                     FROM off_shift_expenses
@@ -1158,4 +2824,13 @@ class Database:
                     return True
                 return False
 
+    def delete_off_shift_expense(self, expense_id: int) -> bool:
+        """Удаление расхода вне смены"""
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM off_shift_expenses WHERE id = %s", (expense_id,))
+                if cur.rowcount:
+                    logger.info(f"Off-shift expense deleted: ID={expense_id}")
+                return cur.rowcount > 0
+
 
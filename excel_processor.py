@@ -2,11 +2,16 @@
 Модуль для обработки Excel файлов
 """
 import pandas as pd
+import numpy as np
+import hashlib
 import logging
-from typing import List, Dict, Any, Tuple, Optional
+import os
+from typing import List, Dict, Any, Tuple, Optional, Union, Callable
 from decimal import Decimal, InvalidOperation
 import io
 import re
+from collections import OrderedDict
+from functools import lru_cache
 
 # Логирование настроено в bot.py, здесь только получаем logger
 import logging
@@ -14,6 +19,368 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+def _parser_version() -> Optional[str]:
+    """Версия парсера - хэш исходного кода модуля, меняется при любой правке экстракторов"""
+    try:
+        with open(__file__, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()[:16]
+    except OSError:
+        return None
+
+
+# Загрузчик листа: 'stream' - потоковое чтение openpyxl в сетку значений, 'pandas' - pd.read_excel
+SHEET_LOADER = os.getenv('EXCEL_SHEET_LOADER', 'stream').strip().lower()
+
+# Ключ кэша разобранных блоков вместе с file_hash (None - кэш отключен)
+PARSER_VERSION = f"{_parser_version()}-{SHEET_LOADER}" if _parser_version() else None
+
+# Строки, которые pd.read_excel по умолчанию считает пустыми значениями
+READ_EXCEL_NA_VALUES = frozenset({
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+})
+
+
+def load_sheet_grid(file_content: bytes) -> List[List[Any]]:
+    """
+    Потоковое чтение первого листа в компактную сетку значений (str, int, float, datetime или None)
+
+    openpyxl открывается в режиме read_only/data_only: строки читаются по одной без модели стилей.
+    Значения приводятся так же, как в pd.read_excel: целые числа из float становятся int,
+    ячейки с ошибкой и пустые строки - None; хвостовые пустые строки и колонки обрезаются.
+    """
+    from openpyxl import load_workbook as openpyxl_load_workbook
+    from openpyxl.cell.cell import TYPE_ERROR
+
+    workbook = openpyxl_load_workbook(io.BytesIO(file_content), read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = workbook.worksheets[0]
+        sheet.reset_dimensions()
+
+        grid: List[List[Any]] = []
+        last_row_with_data = -1
+        for row in sheet.rows:
+            values = []
+            for cell in row:
+                value = cell.value
+                if value is None or getattr(cell, 'data_type', None) == TYPE_ERROR:
+                    value = None
+                elif isinstance(value, float):
+                    int_value = int(value)
+                    if int_value == value:
+                        value = int_value
+                elif isinstance(value, str) and value in READ_EXCEL_NA_VALUES:
+                    value = None
+                values.append(value)
+
+            while values and values[-1] is None:
+                values.pop()
+            if values:
+                last_row_with_data = len(grid)
+            grid.append(values)
+    finally:
+        workbook.close()
+
+    del grid[last_row_with_data + 1:]
+    width = max((len(row) for row in grid), default=0)
+    for row in grid:
+        if len(row) < width:
+            row.extend([None] * (width - len(row)))
+    return grid
+
+
+def _grid_to_frame(grid: List[List[Any]]) -> pd.DataFrame:
+    """DataFrame с типами колонок как у pd.read_excel(header=None)"""
+    if not grid or not grid[0]:
+        return pd.DataFrame()
+
+    columns = {}
+    for col_idx, column in enumerate(zip(*grid)):
+        values = [np.nan if value is None else value for value in column]
+        numeric = all(
+            isinstance(value, (int, float)) and not isinstance(value, bool)
+            for value in values
+        )
+        if numeric:
+            has_float = any(isinstance(value, float) for value in values)
+            columns[col_idx] = np.array(values, dtype=np.float64 if has_float else np.int64)
+        else:
+            columns[col_idx] = np.array(values, dtype=object)
+    return pd.DataFrame(columns)
+
+
+def _grid_to_text_frame(grid: List[List[Any]]) -> pd.DataFrame:
+    """DataFrame со строковыми значениями как у pd.read_excel(header=None, dtype=str)"""
+    if not grid or not grid[0]:
+        return pd.DataFrame()
+
+    return pd.DataFrame(
+        [[np.nan if value is None else str(value) for value in row] for row in grid],
+        dtype=object
+    )
+
+
+# Размер кэша разобранных сумм: в отчетах постоянно повторяются одни и те же значения ("0", "1 500,00")
+MONEY_CACHE_SIZE = int(os.getenv('MONEY_CACHE_SIZE', '4096'))
+_MONEY_QUANT = Decimal('0.01')
+_MONEY_CLEAN_RE = re.compile(r'[^0-9,\.\-]')
+
+
+@lru_cache(maxsize=MONEY_CACHE_SIZE, typed=True)
+def _money_from_scalar(value: Union[int, float, Decimal, str]) -> Optional[Decimal]:
+    """Сумма с точностью до копейки из числа или строки; None - строку разобрать не удалось"""
+    if not isinstance(value, str):
+        return Decimal(str(value)).quantize(_MONEY_QUANT)
+
+    cleaned = _MONEY_CLEAN_RE.sub('', value)
+    cleaned = cleaned.replace(' ', '').replace(',', '.').strip()
+    if cleaned == '':
+        return Decimal('0')
+    try:
+        return Decimal(cleaned).quantize(_MONEY_QUANT)
+    except InvalidOperation:
+        return None
+
+
+def _is_blank(value: Any) -> bool:
+    # NaN - единственное значение, не равное самому себе (дешевле pd.isna для скаляра)
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def parse_money(value: Any) -> Decimal:
+    """Сумма из значения ячейки (пустая или неразобранная ячейка - 0)"""
+    if _is_blank(value):
+        return Decimal('0')
+
+    if isinstance(value, (int, float, Decimal, str)):
+        parsed = _money_from_scalar(value)
+        if parsed is None:
+            logger.warning(f"Failed to parse decimal from string '{value}'")
+            return Decimal('0')
+        return parsed
+
+    logger.warning(f"Unsupported value type for decimal parsing: {value} ({type(value)})")
+    return Decimal('0')
+
+
+# Сколько последних раскладок листа (координат заголовков) помнит процесс
+LAYOUT_CACHE_SIZE = int(os.getenv('LAYOUT_CACHE_SIZE', '8'))
+
+
+class SheetAnchorIndex:
+    """
+    Индекс текстовых ячеек листа для поиска заголовков блоков
+
+    Строится одним проходом: координаты строковых ячеек с ключевыми словами складываются
+    в списки в порядке обхода (строка, затем колонка). Экстракторы ищут свои заголовки
+    по индексу вместо сканирования всего листа.
+
+    Раскладка (координаты ключевых ячеек) запоминается: отчеты клубов приходят по одному шаблону,
+    и для следующего файла проверяется весь отпечаток - ключевые слова стоят ровно в запомненных
+    ячейках и больше нигде на листе. Если проверка не прошла - лист сканируется полностью.
+    """
+
+    KEYWORDS = (
+        'доход',
+        'расход',
+        'входные билеты',
+        'наличные',
+        'статистика',
+        'инкассация',
+        'примечан',
+        'прочие расходы',
+    )
+
+    # Одно регулярное выражение на все ключевые слова - проверка отпечатка без перебора слов по каждой ячейке
+    _KEYWORD_PATTERN = re.compile('|'.join(map(re.escape, KEYWORDS)))
+
+    # Раскладки, известные процессу: отпечаток (координаты ключевых ячеек) -> координаты по ключевым словам
+    _known_layouts: 'OrderedDict[Tuple, Dict[str, Tuple[Tuple[int, int], ...]]]' = OrderedDict()
+
+    def __init__(self, rows: List[List[Any]], cells: Optional[Dict[str, List[Tuple[int, int]]]] = None):
+        self.rows = rows
+        self.from_layout = cells is not None
+        if cells is not None:
+            self.cells = cells
+            return
+
+        self.cells = {keyword: [] for keyword in self.KEYWORDS}
+        for row_idx, row in enumerate(rows):
+            for col_idx, value in enumerate(row):
+                if not isinstance(value, str):
+                    continue
+                normalized = value.strip().lower()
+                for keyword in self.KEYWORDS:
+                    if keyword in normalized:
+                        self.cells[keyword].append((row_idx, col_idx))
+
+    @classmethod
+    def build(cls, rows: List[List[Any]]) -> 'SheetAnchorIndex':
+        """Индекс по известной раскладке, если она подтверждается, иначе полным проходом с запоминанием"""
+        for fingerprint, layout in cls._known_layouts.items():
+            if cls._layout_matches(rows, layout):
+                cls._known_layouts.move_to_end(fingerprint, last=False)
+                return cls(rows, {keyword: list(cells) for keyword, cells in layout.items()})
+
+        index = cls(rows)
+        index._remember_layout()
+        return index
+
+    @classmethod
+    def _layout_matches(cls, rows: List[List[Any]], layout: Dict[str, Tuple[Tuple[int, int], ...]]) -> bool:
+        # Отпечаток: для каждой ячейки раскладки - набор ключевых слов в ней
+        expected: Dict[Tuple[int, int], set] = {}
+        for keyword, cells in layout.items():
+            for cell in cells:
+                expected.setdefault(cell, set()).add(keyword)
+
+        matched = 0
+        for row_idx, row in enumerate(rows):
+            for col_idx, value in enumerate(row):
+                if not isinstance(value, str):
+                    continue
+                normalized = value.strip().lower()
+                if cls._KEYWORD_PATTERN.search(normalized) is None:
+                    continue
+                keywords = expected.get((row_idx, col_idx))
+                if keywords is None:
+                    return False
+                if {keyword for keyword in cls.KEYWORDS if keyword in normalized} != keywords:
+                    return False
+                matched += 1
+        return matched == len(expected)
+
+    def _remember_layout(self):
+        # Без какого-либо из заголовков раскладку не проверить (отсутствие ячейки не подтверждается)
+        if LAYOUT_CACHE_SIZE <= 0 or not all(self.cells.values()):
+            return
+        layout = {keyword: tuple(cells) for keyword, cells in self.cells.items()}
+        fingerprint = tuple(layout[keyword] for keyword in self.KEYWORDS)
+        known = self._known_layouts
+        known[fingerprint] = layout
+        known.move_to_end(fingerprint, last=False)
+        while len(known) > LAYOUT_CACHE_SIZE:
+            known.popitem()
+
+    def cell_text(self, row: int, col: int) -> str:
+        """Нормализованный текст ячейки (strip + lower); пустая строка для нетекстовых и отсутствующих ячеек"""
+        if row >= len(self.rows) or col >= len(self.rows[row]):
+            return ''
+        value = self.rows[row][col]
+        return value.strip().lower() if isinstance(value, str) else ''
+
+    def rows_with(self, keyword: str, col: int) -> set:
+        """Маска «ячейка содержит ключевое слово» для колонки - множество номеров строк"""
+        return {row_idx for row_idx in range(len(self.rows)) if keyword in self.cell_text(row_idx, col)}
+
+    def find(self, keyword: str, predicate: Optional[Callable[[str], bool]] = None,
+             row: Optional[int] = None, col: Optional[int] = None) -> Optional[Tuple[int, int]]:
+        """Первая (по строкам, затем по колонкам) ячейка с ключевым словом, подходящая под условие"""
+        for cell in self.find_all(keyword, predicate, row=row, col=col):
+            return cell
+        return None
+
+    def find_all(self, keyword: str, predicate: Optional[Callable[[str], bool]] = None,
+                 row: Optional[int] = None, col: Optional[int] = None):
+        """Все ячейки с ключевым словом в порядке обхода листа"""
+        for row_idx, col_idx in self.cells[keyword]:
+            if row is not None and row_idx != row:
+                continue
+            if col is not None and col_idx != col:
+                continue
+            if predicate is None or predicate(self.cell_text(row_idx, col_idx)):
+                yield row_idx, col_idx
+
+
+class SheetCells:
+    """
+    Ячейки листа списком строк (list of lists), снятые с DataFrame один раз
+
+    Значения и их типы совпадают с df.iloc[row, col] (numpy-скаляры в числовых колонках),
+    но чтение ячейки - обычная индексация списков без накладных расходов pandas.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.height, self.width = df.shape
+        columns = [df.iloc[:, col_idx].to_numpy() for col_idx in range(self.width)]
+        self.rows: List[List[Any]] = [list(row) for row in zip(*columns)]
+
+    def get(self, row: int, col: int) -> Any:
+        """Значение ячейки или None за правой границей листа"""
+        return self.rows[row][col] if col < self.width else None
+
+
+class ParsedWorkbook:
+    """Первый лист Excel файла, разобранный один раз и общий для всех экстракторов блоков"""
+
+    def __init__(self, file_content: bytes, loader: Optional[str] = None):
+        self.file_content = bytes(file_content)
+        self.loader = loader or SHEET_LOADER
+        self.error: Optional[Exception] = None
+        self.grid: Optional[List[List[Any]]] = None
+        self._text_sheet: Optional[pd.DataFrame] = None
+        self._anchors: Optional[SheetAnchorIndex] = None
+        self._cells: Optional[SheetCells] = None
+        self._text_cells: Optional[SheetCells] = None
+
+        try:
+            if self.loader == 'stream':
+                self.grid = load_sheet_grid(self.file_content)
+                self.sheet: Optional[pd.DataFrame] = _grid_to_frame(self.grid)
+            else:
+                self.sheet = pd.read_excel(
+                    io.BytesIO(self.file_content), sheet_name=0, header=None, engine='openpyxl'
+                )
+        except Exception as e:
+            self.sheet = None
+            self.error = e
+
+    @property
+    def text_sheet(self) -> Optional[pd.DataFrame]:
+        """Тот же лист как текст (dtype=str) — нужен только для текстовых блоков, строится лениво"""
+        if self._text_sheet is None and self.error is None:
+            try:
+                if self.grid is not None:
+                    self._text_sheet = _grid_to_text_frame(self.grid)
+                else:
+                    self._text_sheet = pd.read_excel(
+                        io.BytesIO(self.file_content), sheet_name=0, header=None, engine='openpyxl', dtype=str
+                    )
+            except Exception as e:
+                self.error = e
+        return self._text_sheet
+
+    @property
+    def cells(self) -> SheetCells:
+        """Ячейки листа для построчного чтения в экстракторах"""
+        if self._cells is None:
+            self._cells = SheetCells(self.sheet)
+        return self._cells
+
+    @property
+    def text_cells(self) -> SheetCells:
+        """Ячейки текстового листа для построчного чтения в экстракторах"""
+        if self._text_cells is None:
+            self._text_cells = SheetCells(self.text_sheet)
+        return self._text_cells
+
+    @property
+    def anchors(self) -> SheetAnchorIndex:
+        """Индекс заголовков блоков - строится один раз на файл при первом обращении"""
+        if self._anchors is None:
+            if self.grid is not None:
+                rows = self.grid
+            elif self.sheet is not None:
+                rows = self.cells.rows
+            else:
+                rows = []
+            self._anchors = SheetAnchorIndex.build(rows)
+        return self._anchors
+
+
+WorkbookSource = Union[bytes, bytearray, ParsedWorkbook]
+
+
 class ExcelProcessor:
     def __init__(self):
         """Инициализация процессора Excel"""
@@ -70,74 +437,92 @@ class ExcelProcessor:
             raise ValueError(f"Не удалось обработать файл: {str(e)}")
 
     @staticmethod
-    def _parse_decimal(value) -> Decimal:
-        if value is None or (isinstance(value, float) and pd.isna(value)):
-            return Decimal('0')
+    def load_workbook(source: WorkbookSource) -> ParsedWorkbook:
+        """Разбор файла один раз; уже разобранная книга возвращается как есть"""
+        if isinstance(source, ParsedWorkbook):
+            return source
+        return ParsedWorkbook(source)
+
+    def _resolve_sheet(self, source: WorkbookSource, block_label: str, text: bool = False) -> Optional[pd.DataFrame]:
+        """Получение первого листа для экстрактора блока (None при ошибке чтения)"""
+        workbook = self.load_workbook(source)
+        df = workbook.text_sheet if text else workbook.sheet
+        if df is None:
+            logger.error(f"Error reading Excel for {block_label}: {workbook.error}")
+        return df
 
-        if isinstance(value, (int, float, Decimal)):
-            return Decimal(str(value)).quantize(Decimal('0.01'))
+    def extract_all_blocks(self, source: WorkbookSource) -> Dict[str, Any]:
+        """
+        Извлечение всех блоков отчета из одного разбора файла
 
-        if isinstance(value, str):
-            cleaned = re.sub(r'[^0-9,\.\-]', '', value)
-            cleaned = cleaned.replace(' ', '').replace(',', '.').strip()
-            if cleaned == '':
-                return Decimal('0')
-            try:
-                return Decimal(cleaned).quantize(Decimal('0.01'))
-            except InvalidOperation:
-                logger.warning(f"Failed to parse decimal from string '{value}'")
-                return Decimal('0')
+        Returns:
+            Dict[str, Any]: результаты экстракторов по id блоков (как в QUERY_BLOCKS бота)
+        """
+        workbook = self.load_workbook(source)
 
-        logger.warning(f"Unsupported value type for decimal parsing: {value} ({type(value)})")
-        return Decimal('0')
+        expense_data = self.extract_expense_records(workbook)
+        misc_expenses_text = self.extract_misc_expenses_from_notes_after_total(workbook)
 
-    def extract_income_records(self, file_content: bytes) -> List[Dict[str, Any]]:
-        """Извлечение блока «Доходы» с первого листа"""
-        try:
-            df = pd.read_excel(io.BytesIO(file_content), sheet_name=0, header=None, engine='openpyxl')
-        except Exception as e:
-            logger.error(f"Error reading Excel for income block: {e}")
-            return []
+        return {
+            'income': self.extract_income_records(workbook),
+            'tickets': self.extract_ticket_sales(workbook),
+            'payments': self.extract_payment_types(workbook),
+            'staff': self.extract_staff_statistics(workbook),
+            'expenses': expense_data,
+            'cash': self.extract_cash_collection(workbook),
+            'debts': self.extract_staff_debts(workbook),
+            'notes': self.extract_notes_entries(workbook),
+            'misc_expenses': misc_expenses_text,
+            'misc_expenses_records': self.parse_misc_expenses_text(misc_expenses_text),
+            'totals': self.extract_totals_summary(workbook),
+            'taxi': self._build_taxi_expenses(misc_expenses_text, expense_data),
+        }
 
-        if df.empty:
+    @staticmethod
+    def _parse_decimal(value) -> Decimal:
+        return parse_money(value)
+
+    def extract_income_records(self, source: WorkbookSource) -> List[Dict[str, Any]]:
+        """Извлечение блока «Доходы» с первого листа"""
+        workbook = self.load_workbook(source)
+        df = self._resolve_sheet(workbook, "income block")
+        if df is None or df.empty:
             return []
+        sheet = workbook.cells
+        anchors = workbook.anchors
 
         # Ищем ДОХОДЫ в первой строке (горизонтальный формат с несколькими блоками)
         income_col = None
-        if df.shape[0] > 0:
-            for col_idx in range(df.shape[1]):
-                cell_value = df.iloc[0, col_idx]
-                if isinstance(cell_value, str) and 'ДОХОД' in cell_value.strip().upper():
-                    income_col = col_idx
-                    logger.info(f"Found 'ДОХОДЫ' header in column {col_idx}")
-                    break
+        header = anchors.find('доход', row=0)
+        if header is not None:
+            income_col = header[1]
+            logger.info(f"Found 'ДОХОДЫ' header in column {income_col}")
         
         # Если найден горизонтальный формат
         if income_col is not None:
-            return self._extract_income_horizontal(df, income_col)
+            return self._extract_income_horizontal(sheet, income_col)
         
         # Иначе ищем вертикальный формат (старая логика)
         start_row = None
-        for idx, value in enumerate(df.iloc[:, 0]):
-            if isinstance(value, str) and value.strip().upper() == 'ДОХОДЫ':
-                start_row = idx + 1
-                logger.info(f"Found 'ДОХОДЫ' header at row {idx}, data starts at row {start_row}")
-                break
+        header = anchors.find('доход', lambda text: text == 'доходы', col=0)
+        if header is not None:
+            start_row = header[0] + 1
+            logger.info(f"Found 'ДОХОДЫ' header at row {header[0]}, data starts at row {start_row}")
 
         if start_row is None:
             logger.info("Income block header 'ДОХОДЫ' not found")
             return []
         
-        return self._extract_income_vertical(df, start_row)
+        return self._extract_income_vertical(sheet, start_row)
     
-    def _extract_income_horizontal(self, df: pd.DataFrame, income_col: int) -> List[Dict[str, Any]]:
+    def _extract_income_horizontal(self, sheet: SheetCells, income_col: int) -> List[Dict[str, Any]]:
         """Извлечение доходов из горизонтального формата - универсальный подход"""
         records: List[Dict[str, Any]] = []
         
         # Универсальная логика: в каждой строке ищем текст (категория), потом первое число справа (сумма)
-        for row_idx in range(1, len(df)):
+        for row_idx in range(1, sheet.height):
             # Читаем категорию из колонки income_col
-            raw_category = df.iloc[row_idx, income_col] if df.shape[1] > income_col else None
+            raw_category = sheet.get(row_idx, income_col)
             
             if raw_category is None or (isinstance(raw_category, float) and pd.isna(raw_category)):
                 # Пустая строка - конец блока
@@ -158,8 +543,8 @@ class ExcelProcessor:
                 # Ищем первое число справа от категории
                 amount = None
                 for col_offset in range(1, 6):
-                    if df.shape[1] > income_col + col_offset:
-                        candidate = df.iloc[row_idx, income_col + col_offset]
+                    if sheet.width > income_col + col_offset:
+                        candidate = sheet.rows[row_idx][income_col + col_offset]
                         if candidate is not None and not (isinstance(candidate, float) and pd.isna(candidate)):
                             # Проверяем, что это число, а не текст
                             if isinstance(candidate, (int, float)) or (isinstance(candidate, str) and candidate.replace('.', '').replace(',', '').replace('-', '').isdigit()):
@@ -174,8 +559,8 @@ class ExcelProcessor:
             # Ищем первое ЧИСЛО справа от категории (пропускаем пустые ячейки)
             amount = None
             for col_offset in range(1, 6):
-                if df.shape[1] > income_col + col_offset:
-                    candidate = df.iloc[row_idx, income_col + col_offset]
+                if sheet.width > income_col + col_offset:
+                    candidate = sheet.rows[row_idx][income_col + col_offset]
                     if candidate is not None and not (isinstance(candidate, float) and pd.isna(candidate)):
                         # Проверяем, что это число
                         if isinstance(candidate, (int, float)):
@@ -209,14 +594,14 @@ class ExcelProcessor:
         
         return records
     
-    def _extract_income_vertical(self, df: pd.DataFrame, start_row: int) -> List[Dict[str, Any]]:
+    def _extract_income_vertical(self, sheet: SheetCells, start_row: int) -> List[Dict[str, Any]]:
         """Извлечение доходов из вертикального формата (заголовок в первой колонке)"""
         records: List[Dict[str, Any]] = []
         observed_categories = set()
 
-        for row_idx in range(start_row, len(df)):
-            raw_category = df.iloc[row_idx, 0] if df.shape[1] > 0 else None
-            raw_amount = df.iloc[row_idx, 1] if df.shape[1] > 1 else None
+        for row_idx in range(start_row, sheet.height):
+            raw_category = sheet.get(row_idx, 0)
+            raw_amount = sheet.get(row_idx, 1)
 
             if raw_category is None or (isinstance(raw_category, float) and pd.isna(raw_category)):
                 break
@@ -493,30 +878,26 @@ class ExcelProcessor:
         decimal_value = ExcelProcessor._parse_decimal(value)
         return int(decimal_value)
 
-    def extract_ticket_sales(self, file_content: bytes) -> Dict[str, Any]:
+    def extract_ticket_sales(self, source: WorkbookSource) -> Dict[str, Any]:
         """Извлечение блока «Входные билеты» с первого листа"""
-        try:
-            df = pd.read_excel(io.BytesIO(file_content), sheet_name=0, header=None, engine='openpyxl')
-        except Exception as e:
-            logger.error(f"Error reading Excel for ticket sales block: {e}")
-            return {}
-
-        if df.empty:
+        workbook = self.load_workbook(source)
+        df = self._resolve_sheet(workbook, "ticket sales block")
+        if df is None or df.empty:
             return {}
+        sheet = workbook.cells
 
         # Ищем блок "Входные билеты" - это отдельный блок, не часть доходов
         # Признак: следующая строка содержит заголовки "цена", "кол-во", "сумма"
         start_row = None
-        for idx, value in enumerate(df.iloc[:, 0]):
-            if isinstance(value, str) and value.strip().upper() == 'ВХОДНЫЕ БИЛЕТЫ':
-                # Проверяем следующую строку - должна быть "цена | кол-во | сумма"
-                if idx + 1 < len(df):
-                    next_row_cells = [df.iloc[idx+1, col] if df.shape[1] > col else None for col in range(3)]
-                    next_row_text = ' '.join([str(c).lower() for c in next_row_cells if pd.notna(c)])
-                    if 'цена' in next_row_text and 'кол' in next_row_text:
-                        start_row = idx + 1
-                        logger.info(f"Found ticket sales block at row {idx}")
-                        break
+        for idx, _ in workbook.anchors.find_all('входные билеты', lambda text: text == 'входные билеты', col=0):
+            # Проверяем следующую строку - должна быть "цена | кол-во | сумма"
+            if idx + 1 < sheet.height:
+                next_row_cells = [sheet.get(idx + 1, col) for col in range(3)]
+                next_row_text = ' '.join([str(c).lower() for c in next_row_cells if pd.notna(c)])
+                if 'цена' in next_row_text and 'кол' in next_row_text:
+                    start_row = idx + 1
+                    logger.info(f"Found ticket sales block at row {idx}")
+                    break
 
         if start_row is None:
             logger.info("Ticket sales block header 'ВХОДНЫЕ БИЛЕТЫ' not found")
@@ -525,8 +906,8 @@ class ExcelProcessor:
         header_row = None
         header_keywords = {'цена', 'кол', 'кол-во', 'количество', 'сумма'}
 
-        for row_idx in range(start_row, len(df)):
-            cells = [df.iloc[row_idx, col] if df.shape[1] > col else None for col in range(3)]
+        for row_idx in range(start_row, sheet.height):
+            cells = [sheet.get(row_idx, col) for col in range(3)]
             normalized = [str(cell).strip().lower() if cell is not None and not (isinstance(cell, float) and pd.isna(cell)) else '' for cell in cells]
 
             if any('цена' in cell for cell in normalized) and any('кол' in cell for cell in normalized) and any('сумма' in cell for cell in normalized):
@@ -546,10 +927,11 @@ class ExcelProcessor:
         reported_total_quantity = None
         reported_total_amount = None
 
-        for row_idx in range(start_row, len(df)):
-            price_cell = df.iloc[row_idx, 0] if df.shape[1] > 0 else None
-            quantity_cell = df.iloc[row_idx, 1] if df.shape[1] > 1 else None
-            amount_cell = df.iloc[row_idx, 2] if df.shape[1] > 2 else None
+        total_rows = workbook.anchors.rows_with('итого', 0)
+        for row_idx in range(start_row, sheet.height):
+            price_cell = sheet.get(row_idx, 0)
+            quantity_cell = sheet.get(row_idx, 1)
+            amount_cell = sheet.get(row_idx, 2)
 
             # Проверяем на итоговую строку
             if price_cell is not None and isinstance(price_cell, str):
@@ -575,12 +957,9 @@ class ExcelProcessor:
             # Пропускаем пустые строки (продолжаем искать ИТОГО)
             if price_cell is None or (isinstance(price_cell, float) and pd.isna(price_cell)):
                 # Проверяем следующие несколько строк на наличие ИТОГО
-                found_total = False
-                for next_idx in range(row_idx + 1, min(row_idx + 5, len(df))):
-                    next_cell = df.iloc[next_idx, 0]
-                    if next_cell is not None and isinstance(next_cell, str) and 'ИТОГО' in next_cell.upper():
-                        found_total = True
-                        break
+                found_total = any(
+                    next_idx in total_rows for next_idx in range(row_idx + 1, min(row_idx + 5, sheet.height))
+                )
                 if not found_total:
                     break
                 else:
@@ -628,22 +1007,18 @@ class ExcelProcessor:
             'totals_match': totals_match
         }
 
-    def extract_payment_types(self, file_content: bytes) -> Dict[str, Any]:
+    def extract_payment_types(self, source: WorkbookSource) -> Dict[str, Any]:
         """Извлечение блока «Типы оплат за смену»"""
-        try:
-            df = pd.read_excel(io.BytesIO(file_content), sheet_name=0, header=None, engine='openpyxl')
-        except Exception as e:
-            logger.error(f"Error reading Excel for payment types block: {e}")
-            return {}
-
-        if df.empty:
+        workbook = self.load_workbook(source)
+        df = self._resolve_sheet(workbook, "payment types block")
+        if df is None or df.empty:
             return {}
+        sheet = workbook.cells
 
         start_row = None
-        for idx, value in enumerate(df.iloc[:, 0]):
-            if isinstance(value, str) and value.strip().upper() == 'НАЛИЧНЫЕ':
-                start_row = idx
-                break
+        header = workbook.anchors.find('наличные', lambda text: text == 'наличные', col=0)
+        if header is not None:
+            start_row = header[0]
 
         if start_row is None:
             logger.info("Payment types block header (cash) not found")
@@ -654,18 +1029,16 @@ class ExcelProcessor:
         reported_total = None
         reported_cash_total = None
 
-        for row_idx in range(start_row, len(df)):
-            label_cell = df.iloc[row_idx, 0] if df.shape[1] > 0 else None
-            amount_cell = df.iloc[row_idx, 2] if df.shape[1] > 2 else None  # Колонка 2, не 1!
+        total_rows = workbook.anchors.rows_with('итого', 0)
+        for row_idx in range(start_row, sheet.height):
+            label_cell = sheet.get(row_idx, 0)
+            amount_cell = sheet.get(row_idx, 2)  # Колонка 2, не 1!
 
             if label_cell is None or (isinstance(label_cell, float) and pd.isna(label_cell)):
                 # Пустая строка - проверяем, есть ли дальше ИТОГО
-                found_total = False
-                for next_idx in range(row_idx + 1, min(row_idx + 5, len(df))):
-                    next_cell = df.iloc[next_idx, 0]
-                    if next_cell is not None and isinstance(next_cell, str) and 'ИТОГО' in next_cell.upper():
-                        found_total = True
-                        break
+                found_total = any(
+                    next_idx in total_rows for next_idx in range(row_idx + 1, min(row_idx + 5, sheet.height))
+                )
                 if not found_total:
                     break
                 else:
@@ -727,24 +1100,20 @@ class ExcelProcessor:
             'totals_match': totals_match
         }
 
-    def extract_staff_statistics(self, file_content: bytes) -> List[Dict[str, Any]]:
+    def extract_staff_statistics(self, source: WorkbookSource) -> List[Dict[str, Any]]:
         """Извлечение блока «Статистика персонала» - горизонтальный формат"""
-        try:
-            df = pd.read_excel(io.BytesIO(file_content), sheet_name=0, header=None, engine='openpyxl')
-        except Exception as e:
-            logger.error(f"Error reading Excel for staff statistics block: {e}")
-            return []
-
-        if df.empty:
+        workbook = self.load_workbook(source)
+        df = self._resolve_sheet(workbook, "staff statistics block")
+        if df is None or df.empty:
             return []
+        sheet = workbook.cells
 
         # Ищем заголовок блока
         start_row = None
-        for idx, value in enumerate(df.iloc[:, 0]):
-            if isinstance(value, str) and 'статистика' in value.strip().lower() and 'персонал' in value.strip().lower():
-                start_row = idx + 1
-                logger.info(f"Found 'Статистика персонала' at row {idx}, data starts at {start_row}")
-                break
+        header = workbook.anchors.find('статистика', lambda text: 'персонал' in text, col=0)
+        if header is not None:
+            start_row = header[0] + 1
+            logger.info(f"Found 'Статистика персонала' at row {header[0]}, data starts at {start_row}")
 
         if start_row is None:
             logger.info("Staff statistics block header not found")
@@ -753,9 +1122,9 @@ class ExcelProcessor:
         records: List[Dict[str, Any]] = []
 
         # Данные идут горизонтально: колонка 0 - должность, колонка 2 - количество
-        for row_idx in range(start_row, len(df)):
-            role_cell = df.iloc[row_idx, 0] if df.shape[1] > 0 else None
-            count_cell = df.iloc[row_idx, 2] if df.shape[1] > 2 else None
+        for row_idx in range(start_row, sheet.height):
+            role_cell = sheet.get(row_idx, 0)
+            count_cell = sheet.get(row_idx, 2)
 
             # Останавливаемся на пустой строке
             if role_cell is None or (isinstance(role_cell, float) and pd.isna(role_cell)):
@@ -776,44 +1145,26 @@ class ExcelProcessor:
 
         return records
 
-    def extract_expense_records(self, file_content: bytes) -> Dict[str, Any]:
+    def extract_expense_records(self, source: WorkbookSource) -> Dict[str, Any]:
         """Извлечение блока «Расходы» - горизонтальный формат"""
-        try:
-            df = pd.read_excel(io.BytesIO(file_content), sheet_name=0, header=None, engine='openpyxl')
-        except Exception as e:
-            logger.error(f"Error reading Excel for expense block: {e}")
-            return {}
-
-        if df.empty:
+        workbook = self.load_workbook(source)
+        df = self._resolve_sheet(workbook, "expense block")
+        if df is None or df.empty:
             return {}
+        sheet = workbook.cells
 
         # Ищем заголовок "Расходы" в любой колонке (НО НЕ "Прочие расходы")
         # "Расходы" - это отдельный блок в верхней правой части таблицы
         # "Прочие расходы" - это секция внутри блока "Примечание"
         expense_col = None
         start_row = None
-        for row_idx in range(len(df)):
-            for col_idx in range(df.shape[1]):
-                cell = df.iloc[row_idx, col_idx]
-                if isinstance(cell, str):
-                    cell_lower = cell.strip().lower()
-                    # Ищем именно "Расходы" как отдельное слово, НЕ "Прочие расходы"
-                    # Проверяем: слово "расходы" есть, но НЕ "прочие расходы"
-                    is_expenses_block = False
-                    
-                    if cell_lower == 'расходы':
-                        is_expenses_block = True
-                    elif cell_lower.startswith('расходы'):
-                        if 'прочие расходы' not in cell_lower and not cell_lower.startswith('прочие'):
-                            is_expenses_block = True
-                    
-                    if is_expenses_block:
-                        expense_col = col_idx
-                        start_row = row_idx + 1
-                        logger.info(f"✅ Found 'Расходы' block at row {row_idx}, col {col_idx}, cell='{cell}'")
-                        break
-            if expense_col is not None:
-                break
+        header = workbook.anchors.find(
+            'расход', lambda text: text.startswith('расходы') and 'прочие расходы' not in text
+        )
+        if header is not None:
+            start_row = header[0] + 1
+            expense_col = header[1]
+            logger.info(f"✅ Found 'Расходы' block at row {header[0]}, col {expense_col}, cell='{sheet.rows[start_row - 1][expense_col]}'")
         
         if expense_col is None:
             logger.info("Expense block header not found")
@@ -824,8 +1175,8 @@ class ExcelProcessor:
         reported_total = None
 
         # Данные: колонка expense_col - статья, expense_col+2 - сумма (col+1 пустая)
-        for row_idx in range(start_row, len(df)):
-            item_cell = df.iloc[row_idx, expense_col] if df.shape[1] > expense_col else None
+        for row_idx in range(start_row, sheet.height):
+            item_cell = sheet.get(row_idx, expense_col)
             
             if item_cell is None or (isinstance(item_cell, float) and pd.isna(item_cell)):
                 break
@@ -844,8 +1195,8 @@ class ExcelProcessor:
             # Ищем сумму справа (пропускаем пустые ячейки)
             amount = None
             for col_offset in range(1, 6):
-                if df.shape[1] > expense_col + col_offset:
-                    candidate = df.iloc[row_idx, expense_col + col_offset]
+                if sheet.width > expense_col + col_offset:
+                    candidate = sheet.rows[row_idx][expense_col + col_offset]
                     if candidate is not None and not (isinstance(candidate, float) and pd.isna(candidate)):
                         if isinstance(candidate, (int, float)):
                             amount = self._parse_decimal(candidate)
@@ -902,30 +1253,22 @@ class ExcelProcessor:
             'totals_match': totals_match
         }
 
-    def extract_cash_collection(self, file_content: bytes) -> Dict[str, Any]:
+    def extract_cash_collection(self, source: WorkbookSource) -> Dict[str, Any]:
         """Извлечение блока «Инкассация» - горизонтальный формат"""
-        try:
-            df = pd.read_excel(io.BytesIO(file_content), sheet_name=0, header=None, engine='openpyxl')
-        except Exception as e:
-            logger.error(f"Error reading Excel for cash collection block: {e}")
-            return {}
-
-        if df.empty:
+        workbook = self.load_workbook(source)
+        df = self._resolve_sheet(workbook, "cash collection block")
+        if df is None or df.empty:
             return {}
+        sheet = workbook.cells
 
         # Ищем заголовок "Инкассация" в любой колонке
         cash_col = None
         start_row = None
-        for row_idx in range(len(df)):
-            for col_idx in range(df.shape[1]):
-                cell = df.iloc[row_idx, col_idx]
-                if isinstance(cell, str) and 'инкассация' in cell.strip().lower():
-                    cash_col = col_idx
-                    start_row = row_idx + 1
-                    logger.info(f"Found 'Инкассация' at row {row_idx}, col {col_idx}")
-                    break
-            if cash_col is not None:
-                break
+        header = workbook.anchors.find('инкассация')
+        if header is not None:
+            start_row = header[0] + 1
+            cash_col = header[1]
+            logger.info(f"Found 'Инкассация' at row {header[0]}, col {cash_col}")
 
         if cash_col is None:
             logger.info("Cash collection block header not found")
@@ -933,8 +1276,8 @@ class ExcelProcessor:
 
         # Пропускаем строку с заголовками (---, кол-во, курс, сумма)
         header_row = None
-        for row_idx in range(start_row, min(start_row + 3, len(df))):
-            cells = [df.iloc[row_idx, cash_col + i] if df.shape[1] > cash_col + i else None for i in range(4)]
+        for row_idx in range(start_row, min(start_row + 3, sheet.height)):
+            cells = [sheet.get(row_idx, cash_col + i) for i in range(4)]
             normalized = [str(cell).strip().lower() if cell is not None and not (isinstance(cell, float) and pd.isna(cell)) else '' for cell in cells]
 
             if any('кол' in cell for cell in normalized) or any('курс' in cell for cell in normalized):
@@ -947,24 +1290,19 @@ class ExcelProcessor:
         reported_total = None
 
         # Формат: cash_col - валюта, cash_col+1 - количество, cash_col+2 - курс, cash_col+3 - сумма
-        for row_idx in range(start_row, len(df)):
-            currency_cell = df.iloc[row_idx, cash_col] if df.shape[1] > cash_col else None
-            quantity_cell = df.iloc[row_idx, cash_col + 1] if df.shape[1] > cash_col + 1 else None
-            rate_cell = df.iloc[row_idx, cash_col + 2] if df.shape[1] > cash_col + 2 else None
-            amount_cell = df.iloc[row_idx, cash_col + 3] if df.shape[1] > cash_col + 3 else None
+        total_rows = workbook.anchors.rows_with('итого', cash_col)
+        for row_idx in range(start_row, sheet.height):
+            currency_cell = sheet.get(row_idx, cash_col)
+            quantity_cell = sheet.get(row_idx, cash_col + 1)
+            rate_cell = sheet.get(row_idx, cash_col + 2)
+            amount_cell = sheet.get(row_idx, cash_col + 3)
 
             # Пропускаем пустые строки, ищем ИТОГО
             if currency_cell is None or (isinstance(currency_cell, float) and pd.isna(currency_cell)):
                 # Проверяем следующие несколько строк на наличие ИТОГО
-                found_total = False
-                for offset in range(1, 8):
-                    if row_idx + offset >= len(df):
-                        break
-                    next_cell = df.iloc[row_idx + offset, cash_col] if df.shape[1] > cash_col else None
-                    if next_cell is not None and isinstance(next_cell, str) and 'итого' in next_cell.strip().lower():
-                        # Нашли ИТОГО, продолжаем парсинг с этой строки
-                        found_total = True
-                        break
+                found_total = any(
+                    row_idx + offset in total_rows for offset in range(1, 8) if row_idx + offset < sheet.height
+                )
                 if not found_total:
                     break
                 else:
@@ -1021,40 +1359,32 @@ class ExcelProcessor:
             'totals_match': totals_match
         }
 
-    def extract_staff_debts(self, file_content: bytes) -> Dict[str, Any]:
+    def extract_staff_debts(self, source: WorkbookSource) -> Dict[str, Any]:
         """Извлечение блока «Долги по персоналу» - идет после инкассации БЕЗ заголовка"""
-        try:
-            df = pd.read_excel(io.BytesIO(file_content), sheet_name=0, header=None, engine='openpyxl')
-        except Exception as e:
-            logger.error(f"Error reading Excel for staff debts block: {e}")
-            return {}
-
-        if df.empty:
+        workbook = self.load_workbook(source)
+        df = self._resolve_sheet(workbook, "staff debts block")
+        if df is None or df.empty:
             return {}
+        sheet = workbook.cells
+        anchors = workbook.anchors
 
         # Ищем ИТОГО инкассации, блок долгов идет сразу после него
         cash_itogo_row = None
         cash_col = None
         
         # Сначала ищем блок "Инкассация"
-        for row_idx in range(len(df)):
-            for col_idx in range(df.shape[1]):
-                cell = df.iloc[row_idx, col_idx]
-                if isinstance(cell, str) and 'инкассация' in cell.strip().lower():
-                    # Нашли заголовок инкассации, ищем ИТОГО через 5-15 строк после него
-                    for offset in range(5, 15):
-                        if row_idx + offset >= len(df):
-                            break
-                        itogo_cell = df.iloc[row_idx + offset, col_idx] if df.shape[1] > col_idx else None
-                        if itogo_cell and isinstance(itogo_cell, str) and 'итого' in itogo_cell.strip().lower():
-                            # Проверяем, что справа есть сумма
-                            amount_cell = df.iloc[row_idx + offset, col_idx + 3] if df.shape[1] > col_idx + 3 else None
-                            if amount_cell is not None and isinstance(amount_cell, (int, float)):
-                                cash_itogo_row = row_idx + offset
-                                cash_col = col_idx
-                                logger.info(f"Found cash ИТОГО at row {cash_itogo_row}, col {cash_col}, debts start after")
-                                break
-                    if cash_itogo_row is not None:
+        for row_idx, col_idx in anchors.find_all('инкассация'):
+            # Нашли заголовок инкассации, ищем ИТОГО через 5-15 строк после него
+            for offset in range(5, 15):
+                if row_idx + offset >= sheet.height:
+                    break
+                if 'итого' in anchors.cell_text(row_idx + offset, col_idx):
+                    # Проверяем, что справа есть сумма
+                    amount_cell = sheet.get(row_idx + offset, col_idx + 3)
+                    if amount_cell is not None and isinstance(amount_cell, (int, float)):
+                        cash_itogo_row = row_idx + offset
+                        cash_col = col_idx
+                        logger.info(f"Found cash ИТОГО at row {cash_itogo_row}, col {cash_col}, debts start after")
                         break
             if cash_itogo_row is not None:
                 break
@@ -1070,9 +1400,9 @@ class ExcelProcessor:
         reported_total = None
 
         # Формат: cash_col - тип долга, cash_col+1 - сумма
-        for row_idx in range(start_row, min(start_row + 10, len(df))):
-            debt_type_cell = df.iloc[row_idx, cash_col] if df.shape[1] > cash_col else None
-            amount_cell = df.iloc[row_idx, cash_col + 1] if df.shape[1] > cash_col + 1 else None
+        for row_idx in range(start_row, min(start_row + 10, sheet.height)):
+            debt_type_cell = sheet.get(row_idx, cash_col)
+            amount_cell = sheet.get(row_idx, cash_col + 1)
 
             # Останавливаемся на пустой строке
             if debt_type_cell is None or (isinstance(debt_type_cell, float) and pd.isna(debt_type_cell)):
@@ -1118,22 +1448,18 @@ class ExcelProcessor:
             'totals_match': totals_match
         }
 
-    def extract_misc_expenses_text_from_notes(self, file_content: bytes) -> Optional[str]:
+    def extract_misc_expenses_text_from_notes(self, source: WorkbookSource) -> Optional[str]:
         """
         Извлечение текста прочих расходов из блока Примечания
         
         Returns:
             str: Текст прочих расходов (между заголовком "Прочие расходы:" и "Итого:")
         """
-        try:
-            # Читаем Excel с правильной кодировкой
-            df = pd.read_excel(io.BytesIO(file_content), sheet_name=0, header=None, engine='openpyxl', dtype=str)
-        except Exception as e:
-            logger.error(f"Error reading Excel for misc expenses: {e}")
-            return None
-
-        if df.empty:
+        workbook = self.load_workbook(source)
+        df = self._resolve_sheet(workbook, "misc expenses", text=True)
+        if df is None or df.empty:
             return None
+        sheet = workbook.text_cells
 
         # Ищем блок "Прочие расходы" в примечаниях
         misc_expenses_start_row = None
@@ -1141,22 +1467,11 @@ class ExcelProcessor:
         
         logger.info(f"Searching for 'Прочие расходы' block in Excel file, df shape: {df.shape}")
         
-        for row_idx in range(len(df)):
-            for col_idx in range(df.shape[1]):
-                cell = df.iloc[row_idx, col_idx]
-                if isinstance(cell, str):
-                    cell_lower = cell.strip().lower()
-                    # Логируем все ячейки с текстом "расход"
-                    if 'расход' in cell_lower:
-                        logger.info(f"Found cell with 'расход' at row {row_idx}, col {col_idx}: '{cell}'")
-                    
-                    if 'прочие расходы' in cell_lower:
-                        misc_expenses_start_row = row_idx + 1
-                        misc_expenses_col = col_idx
-                        logger.info(f"✅ Found 'Прочие расходы' at row {row_idx}, col {col_idx}")
-                        break
-            if misc_expenses_start_row is not None:
-                break
+        header = workbook.anchors.find('прочие расходы')
+        if header is not None:
+            misc_expenses_start_row = header[0] + 1
+            misc_expenses_col = header[1]
+            logger.info(f"✅ Found 'Прочие расходы' at row {header[0]}, col {misc_expenses_col}")
         
         if misc_expenses_start_row is None:
             logger.info("❌ Misc expenses block 'Прочие расходы' not found in file")
@@ -1164,8 +1479,8 @@ class ExcelProcessor:
         
         # Извлекаем текст до строки "Итого:"
         misc_expenses_lines = []
-        for row_idx in range(misc_expenses_start_row, len(df)):
-            cell = df.iloc[row_idx, misc_expenses_col] if df.shape[1] > misc_expenses_col else None
+        for row_idx in range(misc_expenses_start_row, sheet.height):
+            cell = sheet.get(row_idx, misc_expenses_col)
             
             if cell is None or (isinstance(cell, float) and pd.isna(cell)):
                 continue
@@ -1192,40 +1507,32 @@ class ExcelProcessor:
         
         return misc_expenses_text
     
-    def extract_notes_entries(self, file_content: bytes) -> Dict[str, List[Dict[str, Any]]]:
+    def extract_notes_entries(self, source: WorkbookSource) -> Dict[str, List[Dict[str, Any]]]:
         """Извлечение блока «Примечание»"""
-        try:
-            df = pd.read_excel(io.BytesIO(file_content), sheet_name=0, header=None, engine='openpyxl')
-        except Exception as e:
-            logger.error(f"Error reading Excel for notes block: {e}")
-            return {}
-
-        if df.empty:
+        workbook = self.load_workbook(source)
+        df = self._resolve_sheet(workbook, "notes block")
+        if df is None or df.empty:
             return {}
+        sheet = workbook.cells
 
         # Ищем заголовок "Примечания" в любой колонке
         start_row = None
         notes_col = None
         
-        for row_idx in range(len(df)):
-            for col_idx in range(df.shape[1]):
-                cell = df.iloc[row_idx, col_idx]
-                if isinstance(cell, str) and 'примечан' in cell.strip().lower():
-                    start_row = row_idx + 1
-                    notes_col = col_idx
-                    logger.info(f"Found 'Примечания' at row {row_idx}, col {col_idx}")
-                    break
-            if start_row is not None:
-                break
+        header = workbook.anchors.find('примечан')
+        if header is not None:
+            start_row = header[0] + 1
+            notes_col = header[1]
+            logger.info(f"Found 'Примечания' at row {header[0]}, col {notes_col}")
 
         if start_row is None or notes_col is None:
             logger.info("Notes block header not found")
             return {}
 
         column_headers_row = None
-        for row_idx in range(start_row, len(df)):
-            left_cell = df.iloc[row_idx, notes_col] if df.shape[1] > notes_col else None
-            right_cell = df.iloc[row_idx, notes_col + 1] if df.shape[1] > notes_col + 1 else None
+        for row_idx in range(start_row, sheet.height):
+            left_cell = sheet.get(row_idx, notes_col)
+            right_cell = sheet.get(row_idx, notes_col + 1)
 
             if left_cell is None and right_cell is None:
                 continue
@@ -1250,9 +1557,9 @@ class ExcelProcessor:
         left_done = False
         right_done = False
 
-        for row_idx in range(start_row, len(df)):
-            left_cell = df.iloc[row_idx, notes_col] if df.shape[1] > notes_col else None
-            right_cell = df.iloc[row_idx, notes_col + 1] if df.shape[1] > notes_col + 1 else None
+        for row_idx in range(start_row, sheet.height):
+            left_cell = sheet.get(row_idx, notes_col)
+            right_cell = sheet.get(row_idx, notes_col + 1)
 
             if left_cell is None and right_cell is None:
                 continue
@@ -1326,36 +1633,28 @@ class ExcelProcessor:
             'extra': extra_notes
         }
 
-    def extract_misc_expenses_from_notes_after_total(self, file_content: bytes) -> Optional[str]:
+    def extract_misc_expenses_from_notes_after_total(self, source: WorkbookSource) -> Optional[str]:
         """
         Извлечение блока «Прочие расходы» из примечаний в колонке безнал после первого ИТОГО
         
         Returns:
             str: Текст прочих расходов (от "ПРОЧИЕ РАСХОДЫ" до следующего "ИТОГО") или None
         """
-        try:
-            df = pd.read_excel(io.BytesIO(file_content), sheet_name=0, header=None, engine='openpyxl')
-        except Exception as e:
-            logger.error(f"Error reading Excel for misc expenses from notes: {e}")
-            return None
-
-        if df.empty:
+        workbook = self.load_workbook(source)
+        df = self._resolve_sheet(workbook, "misc expenses from notes")
+        if df is None or df.empty:
             return None
+        sheet = workbook.cells
 
         # Ищем заголовок "Примечания" в любой колонке
         start_row = None
         notes_col = None
         
-        for row_idx in range(len(df)):
-            for col_idx in range(df.shape[1]):
-                cell = df.iloc[row_idx, col_idx]
-                if isinstance(cell, str) and 'примечан' in cell.strip().lower():
-                    start_row = row_idx + 1
-                    notes_col = col_idx
-                    logger.info(f"Found 'Примечания' at row {row_idx}, col {col_idx}")
-                    break
-            if start_row is not None:
-                break
+        header = workbook.anchors.find('примечан')
+        if header is not None:
+            start_row = header[0] + 1
+            notes_col = header[1]
+            logger.info(f"Found 'Примечания' at row {header[0]}, col {notes_col}")
 
         if start_row is None or notes_col is None:
             logger.info("Notes block header not found")
@@ -1363,9 +1662,9 @@ class ExcelProcessor:
 
         # Ищем строку с заголовками колонок (где "долг")
         column_headers_row = None
-        for row_idx in range(start_row, len(df)):
-            left_cell = df.iloc[row_idx, notes_col] if df.shape[1] > notes_col else None
-            right_cell = df.iloc[row_idx, notes_col + 1] if df.shape[1] > notes_col + 1 else None
+        for row_idx in range(start_row, sheet.height):
+            left_cell = sheet.get(row_idx, notes_col)
+            right_cell = sheet.get(row_idx, notes_col + 1)
 
             if left_cell is None and right_cell is None:
                 continue
@@ -1385,8 +1684,8 @@ class ExcelProcessor:
 
         # Ищем первое ИТОГО в левой колонке (безнал)
         first_total_row = None
-        for row_idx in range(start_row, len(df)):
-            left_cell = df.iloc[row_idx, notes_col] if df.shape[1] > notes_col else None
+        for row_idx in range(start_row, sheet.height):
+            left_cell = sheet.get(row_idx, notes_col)
             
             if left_cell is None or (isinstance(left_cell, float) and pd.isna(left_cell)):
                 continue
@@ -1414,8 +1713,8 @@ class ExcelProcessor:
         misc_expenses_start_row = None
         logger.info(f"Starting search for 'ПРОЧИЕ РАСХОДЫ' after first ИТОГО at row {first_total_row}")
         
-        for row_idx in range(first_total_row + 1, len(df)):
-            left_cell = df.iloc[row_idx, notes_col] if df.shape[1] > notes_col else None
+        for row_idx in range(first_total_row + 1, sheet.height):
+            left_cell = sheet.get(row_idx, notes_col)
             
             # Пропускаем пустые ячейки и продолжаем поиск
             if left_cell is None or (isinstance(left_cell, float) and pd.isna(left_cell)):
@@ -1464,8 +1763,8 @@ class ExcelProcessor:
 
         # Извлекаем текст от "ПРОЧИЕ РАСХОДЫ" до следующего ИТОГО
         misc_expenses_lines = []
-        for row_idx in range(misc_expenses_start_row, len(df)):
-            left_cell = df.iloc[row_idx, notes_col] if df.shape[1] > notes_col else None
+        for row_idx in range(misc_expenses_start_row, sheet.height):
+            left_cell = sheet.get(row_idx, notes_col)
             
             if left_cell is None or (isinstance(left_cell, float) and pd.isna(left_cell)):
                 continue
@@ -1499,33 +1798,77 @@ class ExcelProcessor:
         
         return misc_expenses_text
 
-    def extract_totals_summary(self, file_content: bytes) -> List[Dict[str, Any]]:
-        """Извлечение блока «Итоговый баланс» - горизонтальный формат"""
-        try:
-            df = pd.read_excel(io.BytesIO(file_content), sheet_name=0, header=None, engine='openpyxl')
-        except Exception as e:
-            logger.error(f"Error reading Excel for totals summary block: {e}")
-            return []
+    @staticmethod
+    def parse_misc_expenses_text(misc_expenses_text: Optional[str]) -> List[Dict[str, Any]]:
+        """
+        Разбор текста прочих расходов в записи «сумма-статья»
+
+        В одной строке может быть несколько записей: "1000- т. анар и сразу дальше 2000-т. бобр"
+        """
+        parsed_expenses: List[Dict[str, Any]] = []
+        if not misc_expenses_text:
+            return parsed_expenses
+
+        for line in misc_expenses_text.split('\n'):
+            line = line.strip()
+            if not line or line.lower().startswith('итого'):
+                continue
 
-        if df.empty:
+            number_pattern = r'\d+(?:[.,]\d+)*'
+            number_positions = []
+            for match in re.finditer(number_pattern, line):
+                number_positions.append((match.start(), match.end(), match.group(0)))
+
+            for i, (start_pos, end_pos, number_str) in enumerate(number_positions):
+                after_number = line[end_pos:].lstrip()
+                if not after_number.startswith('-'):
+                    continue
+
+                dash_pos = end_pos + len(line[end_pos:]) - len(after_number)
+                expense_end = len(line)
+
+                # Статья заканчивается перед следующим числом с дефисом
+                for j in range(i + 1, len(number_positions)):
+                    next_start, next_end, _ = number_positions[j]
+                    if line[next_end:].lstrip().startswith('-'):
+                        expense_end = next_start
+                        break
+
+                expense_item = line[dash_pos + 1:expense_end].strip()
+                amount_clean = number_str.replace('.', '').replace(',', '').replace(' ', '')
+                try:
+                    amount = Decimal(amount_clean)
+                except (ValueError, InvalidOperation):
+                    logger.warning(f"Failed to parse amount from '{number_str}'")
+                    continue
+
+                parsed_expenses.append({
+                    'expense_item': expense_item,
+                    'amount': amount,
+                    'is_total': False
+                })
+
+        return parsed_expenses
+
+    def extract_totals_summary(self, source: WorkbookSource) -> List[Dict[str, Any]]:
+        """Извлечение блока «Итоговый баланс» - горизонтальный формат"""
+        workbook = self.load_workbook(source)
+        df = self._resolve_sheet(workbook, "totals summary block")
+        if df is None or df.empty:
             return []
+        sheet = workbook.cells
+        anchors = workbook.anchors
 
         # Ищем строку с заголовками "Доход", "Расход", "Чистая прибыль"
         balance_col = None
         start_row = None
         
-        for row_idx in range(len(df)):
-            for col_idx in range(df.shape[1]):
-                cell = df.iloc[row_idx, col_idx]
-                if isinstance(cell, str) and 'доход' in cell.strip().lower():
-                    # Проверяем, что справа есть "Расход"
-                    next_cell = df.iloc[row_idx, col_idx + 1] if df.shape[1] > col_idx + 1 else None
-                    if next_cell and isinstance(next_cell, str) and 'расход' in next_cell.strip().lower():
-                        balance_col = col_idx - 1  # Колонка с типом оплаты (левее "Дохода")
-                        start_row = row_idx + 1
-                        logger.info(f"Found totals header at row {row_idx}, col {col_idx}, data starts at {start_row}")
-                        break
-            if start_row is not None:
+        for row_idx, col_idx in anchors.find_all('доход'):
+            # Проверяем, что справа есть "Расход"
+            if 'расход' in anchors.cell_text(row_idx, col_idx + 1):
+                balance_col = col_idx - 1  # Колонка с типом оплаты (левее "Дохода")
+                start_row = row_idx + 1
+                logger.info(f"Found totals header at row {row_idx}, col {col_idx}, data starts at {start_row}")
                 break
 
         if start_row is None or balance_col is None:
@@ -1536,11 +1879,11 @@ class ExcelProcessor:
         records: List[Dict[str, Any]] = []
 
         # Формат: balance_col - тип оплаты, balance_col+1 - доход, balance_col+2 - расход, balance_col+3 - чистая прибыль
-        for row_idx in range(start_row, min(start_row + 5, len(df))):
-            type_cell = df.iloc[row_idx, balance_col] if df.shape[1] > balance_col else None
-            income_cell = df.iloc[row_idx, balance_col + 1] if df.shape[1] > balance_col + 1 else None
-            expense_cell = df.iloc[row_idx, balance_col + 2] if df.shape[1] > balance_col + 2 else None
-            net_cell = df.iloc[row_idx, balance_col + 3] if df.shape[1] > balance_col + 3 else None
+        for row_idx in range(start_row, min(start_row + 5, sheet.height)):
+            type_cell = sheet.get(row_idx, balance_col)
+            income_cell = sheet.get(row_idx, balance_col + 1)
+            expense_cell = sheet.get(row_idx, balance_col + 2)
+            net_cell = sheet.get(row_idx, balance_col + 3)
 
             if type_cell is None or (isinstance(type_cell, float) and pd.isna(type_cell)):
                 break
@@ -1567,9 +1910,25 @@ class ExcelProcessor:
 
         return records
 
-    def extract_taxi_expenses(self, file_content: bytes) -> Dict[str, Any]:
+    def extract_taxi_expenses(self, source: WorkbookSource) -> Dict[str, Any]:
         """Извлечение данных по такси из файла"""
         logger.info("=== Starting taxi expenses extraction ===")
+        workbook = self.load_workbook(source)
+
+        misc_expenses_text = None
+        expense_data: Dict[str, Any] = {}
+        try:
+            logger.info("Step 1: Extracting misc expenses for deposits...")
+            misc_expenses_text = self.extract_misc_expenses_from_notes_after_total(workbook)
+            logger.info("Step 2: Extracting expense records to find TAXI and % TAXI...")
+            expense_data = self.extract_expense_records(workbook)
+        except Exception as e:
+            logger.error(f"Error extracting taxi expenses: {e}", exc_info=True)
+
+        return self._build_taxi_expenses(misc_expenses_text, expense_data)
+
+    def _build_taxi_expenses(self, misc_expenses_text: Optional[str], expense_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Расчет блока «ТАКСИ» из уже извлеченных прочих расходов и блока «Расходы»"""
         result = {
             'taxi_amount': Decimal('0.00'),
             'taxi_percent_amount': Decimal('0.00'),
@@ -1578,9 +1937,7 @@ class ExcelProcessor:
         }
         
         try:
-            # 1. Получаем прочие расходы и ищем депозиты
-            logger.info("Step 1: Extracting misc expenses for deposits...")
-            misc_expenses_text = self.extract_misc_expenses_from_notes_after_total(file_content)
+            # 1. Ищем депозиты в прочих расходах
             if misc_expenses_text:
                 # Парсим прочие расходы
                 deposits = []
@@ -1633,9 +1990,7 @@ class ExcelProcessor:
                 
                 result['deposits'] = deposits
             
-            # 2. Получаем блок расходов и ищем "ТАКСИ" и "% ТАКСИСТОВ"
-            logger.info("Step 2: Extracting expense records to find TAXI and % TAXI...")
-            expense_data = self.extract_expense_records(file_content)
+            # 2. Ищем в блоке расходов "ТАКСИ" и "% ТАКСИСТОВ"
             logger.info(f"extract_expense_records returned: {expense_data}")
             
             if expense_data and expense_data.get('records'):
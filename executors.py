@@ -0,0 +1,163 @@
+"""
+Пулы исполнителей для тяжелой работы вне цикла событий бота
+
+Разбор Excel (pandas/openpyxl) нагружает CPU и выполняется в пуле процессов,
+блокирующие вызовы psycopg2 и выгрузка отчетов в Excel - в ограниченном пуле потоков.
+Глубина очереди ограничивает число задач, одновременно отданных в каждый пул:
+остальные обработчики ждут своей очереди в цикле событий, не блокируя его.
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Процессор Excel создается в дочернем процессе один раз и переиспользуется между задачами
+_worker_processor = None
+
+
+def _get_worker_processor():
+    global _worker_processor
+    if _worker_processor is None:
+        from excel_processor import ExcelProcessor
+        _worker_processor = ExcelProcessor()
+    return _worker_processor
+
+
+def _warm_up(_: int = 0) -> int:
+    """Пустая задача для запуска процессов пула заранее"""
+    _get_worker_processor()
+    return os.getpid()
+
+
+def parse_report_file(file_content: bytes, file_name: str) -> Dict[str, Any]:
+    """Полный разбор загруженного файла: строки листа (sheet_rows) и все блоки отчета"""
+    processor = _get_worker_processor()
+    data, stats = processor.process_file(file_content, file_name)
+    blocks = processor.extract_all_blocks(file_content)
+    return {'data': data, 'stats': stats, 'blocks': blocks}
+
+
+def parse_excel_rows(file_content: bytes, file_name: str) -> List[Dict[str, Any]]:
+    """Только строки листа для sheet_rows (блоки взяты из кэша разбора)"""
+    data, _ = _get_worker_processor().process_file(file_content, file_name)
+    return data
+
+
+def extract_report_blocks(file_content: bytes) -> Dict[str, Any]:
+    """Извлечение всех блоков отчета из сохраненного файла"""
+    return _get_worker_processor().extract_all_blocks(file_content)
+
+
+def extract_misc_expenses_text(file_content: bytes) -> Optional[str]:
+    """Извлечение текста прочих расходов из сохраненного файла"""
+    return _get_worker_processor().extract_misc_expenses_from_notes_after_total(file_content)
+
+
+def extract_taxi_expenses(file_content: bytes) -> Dict[str, Any]:
+    """Извлечение данных по такси из сохраненного файла"""
+    return _get_worker_processor().extract_taxi_expenses(file_content)
+
+
+class WorkerPools:
+    """Пул процессов для разбора файлов и ограниченный пул потоков для БД и выгрузок"""
+
+    def __init__(self, process_workers: Optional[int] = None, thread_workers: int = 8,
+                 process_queue_depth: int = 16, thread_queue_depth: int = 64):
+        self.process_workers = process_workers or os.cpu_count() or 1
+        self.thread_workers = thread_workers
+        self.process_queue_depth = max(process_queue_depth, self.process_workers)
+        self.thread_queue_depth = max(thread_queue_depth, self.thread_workers)
+
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        self._thread_pool = ThreadPoolExecutor(
+            max_workers=self.thread_workers, thread_name_prefix='bot-blocking'
+        )
+        # Семафоры создаются в работающем цикле событий при первой задаче
+        self._slots: Dict[str, asyncio.Semaphore] = {}
+
+        self._stats = {
+            'cpu_submitted': 0,
+            'cpu_in_flight': 0,
+            'cpu_waiting': 0,
+            'blocking_submitted': 0,
+            'blocking_in_flight': 0,
+            'blocking_waiting': 0,
+        }
+
+    def _get_process_pool(self) -> ProcessPoolExecutor:
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(max_workers=self.process_workers)
+        return self._process_pool
+
+    def start(self):
+        """
+        Запуск процессов пула до старта бота
+
+        Процессы создаются, пока в основном процессе еще нет рабочих потоков и цикла событий.
+        """
+        pool = self._get_process_pool()
+        pids = set(pool.map(_warm_up, range(self.process_workers)))
+        logger.info(
+            f"Worker pools started: processes={len(pids)}/{self.process_workers}, "
+            f"threads={self.thread_workers}, process queue={self.process_queue_depth}, "
+            f"thread queue={self.thread_queue_depth}"
+        )
+
+    def _get_slots(self, kind: str) -> asyncio.Semaphore:
+        if kind not in self._slots:
+            depth = self.process_queue_depth if kind == 'cpu' else self.thread_queue_depth
+            self._slots[kind] = asyncio.Semaphore(depth)
+        return self._slots[kind]
+
+    async def _submit(self, kind: str, executor, func: Callable, *args, **kwargs):
+        slots = self._get_slots(kind)
+        self._stats[f'{kind}_waiting'] += 1
+        started_at = time.monotonic()
+        try:
+            await slots.acquire()
+        finally:
+            self._stats[f'{kind}_waiting'] -= 1
+
+        waited = time.monotonic() - started_at
+        if waited > 1:
+            logger.info(f"{kind} task {getattr(func, '__name__', func)} waited {waited:.1f}s for a free slot")
+
+        self._stats[f'{kind}_submitted'] += 1
+        self._stats[f'{kind}_in_flight'] += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+        finally:
+            self._stats[f'{kind}_in_flight'] -= 1
+            slots.release()
+
+    async def run_cpu(self, func: Callable, *args, **kwargs):
+        """Выполнение функции в пуле процессов (функция и аргументы должны сериализоваться)"""
+        return await self._submit('cpu', self._get_process_pool(), func, *args, **kwargs)
+
+    async def run_blocking(self, func: Callable, *args, **kwargs):
+        """Выполнение блокирующей функции в пуле потоков"""
+        return await self._submit('blocking', self._thread_pool, func, *args, **kwargs)
+
+    def stats(self) -> Dict[str, int]:
+        """Текущая загрузка пулов"""
+        stats = dict(self._stats)
+        stats.update({
+            'process_workers': self.process_workers,
+            'thread_workers': self.thread_workers,
+            'process_queue_depth': self.process_queue_depth,
+            'thread_queue_depth': self.thread_queue_depth,
+        })
+        return stats
+
+    def shutdown(self, wait: bool = True):
+        """Остановка пулов"""
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=wait, cancel_futures=True)
+            self._process_pool = None
+        self._thread_pool.shutdown(wait=wait, cancel_futures=True)
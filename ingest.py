@@ -0,0 +1,107 @@
+"""
+Разбор и сохранение загруженного отчета
+
+Общий конвейер для обработчика документов бота и воркера очереди (worker.py):
+дедупликация по хэшу содержимого, кэш разбора, разбор в пуле процессов, сохранение.
+"""
+import logging
+from datetime import date
+from typing import Any, Dict, Optional
+
+import executors
+from database import Database
+from excel_processor import PARSER_VERSION
+from executors import WorkerPools
+
+logger = logging.getLogger(__name__)
+
+
+async def ingest_report(db: Database, pools: WorkerPools, user_id: int, username: str, club_name: str,
+                        file_name: str, file_content: bytes, report_date: Optional[date] = None) -> Dict[str, Any]:
+    """
+    Разбор и сохранение одного отчета клуба
+
+    Returns:
+        duplicate=True и данные ранее загруженного файла (file_id, file_name, report_date),
+        если этот файл уже загружен в клуб; иначе file_id, file_hash, report_date,
+        parser_version и разобранные блоки (blocks)
+    """
+    file_hash = Database.compute_file_hash(file_content)
+
+    # Тот же файл уже загружен в этот клуб - его блоки уже разобраны и сохранены
+    existing_file = await pools.run_blocking(db.get_uploaded_file_by_hash, club_name, file_hash)
+    if existing_file:
+        existing_date = existing_file.get('report_date')
+        if report_date and report_date != existing_date:
+            await pools.run_blocking(db.set_uploaded_file_report_date, existing_file['id'], report_date)
+            existing_date = report_date
+        return {
+            'duplicate': True,
+            'file_id': existing_file['id'],
+            'file_name': existing_file['file_name'],
+            'file_hash': file_hash,
+            'report_date': existing_date,
+        }
+
+    # Блоки файла с тем же содержимым могли быть разобраны раньше (например, для другого клуба)
+    cached_blocks = await pools.run_blocking(db.get_cached_blocks, file_hash, PARSER_VERSION)
+    if cached_blocks is not None:
+        logger.info(f"Parse cache hit for {file_name} ({file_hash[:12]})")
+        data = await pools.run_cpu(executors.parse_excel_rows, file_content, file_name)
+        blocks = cached_blocks
+    else:
+        # Разбор Excel файла в пуле процессов: строки листа (sheet_rows) и все блоки из общего листа
+        parsed = await pools.run_cpu(executors.parse_report_file, file_content, file_name)
+        data = parsed['data']
+        blocks = parsed['blocks']
+
+    # Файл, содержимое, строки листа, блоки, кэш разбора и дневные показатели - одной транзакцией:
+    # при сбое не остается файла без блоков, который дедупликация считала бы уже загруженным
+    file_ids = await pools.run_blocking(
+        db.save_report_files,
+        [{
+            'user_id': user_id,
+            'username': username,
+            'file_name': file_name,
+            'file_content': file_content,
+            'file_hash': file_hash,
+            'report_date': report_date,
+            'club_name': club_name,
+            'data': data,
+            'blocks': blocks,
+        }],
+        PARSER_VERSION
+    )
+    file_id = file_ids[0]
+
+    taxi_data = blocks['taxi']
+    logger.info(
+        f"Taxi expenses saved: taxi={taxi_data.get('taxi_amount')}, "
+        f"taxi_percent={taxi_data.get('taxi_percent_amount')}, deposits={taxi_data.get('deposits_total')}"
+    )
+
+    return {
+        'duplicate': False,
+        'file_id': file_id,
+        'file_name': file_name,
+        'file_hash': file_hash,
+        'report_date': report_date,
+        'parser_version': PARSER_VERSION,
+        'blocks': blocks,
+    }
+
+
+def job_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Результат ingest_report для записи в ingest_jobs.result (JSON, без блоков)"""
+    job_data = {key: value for key, value in result.items() if key != 'blocks'}
+    if isinstance(job_data.get('report_date'), date):
+        job_data['report_date'] = job_data['report_date'].isoformat()
+    return job_data
+
+
+def result_from_job(job_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Результат ingest_report из ingest_jobs.result (блоки вызывающий берет из кэша разбора по file_hash)"""
+    result = dict(job_data)
+    if result.get('report_date'):
+        result['report_date'] = date.fromisoformat(result['report_date'])
+    return result
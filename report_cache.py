@@ -0,0 +1,89 @@
+"""
+Кэш сводных отчетов за период
+
+Результат отчета (строки для показа) и выгрузка xlsx хранятся по ключу (клуб, блок, начало, конец)
+вместе с версией данных периода - числом файлов и самой поздней датой загрузки (upload_date).
+Если версия изменилась (файл загружен или удален другим процессом, например воркером очереди),
+запись считается устаревшей. Загрузка, переобработка и очистка файлов в процессе бота
+сбрасывают затронутые записи сразу.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CacheKey = Tuple[str, str, date, date]
+
+
+class PeriodReportCache:
+    """LRU кэш с временем жизни записей и сбросом по клубу и дате отчета"""
+
+    def __init__(self, max_entries: int = 64, ttl: float = 900):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: 'OrderedDict[CacheKey, Dict[str, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidated': 0}
+
+    def get(self, key: CacheKey, version: Hashable) -> Optional[Dict[str, Any]]:
+        """Запись с результатом и xlsx (excel может быть еще None), если она не устарела"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry['version'] != version or time.monotonic() > entry['expires_at']):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry
+
+    def put(self, key: CacheKey, version: Hashable, result: Any) -> Dict[str, Any]:
+        entry = {
+            'version': version,
+            'expires_at': time.monotonic() + self.ttl,
+            'result': result,
+            'excel': None,
+        }
+        if self.max_entries <= 0:
+            return entry
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def find(self, key: CacheKey, result: Any) -> Optional[Dict[str, Any]]:
+        """Запись, хранящая именно этот результат (для сохранения xlsx к нему)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry if entry is not None and entry['result'] is result else None
+
+    def invalidate(self, club_name: Optional[str] = None, report_date: Optional[date] = None) -> int:
+        """
+        Сброс записей клуба, в период которых входит report_date
+
+        Без report_date сбрасываются все периоды клуба, без club_name - все записи.
+        """
+        with self._lock:
+            stale = [
+                key for key in self._entries
+                if (club_name is None or key[0] == club_name)
+                and (report_date is None or key[2] <= report_date <= key[3])
+            ]
+            for key in stale:
+                del self._entries[key]
+            self._stats['invalidated'] += len(stale)
+        if stale:
+            logger.info(f"Period report cache: {len(stale)} entries invalidated (club={club_name}, date={report_date})")
+        return len(stale)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
@@ -0,0 +1,186 @@
+"""
+Параллельная переобработка сохраненных файлов («Обновить все файлы»)
+
+Файлы читаются из БД пачками, разбираются в пуле процессов и сохраняются
+каждый своей транзакцией. Результат по каждому файлу фиксируется в reprocess_run_files,
+поэтому прерванный запуск продолжается с необработанных файлов.
+Файлы, уже разобранные текущей версией парсера, пропускаются (кроме запуска с force),
+а для файлов с тем же содержимым блоки берутся из кэша разбора без чтения Excel.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+import executors
+from database import Database
+from excel_processor import PARSER_VERSION
+from executors import WorkerPools
+
+logger = logging.getLogger(__name__)
+
+ProgressCallback = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class ReprocessAlreadyRunningError(RuntimeError):
+    """Переобработка для пользователя уже выполняется в этом процессе"""
+
+
+class ReprocessEngine:
+    """Переобработка всех файлов пользователя в пуле процессов"""
+
+    def __init__(self, db: Database, pools: WorkerPools, workers: Optional[int] = None,
+                 batch_size: int = 20, progress_interval: float = 2.0):
+        self.db = db
+        self.pools = pools
+        self.workers = workers or pools.process_workers
+        self.batch_size = max(batch_size, self.workers)
+        self.progress_interval = progress_interval
+        self._active_users: Set[int] = set()
+
+    async def run(self, user_id: int, on_progress: Optional[ProgressCallback] = None,
+                  force: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Переобработка всех файлов пользователя
+
+        force - сохранить заново и файлы, уже разобранные текущей версией парсера
+        (версия зависит только от парсера, а не от кода сохранения в database.py)
+
+        Returns:
+            Итоги запуска (total, done, error, skipped, cached, resumed, elapsed) или None, если файлов нет
+        """
+        if user_id in self._active_users:
+            raise ReprocessAlreadyRunningError(f"Reprocessing is already running for user {user_id}")
+
+        self._active_users.add(user_id)
+        try:
+            return await self._run(user_id, on_progress, force)
+        finally:
+            self._active_users.discard(user_id)
+
+    async def _run(self, user_id: int, on_progress: Optional[ProgressCallback],
+                   force: bool) -> Optional[Dict[str, Any]]:
+        run = await self.pools.run_blocking(self.db.start_reprocess_run, user_id, PARSER_VERSION, force)
+        if not run:
+            return None
+
+        run_id = run['id']
+        pending = await self.pools.run_blocking(self.db.get_pending_reprocess_files, run_id)
+        counts = await self.pools.run_blocking(self.db.get_reprocess_run_progress, run_id)
+
+        progress = {
+            'run_id': run_id,
+            'resumed': run['resumed'],
+            'total': run['total_files'],
+            'done': counts['done'],
+            'error': counts['error'],
+            'skipped': counts['skipped'],
+            'cached': 0,
+            'started_at': time.monotonic(),
+        }
+        logger.info(
+            f"Reprocess run {run_id} for user {user_id}: {len(pending)} pending of {progress['total']} "
+            f"(resumed={run['resumed']}, force={force}, workers={self.workers})"
+        )
+
+        last_report = 0.0
+
+        async def report(force: bool = False):
+            nonlocal last_report
+            if on_progress is None:
+                return
+            now = time.monotonic()
+            if not force and now - last_report < self.progress_interval:
+                return
+            last_report = now
+            try:
+                await on_progress(self._snapshot(progress))
+            except Exception as e:
+                logger.warning(f"Reprocess progress callback failed: {e}")
+
+        await report(force=True)
+
+        slots = asyncio.Semaphore(self.workers)
+
+        async def process_one(file_row: Dict[str, Any]):
+            async with slots:
+                status, error_message = await self._process_file(file_row)
+            await self.pools.run_blocking(
+                self.db.mark_reprocess_file, run_id, file_row['id'], 'error' if status == 'error' else 'done', error_message
+            )
+            if status == 'cached':
+                progress['cached'] += 1
+            progress['error' if status == 'error' else 'done'] += 1
+            await report()
+
+        # Следующая пачка читается из БД, пока обрабатывается текущая
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        next_batch = (
+            asyncio.ensure_future(self.pools.run_blocking(self.db.get_file_contents, batches[0]))
+            if batches else None
+        )
+        for index in range(len(batches)):
+            file_rows = await next_batch
+            requested = set(batches[index])
+            next_batch = (
+                asyncio.ensure_future(self.pools.run_blocking(self.db.get_file_contents, batches[index + 1]))
+                if index + 1 < len(batches) else None
+            )
+
+            # Файл мог быть удален во время переобработки
+            missing = requested - {row['id'] for row in file_rows}
+            for file_id in missing:
+                await self.pools.run_blocking(
+                    self.db.mark_reprocess_file, run_id, file_id, 'error', 'file not found'
+                )
+                progress['error'] += 1
+
+            await asyncio.gather(*(process_one(row) for row in file_rows))
+
+        await self.pools.run_blocking(self.db.finish_reprocess_run, run_id)
+        await report(force=True)
+
+        result = self._snapshot(progress)
+        logger.info(
+            f"Reprocess run {run_id} finished: done={result['done']}, errors={result['error']}, "
+            f"elapsed={result['elapsed']:.1f}s"
+        )
+        return result
+
+    async def _process_file(self, file_row: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+        """Разбор и сохранение одного файла; возвращает (status, error_message)"""
+        file_id = file_row['id']
+        file_name = file_row['file_name']
+        file_content = file_row['file_content']
+
+        if not file_content:
+            logger.warning(f"File {file_id} has no content, skipping")
+            return 'error', 'no content'
+
+        try:
+            blocks = await self.pools.run_blocking(self.db.get_cached_blocks, file_row['file_hash'], PARSER_VERSION)
+            status = 'cached'
+            if blocks is None:
+                blocks = await self.pools.run_cpu(executors.extract_report_blocks, file_content)
+                status = 'done'
+            # Все блоки (включая ТАКСИ и прочие расходы) сохраняются одной транзакцией
+            await self.pools.run_blocking(self.db.save_parsed_report, file_id, blocks, PARSER_VERSION)
+            logger.info(f"File {file_id} ({file_name}) reprocessed successfully ({status})")
+            return status, None
+        except Exception as e:
+            logger.error(f"Error reprocessing file {file_id} ({file_name}): {e}", exc_info=True)
+            return 'error', str(e)
+
+    @staticmethod
+    def _snapshot(progress: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'run_id': progress['run_id'],
+            'resumed': progress['resumed'],
+            'total': progress['total'],
+            'done': progress['done'],
+            'error': progress['error'],
+            'skipped': progress['skipped'],
+            'cached': progress['cached'],
+            'processed': progress['done'] + progress['error'] + progress['skipped'],
+            'elapsed': time.monotonic() - progress['started_at'],
+        }
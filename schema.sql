@@ -7,35 +7,128 @@ CREATE TABLE IF NOT EXISTS uploaded_files (
     upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     file_hash VARCHAR(64),
     row_count INTEGER DEFAULT 0,
-    report_date DATE,
-    file_content BYTEA
+    report_date DATE
 );
 
 ALTER TABLE uploaded_files
     ADD COLUMN IF NOT EXISTS report_date DATE;
 
-ALTER TABLE uploaded_files
-    ADD COLUMN IF NOT EXISTS file_content BYTEA;
-
 ALTER TABLE uploaded_files
     ADD COLUMN IF NOT EXISTS club_name VARCHAR(50);
 
--- Создание таблицы для хранения данных из Excel файлов
-CREATE TABLE IF NOT EXISTS excel_data (
-    id SERIAL PRIMARY KEY,
-    file_id INTEGER REFERENCES uploaded_files(id) ON DELETE CASCADE,
+-- Строки исходного листа Excel: одна строка таблицы на строку файла, ячейки - JSONB {колонка: значение}
+CREATE TABLE IF NOT EXISTS sheet_rows (
+    file_id INTEGER NOT NULL REFERENCES uploaded_files(id) ON DELETE CASCADE,
     row_number INTEGER NOT NULL,
-    column_name VARCHAR(255) NOT NULL,
-    column_value TEXT,
-    data_type VARCHAR(50),
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    data JSONB NOT NULL,
+    PRIMARY KEY (file_id, row_number)
 );
 
--- Создание индексов для быстрого поиска
-CREATE INDEX IF NOT EXISTS idx_excel_data_file_id ON excel_data(file_id);
-CREATE INDEX IF NOT EXISTS idx_excel_data_column_name ON excel_data(column_name);
+-- Отбор строк, в которых есть колонка (data ? 'колонка') или значение (data @> '{...}')
+CREATE INDEX IF NOT EXISTS idx_sheet_rows_data ON sheet_rows USING GIN (data);
+
+-- Перенос старой таблицы excel_data (одна строка на ячейку) в sheet_rows.
+-- Старая таблица не удаляется, а переименовывается в excel_data_legacy; число перенесенных
+-- ячеек и строк попадает в лог запуска. После проверки excel_data_legacy можно удалить вручную
+DO $$
+DECLARE
+    legacy_cells BIGINT;
+    migrated_rows BIGINT;
+    migrated_cells BIGINT;
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_class
+        WHERE oid = to_regclass('excel_data') AND relkind = 'r'
+    ) THEN
+        IF to_regclass('excel_data_legacy') IS NOT NULL THEN
+            RAISE EXCEPTION 'excel_data_legacy already exists, cannot migrate excel_data';
+        END IF;
+
+        SELECT COUNT(*) INTO legacy_cells FROM excel_data WHERE file_id IS NOT NULL;
+
+        INSERT INTO sheet_rows (file_id, row_number, data)
+        SELECT file_id, row_number, jsonb_object_agg(column_name, column_value)
+        FROM excel_data
+        WHERE file_id IS NOT NULL
+        GROUP BY file_id, row_number
+        ON CONFLICT (file_id, row_number) DO NOTHING;
+
+        SELECT COUNT(*), COALESCE(SUM((SELECT COUNT(*) FROM jsonb_object_keys(data))), 0)
+        INTO migrated_rows, migrated_cells
+        FROM sheet_rows;
+
+        RAISE NOTICE 'migration: excel_data migrated: % cells -> % sheet rows with % cells, old table renamed to excel_data_legacy',
+            legacy_cells, migrated_rows, migrated_cells;
+        ALTER TABLE excel_data RENAME TO excel_data_legacy;
+    END IF;
+END $$;
+
+-- Ячейки в прежнем виде (для запросов DeepSeek и примеров SQL)
+CREATE OR REPLACE VIEW excel_data AS
+SELECT r.file_id, r.row_number, c.key AS column_name, c.value AS column_value
+FROM sheet_rows r
+CROSS JOIN LATERAL jsonb_each_text(r.data) AS c;
+
 CREATE INDEX IF NOT EXISTS idx_uploaded_files_user_id ON uploaded_files(user_id);
 
+-- Версия парсера, которой разобраны блоки файла (при совпадении переобработка не нужна)
+ALTER TABLE uploaded_files
+    ADD COLUMN IF NOT EXISTS parser_version VARCHAR(64);
+
+-- Уникальный индекс (club_name, file_hash) создается в Database._dedupe_uploaded_files:
+-- до этого из базы удаляются (с записью в лог) повторные загрузки одного файла в клуб
+
+-- Отбор файлов клуба за дату/период и выбор последней загрузки за дату
+CREATE INDEX IF NOT EXISTS idx_uploaded_files_club_report_date
+    ON uploaded_files(club_name, report_date, upload_date DESC, id DESC);
+
+-- Текущий файл клуба за дату отчета: при повторной загрузке даты учитывается только последняя.
+-- Все сводные отчеты за период читают файлы через это представление
+CREATE OR REPLACE VIEW current_uploaded_files AS
+SELECT DISTINCT ON (club_name, report_date)
+       id, user_id, username, file_name, upload_date, file_hash, row_count, report_date, club_name, parser_version
+FROM uploaded_files
+WHERE report_date IS NOT NULL
+ORDER BY club_name, report_date, upload_date DESC, id DESC;
+
+-- Кэш разобранных блоков по содержимому файла и версии парсера.
+-- Блоки хранятся в JSON: Decimal и даты - {"$decimal": "..."}, {"$date": "..."} (Database._dump_blocks)
+CREATE TABLE IF NOT EXISTS parse_cache (
+    file_hash VARCHAR(64) NOT NULL,
+    parser_version VARCHAR(64) NOT NULL,
+    blocks JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (file_hash, parser_version)
+);
+
+-- Раньше блоки хранились в pickle (BYTEA): такие записи не читаются, кэш заполнится заново
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'parse_cache' AND column_name = 'blocks' AND data_type = 'bytea'
+    ) THEN
+        DELETE FROM parse_cache;
+        ALTER TABLE parse_cache ALTER COLUMN blocks TYPE JSONB USING '{}'::jsonb;
+        RAISE NOTICE 'migration: parse_cache switched from pickle to JSONB, old entries removed';
+    END IF;
+END $$;
+
+-- Хранилище исходных файлов по хэшу содержимого (сжатие zstd, codec: zstd/zlib/raw).
+-- uploaded_files хранит только file_hash; одинаковые файлы разных клубов хранятся один раз.
+-- Старое содержимое uploaded_files.file_content переносится сюда при запуске, после чего колонка
+-- удаляется (Database._migrate_file_blobs)
+CREATE TABLE IF NOT EXISTS file_blobs (
+    file_hash VARCHAR(64) PRIMARY KEY,
+    codec VARCHAR(10) NOT NULL,
+    size INTEGER NOT NULL,
+    content BYTEA NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Сжатое содержимое уже сжато: PostgreSQL не пытается сжать его повторно
+ALTER TABLE file_blobs ALTER COLUMN content SET STORAGE EXTERNAL;
+
 -- Таблица для блока «ДОХОДЫ»
 CREATE TABLE IF NOT EXISTS income_records (
     id SERIAL PRIMARY KEY,
@@ -206,6 +299,26 @@ CREATE TABLE IF NOT EXISTS employees (
 
 CREATE INDEX IF NOT EXISTS idx_employees_full_name ON employees(full_name);
 
+-- Поиск по подстроке (ILIKE '%...%') и по похожести: триграммные GIN индексы pg_trgm.
+-- Если расширение недоступно (нет postgresql-contrib или прав), индексы не создаются,
+-- а Database ищет обычным ILIKE
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+EXCEPTION WHEN OTHERS THEN
+    RAISE NOTICE 'pg_trgm is not available: %', SQLERRM;
+END $$;
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+        CREATE INDEX IF NOT EXISTS idx_employees_full_name_trgm ON employees USING GIN (full_name gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_employees_code_trgm ON employees USING GIN (employee_code gin_trgm_ops);
+        -- Предварительный отбор строк sheet_rows по подстроке значения (точная проверка - по колонке)
+        CREATE INDEX IF NOT EXISTS idx_sheet_rows_text_trgm ON sheet_rows USING GIN ((data::text) gin_trgm_ops);
+    END IF;
+END $$;
+
 -- Таблица для расходов вне смены
 CREATE TABLE IF NOT EXISTS off_shift_expenses (
     id SERIAL PRIMARY KEY,
@@ -238,3 +351,86 @@ CREATE INDEX IF NOT EXISTS idx_off_shift_expenses_date ON off_shift_expenses(exp
 CREATE INDEX IF NOT EXISTS idx_off_shift_expenses_payment_type ON off_shift_expenses(payment_type);
 
 
+
+-- Запуски переобработки всех файлов пользователя (для продолжения после сбоя)
+CREATE TABLE IF NOT EXISTS reprocess_runs (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'running',
+    total_files INTEGER NOT NULL DEFAULT 0,
+    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_reprocess_runs_user_status ON reprocess_runs(user_id, status);
+
+-- Файлы запуска переобработки: pending -> done / error / skipped, фиксируется после каждого файла
+CREATE TABLE IF NOT EXISTS reprocess_run_files (
+    run_id INTEGER REFERENCES reprocess_runs(id) ON DELETE CASCADE,
+    file_id INTEGER REFERENCES uploaded_files(id) ON DELETE CASCADE,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    error_message TEXT,
+    processed_at TIMESTAMP,
+    PRIMARY KEY (run_id, file_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_reprocess_run_files_status ON reprocess_run_files(run_id, status);
+
+-- Очередь задач разбора: загрузки и переобработка выполняются отдельными воркерами (worker.py).
+-- Воркер забирает задачу через FOR UPDATE SKIP LOCKED и обновляет heartbeat_at, пока работает;
+-- задача с устаревшим heartbeat_at (воркер упал) возвращается в очередь
+CREATE TABLE IF NOT EXISTS ingest_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    kind VARCHAR(20) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    user_id BIGINT NOT NULL,
+    chat_id BIGINT,
+    message_id BIGINT,
+    payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+    file_content BYTEA,
+    progress JSONB,
+    result JSONB,
+    error_message TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker_id VARCHAR(100),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    heartbeat_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    notified_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_ingest_jobs_queued ON ingest_jobs(id) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS idx_ingest_jobs_running ON ingest_jobs(heartbeat_at) WHERE status = 'running';
+CREATE INDEX IF NOT EXISTS idx_ingest_jobs_unnotified ON ingest_jobs(id) WHERE notified_at IS NULL AND chat_id IS NOT NULL;
+
+-- Дневные показатели клуба: одна строка на (клуб, дата отчета) по текущему файлу дня
+-- (последней загрузке, см. current_uploaded_files); file_count - число всех загрузок за дату.
+-- Пересчитывается в той же транзакции, что и строки блоков; отчеты за неделю/месяц/период
+-- читают диапазон дат по первичному ключу. Расходы вне смены сюда не входят.
+CREATE TABLE IF NOT EXISTS daily_club_facts (
+    club_name VARCHAR(50) NOT NULL,
+    report_date DATE NOT NULL,
+    file_count INTEGER NOT NULL DEFAULT 0,
+    shift_income_total NUMERIC(14,2) NOT NULL DEFAULT 0,
+    staff_amount NUMERIC(14,2) NOT NULL DEFAULT 0,
+    staff_hookah_amount NUMERIC(14,2) NOT NULL DEFAULT 0,
+    guests_count INTEGER NOT NULL DEFAULT 0,
+    tickets_amount NUMERIC(14,2) NOT NULL DEFAULT 0,
+    cash_income NUMERIC(14,2) NOT NULL DEFAULT 0,
+    cash_expense NUMERIC(14,2) NOT NULL DEFAULT 0,
+    noncash_income NUMERIC(14,2) NOT NULL DEFAULT 0,
+    noncash_expense NUMERIC(14,2) NOT NULL DEFAULT 0,
+    net_profit NUMERIC(14,2) NOT NULL DEFAULT 0,
+    taxi_amount NUMERIC(14,2) NOT NULL DEFAULT 0,
+    taxi_percent_amount NUMERIC(14,2) NOT NULL DEFAULT 0,
+    deposits_total NUMERIC(14,2) NOT NULL DEFAULT 0,
+    taxi_total NUMERIC(14,2) NOT NULL DEFAULT 0,
+    debts_total NUMERIC(14,2) NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (club_name, report_date)
+);
+
+-- Версия правил подсчета (DAILY_FACTS_VERSION в database.py): строки старой версии пересчитываются при запуске
+ALTER TABLE daily_club_facts
+    ADD COLUMN IF NOT EXISTS facts_version INTEGER NOT NULL DEFAULT 1;
@@ -0,0 +1,73 @@
+"""
+Проверка запомненной раскладки листа: лишние ячейки с ключевыми словами сбрасывают кэш
+"""
+import io
+import os
+import sys
+
+import pytest
+from openpyxl import load_workbook
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from excel_processor import ExcelProcessor, ParsedWorkbook, SheetAnchorIndex  # noqa: E402
+
+SAMPLE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '01.11.xlsx')
+
+
+@pytest.fixture
+def sample_content():
+    if not os.path.exists(SAMPLE_PATH):
+        pytest.skip('нет образца 01.11.xlsx')
+    with open(SAMPLE_PATH, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture(autouse=True)
+def clean_layouts():
+    SheetAnchorIndex._known_layouts.clear()
+    yield
+    SheetAnchorIndex._known_layouts.clear()
+
+
+def _with_extra_anchors(content: bytes) -> bytes:
+    """Тот же отчет с лишними ячейками «Инкассация» в строках 1 и 4, колонках 12-15"""
+    workbook = load_workbook(io.BytesIO(content))
+    sheet = workbook.worksheets[0]
+    for row in (1, 4):
+        for col in range(12, 16):
+            sheet.cell(row=row, column=col, value='Инкассация')
+    output = io.BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+
+def _blocks(content: bytes):
+    processor = ExcelProcessor()
+    workbook = ParsedWorkbook(content)
+    return workbook, processor.extract_all_blocks(workbook)
+
+
+def test_same_layout_uses_cache(sample_content):
+    _blocks(sample_content)
+    workbook, cached = _blocks(sample_content)
+    assert workbook.anchors.from_layout
+
+    SheetAnchorIndex._known_layouts.clear()
+    _, full = _blocks(sample_content)
+    assert cached == full
+
+
+def test_extra_anchor_cells_fall_back_to_full_scan(sample_content):
+    extra = _with_extra_anchors(sample_content)
+
+    SheetAnchorIndex._known_layouts.clear()
+    _, full = _blocks(extra)
+
+    SheetAnchorIndex._known_layouts.clear()
+    _blocks(sample_content)
+    workbook, cached = _blocks(extra)
+
+    assert not workbook.anchors.from_layout
+    assert cached['cash'] == full['cash']
+    assert cached == full
@@ -0,0 +1,138 @@
+"""
+Прием обновлений Telegram через webhook и параллельная обработка с порядком внутри чата
+
+Обновления разных чатов обрабатываются параллельно, обновления одного чата - строго по очереди:
+состояние многошаговых диалогов хранится в context.user_data (awaiting_report_period,
+expense_action и др.), и следующее сообщение пользователя должно видеть результат предыдущего.
+
+Webhook обслуживает локальный сервер aiohttp. Проверка без Telegram: POST JSON обновления
+на http://WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH (ответы бота уходят на TELEGRAM_BASE_URL).
+"""
+import asyncio
+import logging
+import signal
+from typing import Any, Awaitable, Dict, Hashable, List, Optional
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application, BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка обновлений с сохранением порядка внутри чата
+
+    max_pending_updates - сколько обновлений может ждать своей очереди (ограничение PTB),
+    concurrency - сколько обработчиков выполняется одновременно.
+    """
+
+    def __init__(self, concurrency: int = 8, max_pending_updates: int = 256):
+        super().__init__(max(max_pending_updates, concurrency))
+        self.concurrency = max(concurrency, 1)
+        self._slots = asyncio.Semaphore(self.concurrency)
+        # Замок чата и число обновлений, которые его держат или ждут
+        self._chat_locks: Dict[Hashable, List[Any]] = {}
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[Hashable]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return ('user', update.effective_user.id)
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._chat_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._chat_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # Слот занимается только после замка чата: ожидающие обновления одного чата не занимают слоты
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._chat_locks.pop(key, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+def create_webhook_app(application: Application, path: str, secret_token: Optional[str] = None) -> web.Application:
+    """Приложение aiohttp, передающее полученные обновления в очередь бота"""
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if secret_token and request.headers.get(SECRET_TOKEN_HEADER) != secret_token:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            logger.warning(f"Invalid webhook update: {e}")
+            return web.Response(status=400)
+
+        # Telegram получает ответ сразу, обработка идет в фоне
+        await application.update_queue.put(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    return app
+
+
+async def serve_webhook(application: Application, listen: str, port: int, path: str,
+                        webhook_url: Optional[str] = None, secret_token: Optional[str] = None):
+    """
+    Запуск бота в режиме webhook до SIGINT/SIGTERM
+
+    Если указан webhook_url (внешний адрес, под которым доступен path), он регистрируется в Telegram.
+    Без него сервер только принимает обновления локально.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: остановка по KeyboardInterrupt
+            pass
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        if webhook_url:
+            await application.bot.set_webhook(
+                webhook_url,
+                allowed_updates=Update.ALL_TYPES,
+                secret_token=secret_token
+            )
+        await application.start()
+
+        runner = web.AppRunner(create_webhook_app(application, path, secret_token))
+        await runner.setup()
+        site = web.TCPSite(runner, listen, port)
+        await site.start()
+        logger.info(f"Webhook server listening on http://{listen}:{port}{path}")
+
+        try:
+            await stop_event.wait()
+        finally:
+            await runner.cleanup()
+            await application.stop()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
@@ -0,0 +1,203 @@
+"""
+Воркер очереди разбора (ingest_jobs)
+
+Запуск: python worker.py. Можно запускать несколько воркеров (на одной или разных машинах):
+задачи забираются через FOR UPDATE SKIP LOCKED, каждая достается одному воркеру.
+Бот в режиме INGEST_MODE=queue только ставит задачи и показывает их прогресс.
+"""
+import asyncio
+import logging
+import os
+import socket
+import sys
+from datetime import date
+from typing import Any, Dict, Optional, Set
+
+from dotenv import load_dotenv
+
+from database import Database
+from executors import WorkerPools
+from ingest import ingest_report, job_result
+from reprocessing import ReprocessEngine
+
+logger = logging.getLogger(__name__)
+
+
+class IngestWorker:
+    """Цикл выполнения задач из ingest_jobs"""
+
+    def __init__(self, db: Database, pools: WorkerPools, reprocess_engine: ReprocessEngine,
+                 worker_id: Optional[str] = None, concurrency: int = 2, poll_interval: float = 1.0,
+                 lease_seconds: float = 120, heartbeat_interval: float = 10, max_attempts: int = 3):
+        self.db = db
+        self.pools = pools
+        self.reprocess_engine = reprocess_engine
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.concurrency = max(concurrency, 1)
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.max_attempts = max_attempts
+        self._running: Set[asyncio.Task] = set()
+        self._stopping = False
+
+    async def run(self):
+        """Забирает задачи, пока есть свободные слоты; без задач ждет poll_interval"""
+        logger.info(f"Ingest worker {self.worker_id} started (concurrency={self.concurrency})")
+        while not self._stopping:
+            if len(self._running) >= self.concurrency:
+                await asyncio.wait(self._running, return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            try:
+                job = await self.pools.run_blocking(
+                    self.db.claim_job, self.worker_id, self.lease_seconds, self.max_attempts
+                )
+            except Exception as e:
+                logger.error(f"Failed to claim a job: {e}")
+                job = None
+
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            task = asyncio.create_task(self._execute(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+        if self._running:
+            await asyncio.wait(self._running)
+
+    def stop(self):
+        self._stopping = True
+
+    async def _execute(self, job: Dict[str, Any]):
+        job_id = job['id']
+        logger.info(f"Job {job_id} ({job['kind']}) claimed, attempt {job['attempts']}")
+        progress: Dict[str, Any] = {}
+
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(self.heartbeat_interval)
+                try:
+                    owned = await self.pools.run_blocking(
+                        self.db.heartbeat_job, job_id, self.worker_id, progress or None
+                    )
+                except Exception as e:
+                    logger.warning(f"Heartbeat for job {job_id} failed: {e}")
+                    continue
+                if not owned:
+                    logger.warning(f"Job {job_id} is no longer owned by worker {self.worker_id}, heartbeat stopped")
+                    return
+
+        heartbeat_task = asyncio.create_task(heartbeat())
+        try:
+            if job['kind'] == 'upload':
+                result = await self._run_upload(job)
+            elif job['kind'] == 'reprocess':
+                result = await self._run_reprocess(job, progress)
+            else:
+                raise ValueError(f"Unknown job kind: {job['kind']}")
+            await self._finish(job_id, 'done', result)
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}", exc_info=True)
+            await self._finish(job_id, 'error', None, str(e))
+        finally:
+            heartbeat_task.cancel()
+
+    async def _finish(self, job_id: int, status: str, result: Optional[Dict[str, Any]] = None,
+                      error_message: Optional[str] = None):
+        """Запись итога задачи; задача, которую забрал другой воркер, не перезаписывается"""
+        try:
+            owned = await self.pools.run_blocking(
+                self.db.finish_job, job_id, self.worker_id, status, result, error_message
+            )
+        except Exception as e:
+            logger.error(f"Failed to finish job {job_id} as {status}: {e}")
+            return
+        if owned:
+            logger.info(f"Job {job_id} {status}")
+        else:
+            logger.warning(f"Job {job_id} lost its lease, {status} result of worker {self.worker_id} dropped")
+
+    async def _run_upload(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        payload = job['payload']
+        report_date = payload.get('report_date')
+        result = await ingest_report(
+            self.db,
+            self.pools,
+            user_id=job['user_id'],
+            username=payload.get('username'),
+            club_name=payload['club_name'],
+            file_name=payload['file_name'],
+            file_content=bytes(job['file_content']),
+            report_date=date.fromisoformat(report_date) if report_date else None
+        )
+        return job_result(result)
+
+    async def _run_reprocess(self, job: Dict[str, Any], progress: Dict[str, Any]) -> Dict[str, Any]:
+        async def on_progress(snapshot: Dict[str, Any]):
+            progress.clear()
+            progress.update(snapshot)
+            await self.pools.run_blocking(self.db.heartbeat_job, job['id'], self.worker_id, snapshot)
+
+        result = await self.reprocess_engine.run(
+            job['user_id'], on_progress=on_progress, force=bool((job['payload'] or {}).get('force'))
+        )
+        return result or {'total': 0}
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO,
+        stream=sys.stdout,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    db = Database(
+        host=os.getenv('DB_HOST', 'localhost'),
+        port=int(os.getenv('DB_PORT', 5432)),
+        database=os.getenv('DB_NAME', 'excel_bot'),
+        user=os.getenv('DB_USER', 'postgres'),
+        password=os.getenv('DB_PASSWORD', 'postgres'),
+        pool_min=int(os.getenv('DB_POOL_MIN', 1)),
+        pool_max=int(os.getenv('DB_POOL_MAX', 10)),
+        pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+        pool_max_idle=float(os.getenv('DB_POOL_MAX_IDLE', 300)),
+        prepared_statements=os.getenv('DB_PREPARED_STATEMENTS', '1') != '0'
+    )
+    pools = WorkerPools(
+        process_workers=int(os.getenv('WORKER_PROCESSES', 0)) or None,
+        thread_workers=int(os.getenv('WORKER_THREADS', os.getenv('DB_POOL_MAX', 10))),
+        process_queue_depth=int(os.getenv('WORKER_PROCESS_QUEUE', 16)),
+        thread_queue_depth=int(os.getenv('WORKER_THREAD_QUEUE', 64))
+    )
+    reprocess_engine = ReprocessEngine(
+        db,
+        pools,
+        workers=int(os.getenv('REPROCESS_WORKERS', 0)) or None,
+        batch_size=int(os.getenv('REPROCESS_BATCH_SIZE', 20))
+    )
+    worker = IngestWorker(
+        db,
+        pools,
+        reprocess_engine,
+        concurrency=int(os.getenv('INGEST_WORKER_CONCURRENCY', 2)),
+        poll_interval=float(os.getenv('INGEST_POLL_INTERVAL', 1)),
+        lease_seconds=float(os.getenv('INGEST_JOB_LEASE', 120)),
+        max_attempts=int(os.getenv('INGEST_JOB_MAX_ATTEMPTS', 3))
+    )
+
+    pools.start()
+    try:
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        logger.info("Ingest worker stopped")
+    finally:
+        pools.shutdown()
+        db.close()
+
+
+if __name__ == '__main__':
+    main()